@@ -0,0 +1,68 @@
+# -*- encoding: utf-8 -*-
+
+from collections import OrderedDict
+import time
+
+class LRUCache(object):
+    """
+    A bounded in-memory cache, evicting the least recently
+    used entries first. Entries can also expire after a
+    fixed time to live. Values cannot be None.
+    """
+    def __init__(self, max_size=100000, ttl=None):
+        """
+        :param max_size: the maximum number of entries
+        :param ttl: the number of seconds after which entries
+            expire (they never do if None)
+        """
+        if max_size < 0:
+            raise ValueError('The size of the cache has to be nonnegative.')
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        """
+        Returns the value stored for the key,
+        or None if there is none (or if it has expired).
+        """
+        entry = self.entries.get(key)
+        if entry is not None:
+            value, expires = entry
+            if expires is None or expires > time.monotonic():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return value
+            del self.entries[key]
+        self.misses += 1
+
+    def put(self, key, value):
+        """
+        Stores a value, evicting the least recently used
+        entries if the cache is full.
+        """
+        if not self.max_size:
+            return
+        expires = time.monotonic() + self.ttl if self.ttl is not None else None
+        self.entries[key] = (value, expires)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, key):
+        self.entries.pop(key, None)
+
+    def clear(self):
+        self.entries.clear()
+
+    def hit_ratio(self):
+        """
+        The proportion of lookups answered from the cache.
+        """
+        lookups = self.hits + self.misses
+        return float(self.hits) / lookups if lookups else 0.
@@ -1,7 +1,10 @@
 # -*- encoding: utf-8 -*-
 
-from gevent.lock import Semaphore
 from urltheory.preftree import PrefTree
+from .rwlock import ReadWriteLock
+from .forestfile import is_forest_file
+from .forestfile import read_forest
+from .forestfile import write_forest
 import pickle
 
 class URLForest(object):
@@ -14,8 +17,13 @@ class URLForest(object):
     - a PrefTree to classify URLs that are registration-protected…
 
     This class is intended to be a greenlet-safe interface to these
-    trees.
+    trees. Each tree is protected by a :class:`ReadWriteLock`:
+    lookups in a tree run concurrently, while the methods which
+    modify it (listed in `write_methods`) have exclusive access.
     """
+    # methods of the trees which modify them
+    write_methods = frozenset(['add_url', 'prune_dirty', 'merge'])
+
     def __init__(self):
         self.trees = {}
         self.locks = {}
@@ -31,8 +39,26 @@ class URLForest(object):
                 'A tree with id %s is already present.' % id)
         if tree is None:
             tree = PrefTree()
+        lock = None
+        joint = getattr(tree, 'joint', None)
+        if joint is not None:
+            # the classes of a joint tree share its lock
+            lock = next((self.locks[other] for other, view in self.trees.items()
+                         if getattr(view, 'joint', None) is joint), None)
         self.trees[id] = tree
-        self.locks[id] = Semaphore(1)
+        self.locks[id] = lock or ReadWriteLock()
+
+    def add_joint_tree(self, tree):
+        """
+        Add a :class:`urltheory.jointtree.JointPrefTree`, as the
+        classifier tree of each of its classes.
+        """
+        for id in tree.classes:
+            if id in self.trees:
+                raise ValueError(
+                    'A tree with id %s is already present.' % id)
+        for id in tree.classes:
+            self.add_tree(id, tree.class_view(id))
 
     def __contains__(self, key):
         return key in self.trees
@@ -51,6 +77,47 @@ class URLForest(object):
         """
         return self._run_method('match_length', id, *args, **kwargs)
 
+    def match_confident(self, id, *args, **kwargs):
+        """
+        Matches a URL with the tree identified by the identifier,
+        checking the confidence of the nodes on the way down.
+        All arguments after the first one are passed to
+        PrefTree.match_confident()
+        """
+        return self._run_method('match_confident', id, *args, **kwargs)
+
+    def match_many(self, id, urls):
+        """
+        Matches a batch of tokenized URLs with the tree identified
+        by the identifier, acquiring its lock only once.
+        Frozen trees (see :meth:`freeze`) match the whole batch
+        at once. Returns NumPy arrays: see :meth:`PrefTree.match_many`.
+        """
+        return self._run_method('match_many', id, urls)
+
+    def match_all(self, url):
+        """
+        Matches a URL with all the trees of the forest. Joint trees
+        are only walked down once for all their classes.
+
+        :returns: a dictionary mapping each id to the triple
+            returned by :meth:`PrefTree.match_length`
+        """
+        results = {}
+        for id, tree in list(self.trees.items()):
+            if id in results:
+                continue
+            joint = getattr(tree, 'joint', None)
+            if joint is None:
+                results[id] = self._run_method('match_length', id, url)
+                continue
+            with self.locks[id].read_locked():
+                counts, successes, lengths = joint.match_all(url)
+            for k, class_id in enumerate(joint.classes):
+                if getattr(self.trees.get(class_id), 'joint', None) is joint:
+                    results[class_id] = (float(counts[k]), float(successes[k]),
+                                          int(lengths[k]))
+        return results
 
     def add_url(self, id, *args, **kwargs):
         """
@@ -59,20 +126,78 @@ class URLForest(object):
         """
         return self._run_method('add_url', id, *args, **kwargs)
 
+    def add_urls(self, id, urls, prune_kwargs=None):
+        """
+        Adds a batch of URLs to the tree identified by the identifier,
+        acquiring its lock only once.
+
+        :param urls: an iterable of tuples (url, success_count) or
+            (url, success_count, url_count), passed to PrefTree.add_url()
+        :param prune_kwargs: passed to PrefTree.add_url()
+        """
+        if id not in self.trees:
+            raise ValueError('Unknown id %s.' % id)
+        with self.locks[id].write_locked():
+            tree = self.trees[id]
+            for url in urls:
+                tree.add_url(*url, prune_kwargs=prune_kwargs)
+
+    def prune_dirty(self, id, *args, **kwargs):
+        """
+        Prunes the parts of the tree identified by the identifier
+        which have changed since the last prune.
+        All arguments after the first one are passed to PrefTree.prune_dirty()
+        """
+        return self._run_method('prune_dirty', id, *args, **kwargs)
+
+    def merge(self, other):
+        """
+        Merges the trees of another forest into this one
+        (see :meth:`PrefTree.merge`). Trees for new ids are
+        added to the forest. The other forest should not be used
+        afterwards.
+        """
+        for id, tree in list(other.trees.items()):
+            if id in self.trees:
+                self._run_method('merge', id, tree)
+            else:
+                self.add_tree(id, tree)
+
+    def freeze(self, id, smoothing=None):
+        """
+        Replaces the tree identified by the identifier by its
+        frozen version (see :meth:`PrefTree.freeze`). The tree
+        cannot be modified anymore, but it is matched without
+        acquiring its lock.
+        """
+        if id not in self.trees:
+            raise ValueError('Unknown id %s.' % id)
+        with self.locks[id].write_locked():
+            frozen = self.trees[id].freeze(smoothing=smoothing)
+            self.trees[id] = frozen
+        return frozen
+
     def print_as_tree(self, id, *args, **kwargs):
         return self._run_method('print_as_tree', id, *args, **kwargs)
 
     def _run_method(self, method, id, *args, **kwargs):
         """
         Internal wrapper that acquires the lock and runs a method of the
-        tree.
+        tree: for writing if the method modifies the tree (see
+        `write_methods`), for reading otherwise. Read-only trees are
+        run without the lock.
         """
         if id not in self.trees:
             raise ValueError('Unknown id %s.' % id)
-        self.locks[id].acquire()
-        response = getattr(self.trees[id], method)(*args, **kwargs)
-        self.locks[id].release()
-        return response
+        tree = self.trees[id]
+        if getattr(tree, 'read_only', False):
+            return getattr(tree, method)(*args, **kwargs)
+        lock = self.locks[id]
+        if method in self.write_methods:
+            with lock.write_locked():
+                return getattr(self.trees[id], method)(*args, **kwargs)
+        with lock.read_locked():
+            return getattr(self.trees[id], method)(*args, **kwargs)
 
     def clear(self):
         """
@@ -85,18 +210,38 @@ class URLForest(object):
 
     def load(self, fname):
         """
-        Loads the forest from a file (with pickle)
+        Loads the forest from a file, either in the binary format
+        (see :mod:`accesspredict.forestfile`), in which case the trees
+        are frozen and memory-mapped, or with pickle.
         """
         self.clear()
-        with open(fname, 'rb') as f:
-            new_trees = pickle.load(f)
-            for id, tree in list(new_trees.items()):
-                self.add_tree(id, tree)
+        if is_forest_file(fname):
+            new_trees = read_forest(fname)
+        else:
+            with open(fname, 'rb') as f:
+                new_trees = pickle.load(f)
+        for id, tree in list(new_trees.items()):
+            self.add_tree(id, tree)
 
-    def save(self, fname):
-        """
-        Saves the forest to a file (with pickle)
+    def save(self, fname, format='pickle', smoothing=None):
         """
-        with open(fname, 'wb') as f:
-            pickle.dump(self.trees, f)
+        Saves the forest to a file.
 
+        :param format: 'pickle', or 'binary' for the memory-mapped
+            format of :mod:`accesspredict.forestfile`. In this case
+            the trees are frozen first (see :meth:`PrefTree.freeze`).
+        :param smoothing: the smoothing strategy used to freeze
+            the trees in the binary format
+        """
+        if format == 'pickle':
+            with open(fname, 'wb') as f:
+                pickle.dump(self.trees, f)
+        elif format == 'binary':
+            trees = {}
+            for id, tree in list(self.trees.items()):
+                if not getattr(tree, 'read_only', False):
+                    tree = self._run_method('freeze', id, smoothing=smoothing)
+                trees[id] = tree
+            write_forest(trees, fname)
+        else:
+            raise ValueError('Unknown format %s.' % format)
@@ -0,0 +1,114 @@
+# -*- encoding: utf-8 -*-
+
+"""
+A memory-mapped binary format for URL forests.
+
+The file starts with a header:
+- the magic string `MAGIC`
+- the format version and the length of the table of contents,
+  as two little-endian 32-bit unsigned integers
+- the table of contents, in JSON, which gives for each tree the offset,
+  type code and length of each of its arrays (see
+  :attr:`FrozenPrefTree.array_types`) and of its token table
+  (see :class:`TokenTable`).
+
+The arrays follow, each aligned on 8 bytes, in the native byte order
+of the machine which wrote the file (recorded in the table of contents).
+The file is opened with `mmap`, so the trees are matched directly from the
+file: nothing is deserialized, and the pages are shared by all the
+processes which open the same file.
+"""
+
+import json
+import mmap
+import struct
+import sys
+
+from urltheory.frozentree import FrozenPrefTree
+from urltheory.frozentree import TokenTable
+
+MAGIC = b'CROAWLF\x00'
+VERSION = 1
+header_format = '<II'
+alignment = 8
+
+def is_forest_file(fname):
+    """
+    Checks whether a file is in the binary forest format.
+    """
+    with open(fname, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+def write_forest(trees, fname):
+    """
+    Writes frozen trees to a file.
+
+    :param trees: a dictionary from tree ids (strings) to
+        :class:`FrozenPrefTree`
+    :param fname: the name of the file to write
+    """
+    sections = []
+    toc = {'byteorder': sys.byteorder, 'trees': {}}
+    offset = 0
+    for id, tree in sorted(trees.items()):
+        if not isinstance(tree, FrozenPrefTree):
+            raise ValueError('The tree %s is not frozen.' % id)
+        table = tree.tokens
+        if not isinstance(table, TokenTable):
+            table = TokenTable.from_tokens(tree.tokens)
+        arrays = [(name, typecode, getattr(tree, name))
+                  for name, typecode in FrozenPrefTree.array_types]
+        arrays += [('token_offsets', 'Q', table.offsets),
+                   ('token_blob', 'B', table.blob)]
+
+        entry = {}
+        for name, typecode, values in arrays:
+            if values is None:
+                continue
+            data = bytes(values)
+            entry[name] = [offset, typecode, len(data)]
+            padding = -len(data) % alignment
+            sections.append(data + b'\x00'*padding)
+            offset += len(data) + padding
+        toc['trees'][id] = entry
+
+    toc = json.dumps(toc).encode('utf-8')
+    header = MAGIC + struct.pack(header_format, VERSION, len(toc)) + toc
+    header += b'\x00'*(-len(header) % alignment)
+    with open(fname, 'wb') as f:
+        f.write(header)
+        for data in sections:
+            f.write(data)
+
+def read_forest(fname):
+    """
+    Opens a file written by :func:`write_forest`.
+
+    :returns: a dictionary from tree ids to :class:`FrozenPrefTree`,
+        whose arrays are views of the memory-mapped file.
+    """
+    with open(fname, 'rb') as f:
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    header_size = len(MAGIC) + struct.calcsize(header_format)
+    if buf[:len(MAGIC)] != MAGIC:
+        raise ValueError('Not a forest file: %s' % fname)
+    version, toc_length = struct.unpack(header_format,
+                                        buf[len(MAGIC):header_size])
+    if version != VERSION:
+        raise ValueError('Unsupported forest file version: %d' % version)
+    toc = json.loads(buf[header_size:header_size+toc_length].decode('utf-8'))
+    if toc['byteorder'] != sys.byteorder:
+        raise ValueError('The forest file was written with another byte order.')
+
+    start = header_size + toc_length
+    start += -start % alignment
+    view = memoryview(buf)
+    trees = {}
+    for id, entry in toc['trees'].items():
+        arrays = {}
+        for name, (offset, typecode, length) in entry.items():
+            arrays[name] = view[start+offset:start+offset+length].cast(typecode)
+        table = TokenTable(arrays.pop('token_offsets'), arrays.pop('token_blob'))
+        trees[id] = FrozenPrefTree.from_arrays(arrays, table)
+    return trees
@@ -0,0 +1,82 @@
+# -*- encoding: utf-8 -*-
+
+from contextlib import contextmanager
+
+from gevent.lock import Semaphore
+
+class ReadWriteLock(object):
+    """
+    A greenlet-safe lock letting any number of readers
+    hold it at the same time, or a single writer.
+
+    Writers are not starved by a continuous flow of readers:
+    once a writer waits for the lock, new readers wait
+    until it has been released by the writer.
+
+    It can also be used as a simple lock: :meth:`acquire`
+    and :meth:`release` acquire it for writing.
+    """
+    def __init__(self):
+        self.readers = 0
+        self.writer = False
+        # protects the count of readers
+        self._mutex = Semaphore(1)
+        # held by the readers (as a group) or by the writer
+        self._resource = Semaphore(1)
+        # held by waiting writers, to stop new readers
+        self._turnstile = Semaphore(1)
+
+    def acquire_read(self):
+        self._turnstile.acquire()
+        self._turnstile.release()
+        with self._mutex:
+            self.readers += 1
+            if self.readers == 1:
+                self._resource.acquire()
+
+    def release_read(self):
+        with self._mutex:
+            if self.readers <= 0:
+                raise ValueError('The lock is not held for reading.')
+            self.readers -= 1
+            if self.readers == 0:
+                self._resource.release()
+
+    def acquire_write(self):
+        self._turnstile.acquire()
+        try:
+            self._resource.acquire()
+        finally:
+            self._turnstile.release()
+        self.writer = True
+
+    def release_write(self):
+        if not self.writer:
+            raise ValueError('The lock is not held for writing.')
+        self.writer = False
+        self._resource.release()
+
+    acquire = acquire_write
+    release = release_write
+
+    def locked(self):
+        """
+        Returns True when the lock is held by readers or by a writer.
+        """
+        return self.writer or self.readers > 0
+
+    @contextmanager
+    def read_locked(self):
+        self.acquire_read()
+        try:
+            yield self
+        finally:
+            self.release_read()
+
+    @contextmanager
+    def write_locked(self):
+        self.acquire_write()
+        try:
+            yield self
+        finally:
+            self.release_write()
@@ -0,0 +1,153 @@
+# -*- encoding: utf-8 -*-
+
+from contextlib import contextmanager
+import time
+
+import gevent
+from gevent.lock import Semaphore
+from requests.compat import urlparse
+
+class HostState(object):
+    """
+    The politeness state of a host: the slots left for
+    concurrent requests, the earliest time at which the
+    next request can be started, and the time at which
+    the last one was actually started.
+    """
+    def __init__(self, max_concurrency):
+        self.slots = Semaphore(max_concurrency)
+        self.next_start = 0.
+        self.last_start = 0.
+
+class HostScheduler(object):
+    """
+    Decides when the requests of a crawl can be sent, so that
+    many greenlets can crawl concurrently without hammering
+    the same host:
+
+    - at most `per_host` requests are sent concurrently to each host;
+    - two requests to the same host are started at least
+      `min_delay` seconds apart;
+    - at most `max_concurrency` requests are sent concurrently
+      overall.
+
+    Only the outermost request of a greenlet counts against the
+    concurrency limits: the requests sent while processing a response
+    (for instance when a predictor follows the links of a page) only
+    wait for the delays between requests. Otherwise, two greenlets
+    could wait forever for the host of each other.
+    """
+    # number of hosts above which the states of idle hosts are purged
+    max_idle_hosts = 10000
+
+    def __init__(self, max_concurrency=32, per_host=2, min_delay=1.,
+                 host_delays=None):
+        """
+        :param max_concurrency: the number of requests sent concurrently
+        :param per_host: the number of requests sent concurrently
+            to the same host
+        :param min_delay: the minimum delay (in seconds) between the
+            starts of two requests to the same host
+        :param host_delays: a dictionary mapping host names to
+            their own minimum delay
+        """
+        if max_concurrency < 1 or per_host < 1:
+            raise ValueError('The concurrency limits have to be positive.')
+        if min_delay < 0:
+            raise ValueError('The minimum delay has to be nonnegative.')
+        self.per_host = per_host
+        self.min_delay = min_delay
+        self.host_delays = host_delays or {}
+        self.slots = Semaphore(max_concurrency)
+        self.hosts = {}
+        # greenlet -> stack of the hosts it is sending requests to
+        self.held = {}
+
+    def _host_state(self, host):
+        state = self.hosts.get(host)
+        if state is None:
+            if len(self.hosts) >= self.max_idle_hosts:
+                self._purge()
+            state = HostState(self.per_host)
+            self.hosts[host] = state
+        return state
+
+    def _purge(self):
+        """
+        Forgets the hosts which are not being fetched from,
+        and whose delay has expired.
+        """
+        now = time.time()
+        for host, state in list(self.hosts.items()):
+            if state.slots.counter == self.per_host and state.next_start <= now:
+                del self.hosts[host]
+
+    def acquire(self, url):
+        """
+        Waits until a request to this URL can be sent.
+
+        :returns: the host of the URL, to be passed to :meth:`release`
+            once the response has been processed
+        """
+        host = urlparse(url).hostname or ''
+        current = gevent.getcurrent()
+        stack = self.held.get(current)
+        nested = stack is not None
+        state = self._host_state(host)
+        if not nested:
+            state.slots.acquire()
+        try:
+            # reserve the next start time for this host
+            now = time.time()
+            start = max(now, state.next_start)
+            delay = self.host_delays.get(host, self.min_delay)
+            state.next_start = start + delay
+            if start > now:
+                gevent.sleep(start - now)
+            if not nested:
+                self.slots.acquire()
+                try:
+                    # the previous request may have been held back
+                    # by the global limit after its reservation
+                    wait = state.last_start + delay - time.time()
+                    if wait > 0:
+                        gevent.sleep(wait)
+                except BaseException:
+                    self.slots.release()
+                    raise
+            state.last_start = time.time()
+        except BaseException:
+            # the greenlet has been killed while waiting
+            if not nested:
+                state.slots.release()
+            raise
+        if nested:
+            stack.append(host)
+        else:
+            self.held[current] = [host]
+        return host
+
+    def release(self, host):
+        """
+        Releases the slots acquired by :meth:`acquire` for this host.
+        """
+        current = gevent.getcurrent()
+        stack = self.held.get(current)
+        if not stack or stack[-1] != host:
+            raise ValueError('No slot is held for host %s.' % host)
+        stack.pop()
+        if not stack:
+            del self.held[current]
+            self.slots.release()
+            self.hosts[host].slots.release()
+
+    @contextmanager
+    def slot(self, url):
+        """
+        Holds a slot to send a request to this URL.
+        """
+        host = self.acquire(url)
+        try:
+            yield host
+        finally:
+            self.release(host)
@@ -0,0 +1,104 @@
+# -*- encoding: utf-8 -*-
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.compat import urlparse
+
+class PoolCountingAdapter(HTTPAdapter):
+    """
+    An HTTP adapter reporting, for each request, whether it reused
+    a connection kept alive in its pools (a hit) or had to open
+    a new one (a miss).
+    """
+    def __init__(self, on_connection, *args, **kwargs):
+        """
+        :param on_connection: called with True for a hit,
+            False for a miss
+        """
+        self.on_connection = on_connection
+        super(PoolCountingAdapter, self).__init__(*args, **kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super(PoolCountingAdapter, self).init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            scheme: self._counting_pool_class(pool_class)
+            for scheme, pool_class in self.poolmanager.pool_classes_by_scheme.items()}
+
+    def _counting_pool_class(self, pool_class):
+        on_connection = self.on_connection
+        class CountingConnectionPool(pool_class):
+            def _get_conn(self, timeout=None):
+                conn = pool_class._get_conn(self, timeout)
+                # new connections, and dropped ones which are reopened,
+                # are not connected yet
+                on_connection(conn.sock is not None)
+                return conn
+        return CountingConnectionPool
+
+class PooledSession(requests.Session):
+    """
+    A requests session keeping the connections to the hosts it
+    fetches from alive between requests, so that fetching many
+    pages from the same repository does not open a new connection
+    (and do a new TLS handshake) for each of them.
+
+    The number of requests reusing a connection (hits) and
+    opening a new one (misses) are counted, and reported
+    to the crawling statistics if provided (as `http:pool_hit`
+    and `http:pool_miss`). Requests going through a proxy are
+    not counted.
+    """
+    def __init__(self, pool_connections=64, pool_maxsize=4,
+                 host_pool_sizes=None, stats=None):
+        """
+        :param pool_connections: the number of hosts for which
+            connections are kept alive
+        :param pool_maxsize: the number of connections kept alive
+            for each host
+        :param host_pool_sizes: a dictionary mapping host names
+            to the number of connections kept alive for them,
+            overriding `pool_maxsize`
+        :param stats: the :class:`CrawlingStatistics` to report to
+        """
+        super(PooledSession, self).__init__()
+        self.hits = 0
+        self.misses = 0
+        self.stats = stats
+        if stats is not None:
+            stats.add_key('http:pool_hit')
+            stats.add_key('http:pool_miss')
+
+        adapter = PoolCountingAdapter(self._record,
+                    pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+        self.mount('http://', adapter)
+        self.mount('https://', adapter)
+        # mounting these by prefix would miss the urls with a port
+        # or without a path: they are looked up by host name instead
+        self.host_adapters = {}
+        for host, maxsize in (host_pool_sizes or {}).items():
+            self.host_adapters[host.lower()] = PoolCountingAdapter(self._record,
+                        pool_connections=1, pool_maxsize=maxsize)
+
+    def get_adapter(self, url):
+        """
+        Returns the adapter of the host of the url if its number
+        of connections was configured, whatever its port and path.
+        """
+        parsed = urlparse(url)
+        adapter = self.host_adapters.get(parsed.hostname)
+        if adapter is not None and parsed.scheme.lower() in ['http', 'https']:
+            return adapter
+        return super(PooledSession, self).get_adapter(url)
+
+    def close(self):
+        super(PooledSession, self).close()
+        for adapter in self.host_adapters.values():
+            adapter.close()
+
+    def _record(self, hit):
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+        if self.stats is not None:
+            self.stats.increment('http:pool_hit' if hit else 'http:pool_miss')
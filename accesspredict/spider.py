@@ -1,11 +1,15 @@
 # -*- encoding: utf-8 -*-
 
+import gevent
+from gevent.event import AsyncResult
 from .forest import URLForest
 from urltheory.utils import proba_confidence
 from urltheory import tokenizer
+from urltheory.tokenizer import normalize_url
 import requests
 from requests.models import REDIRECT_STATI
 from accesspredict.utils import normalize_outgoing_url
+from accesspredict.session import PooledSession
 from accesspredict.statistics import CrawlingStatistics
 
 crawler_user_agent = 'http://dissem.in/'
@@ -14,12 +18,31 @@ class Spider(object):
     """
     Holds an URL forest and a set of associated predictors.
     """
-    def __init__(self, forest=None, dataset=None, stats=None):
+    def __init__(self, forest=None, dataset=None, stats=None, stop_early=False,
+                 session=None, scheduler=None):
+        """
+        :param stop_early: when looking up URLs in the trees, decide
+            with the first confident prefix of the URL, rather than
+            with the deepest one (see :meth:`PrefTree.match_confident`)
+        :param session: the :class:`PooledSession` used to fetch URLs
+            (by default, one with the default pool sizes is created)
+        :param scheduler: the :class:`HostScheduler` deciding when
+            URLs can be fetched, if any (without one, URLs are fetched
+            right away, so the spider should not be used concurrently)
+        """
+        self.stop_early = stop_early
         self.forest = forest or URLForest()
         self.dataset = dataset # We don't necessarily need a dataset
         self.predictors = {}
         self.stats = stats or CrawlingStatistics()
         self.smoothing = {}
+        self.session = session or PooledSession(stats=self.stats)
+        self.scheduler = scheduler
+        # predictions in progress: (class_id, normalized url) ->
+        # (greenlet, min_confidence, AsyncResult)
+        self.in_flight = {}
+        # greenlet -> the key of the prediction it waits for
+        self.waiting = {}
 
     def __contains__(self, key):
         return key in self.predictors
@@ -53,7 +76,7 @@ class Spider(object):
         # init the stats for this class
         if self.stats:
             for key in ['incoming','cached','pre_filter','post_filter','filtered',
-                        'requested','redirected','learned']:
+                        'requested','redirected','learned','coalesced']:
                 self.stats.add_key('%s:%s' % (class_id,key))
 
     def predict(self, class_id, url, history=[], referer=None, min_confidence=0.8):
@@ -92,6 +115,97 @@ class Spider(object):
                     self.incr(class_id+':cached')
                     return previous_result
 
+        # If the same URL is being classified by another greenlet,
+        # wait for its answer rather than fetching it again
+        key = (class_id, normalize_url(url))
+        entry = self.in_flight.get(key)
+        if entry is not None and self._can_wait_for(entry, min_confidence):
+            self.incr(class_id+':coalesced')
+            self.waiting[gevent.getcurrent()] = key
+            try:
+                answer = entry[2].get()
+            finally:
+                del self.waiting[gevent.getcurrent()]
+            # the URLs which redirected to this one are ours to learn
+            if history:
+                self._update_history_classification(class_id, history, answer)
+            return answer
+        elif entry is not None:
+            return self._predict(class_id, predictor, url, history,
+                                 referer, min_confidence)
+
+        result = AsyncResult()
+        self.in_flight[key] = (gevent.getcurrent(), min_confidence, result)
+        try:
+            answer = self._predict(class_id, predictor, url, history,
+                                   referer, min_confidence)
+        except BaseException as e:
+            result.set_exception(e)
+            raise
+        finally:
+            del self.in_flight[key]
+        result.set(answer)
+        return answer
+
+    def precheck(self, class_id, urls, min_confidence=0.8):
+        """
+        Looks up a batch of URLs in the dataset in a single round
+        trip, keeping the results in its cache so that predicting
+        them afterwards does not query redis again (including
+        for the URLs which are not in the dataset). These lookups
+        are not counted in the cache statistics: predicting the
+        URLs counts them.
+
+        :param class_id: the class membership to test for
+        :param urls: the list of URLs about to be predicted
+        :param min_confidence: the confidence required for
+                cached results (as in :meth:`predict`)
+        :returns: the list of the cached probabilities of the URLs,
+                None for those which have to be predicted
+        """
+        if class_id not in self:
+            raise ValueError('No predictor for class "%s".' % class_id)
+        if self.dataset is None:
+            return [None]*len(urls)
+        urls = [url if type(url) == str else url.decode('utf-8') for url in urls]
+        return [proba if proba is not None and
+                    proba_confidence(proba) > min_confidence else None
+                for proba in self.dataset.get_many_if_recent(urls, class_id,
+                                                             record=False)]
+
+    def _can_wait_for(self, entry, min_confidence):
+        """
+        Can the current greenlet wait for the answer of a prediction
+        in progress? Its answer has to be confident enough, and
+        waiting must not lead to a cycle of greenlets waiting for
+        each other (for instance with a redirect loop).
+
+        A greenlet holding a slot of the scheduler (while processing
+        a response) never waits: the other greenlet could be waiting
+        for that slot, or need it again to follow a redirect.
+        """
+        owner, owner_confidence, result = entry
+        if owner_confidence < min_confidence:
+            return False
+        current = gevent.getcurrent()
+        if self.scheduler is not None and current in self.scheduler.held:
+            return False
+        seen = set()
+        while owner not in seen:
+            if owner is current:
+                return False
+            seen.add(owner)
+            key = self.waiting.get(owner)
+            if key is None or key not in self.in_flight:
+                return True
+            owner = self.in_flight[key][0]
+        return True
+
+    def _predict(self, class_id, predictor, url, history, referer, min_confidence):
+        """
+        Predicts the membership of an URL to a class, from the
+        prefix trees or by fetching it: see :meth:`predict`.
+        """
         tokenized = tokenizer.prepare_url(url)
 
         # first check if it's obvious from the URL
@@ -140,34 +254,55 @@ class Spider(object):
             }
             if referer:
                 headers['Referer'] = referer
+            kwargs['headers'] = headers
 
             self.incr(class_id+':requested')
 
-            print("## fetching %s" % url)
-            if predictor.head_mode:
-                r = requests.head(url, **kwargs)
-            else:
-                r = requests.get(url, **kwargs)
-
-            r.raise_for_status()
-
-            # detect redirects
-            next_url = r.headers.get('location')
-            if r.status_code in REDIRECT_STATI and next_url:
-                # detect cyclic redirects
-                if (next_url in [url for url, t in history] or
-                    len(history) > 15):
-                    raise requests.exceptions.TooManyRedirects()
-
-                next_url = normalize_outgoing_url(r.url, next_url)
-                self.incr(class_id+':redirected')
-                return self.predict(class_id, next_url, new_history,
-                            min_confidence=min_confidence, referer=referer)
-
-            # classify manually
-            answer = predictor.predict_after_fetch(r, url, tokenized, min_confidence)
-            if type(answer) != float:
-                raise ValueError('Predictor {} did not return a float for url {}'.format(class_id, url))
+            host = self.scheduler.acquire(url) if self.scheduler else None
+            try:
+                print("## fetching %s" % url)
+                if predictor.head_mode:
+                    r = self.session.head(url, **kwargs)
+                else:
+                    r = self.session.get(url, **kwargs)
+            except BaseException:
+                if host is not None:
+                    self.scheduler.release(host)
+                raise
+
+            try:
+                r.raise_for_status()
+
+                # detect redirects
+                next_url = r.headers.get('location')
+                if r.status_code in REDIRECT_STATI and next_url:
+                    # detect cyclic redirects
+                    if (next_url in [url for url, t in history] or
+                        len(history) > 15):
+                        raise requests.exceptions.TooManyRedirects()
+
+                    next_url = normalize_outgoing_url(r.url, next_url)
+                    self.incr(class_id+':redirected')
+                    # give the connection back to the pool before
+                    # following the redirect, which is likely to use it
+                    # (requests has already read the body of the redirect)
+                    r.close()
+                    if host is not None:
+                        self.scheduler.release(host)
+                        host = None
+                    return self.predict(class_id, next_url, new_history,
+                                min_confidence=min_confidence, referer=referer)
+
+                # classify manually
+                answer = predictor.predict_after_fetch(r, url, tokenized, min_confidence)
+                if type(answer) != float:
+                    raise ValueError('Predictor {} did not return a float for url {}'.format(class_id, url))
+            finally:
+                # releases the connection to the pool (it is closed
+                # if the predictor has not read the whole body)
+                r.close()
+                if host is not None:
+                    self.scheduler.release(host)
         except requests.exceptions.RequestException as e:
             print(e)
             answer = 0.
@@ -188,12 +323,9 @@ class Spider(object):
             raise ValueError('The proba has to be a float, got "{}" instead'.format(proba))
         for url, tokenized in history:
             self.incr(class_id+':learned')
-            if self.dataset is not None:
-                self.dataset.set(url, class_id, proba)
-            # TODO: this involves acquiring and releasing many times
-            # the same lock. Add a method in URLForest to add many URLs
-            # that acquires the lock only once.
-            self.forest.add_url(class_id, tokenized, proba)
+        if self.dataset is not None:
+            self.dataset.set_many(class_id, [(url, proba) for url, tokenized in history])
+        self.forest.add_urls(class_id, [(tokenized, proba) for url, tokenized in history])
 
     def _get_preftree_answer(self, class_id, tokenized, min_confidence):
         """
@@ -202,17 +334,10 @@ class Spider(object):
         a class, or None if a manual classification is
         needed
         """
-        url_count, success_count, length = self.forest.match_length(class_id, tokenized)
-
-        if not url_count:
-            return None
-
-        smoothed = self.smoothing[class_id].evaluate(url_count, success_count, length)
-        obtained_confidence = proba_confidence(smoothed)
-        print("threshold: %f" % min_confidence)
-        print("count: %d/%d" % (success_count, url_count))
-        print("confidence: %f" % obtained_confidence)
-        if obtained_confidence > min_confidence:
+        url_count, success_count, length, confident = self.forest.match_confident(
+                class_id, tokenized, self.smoothing[class_id], min_confidence,
+                stop_early=self.stop_early, strict=True)
+        if confident:
             return 2*success_count >= url_count
 
 
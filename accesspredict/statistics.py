@@ -20,6 +20,7 @@ class CrawlingStatistics(object):
         self.keys = []
         self.lines = defaultdict(list)
         self.accu = defaultdict(int)
+        self.ratios = {}
         self.start = datetime.utcnow()
 
     def add_key(self, key):
@@ -28,6 +29,15 @@ class CrawlingStatistics(object):
         if not key in self.keys:
             self.keys.append(key)
 
+    def add_ratio(self, key, numerator, other):
+        """
+        Adds a statistic computed from two counters, as the ratio
+        numerator / (numerator + other) over each logging period
+        (for instance a cache hit ratio from the hits and misses).
+        """
+        self.add_key(key)
+        self.ratios[key] = (numerator, other)
+
     def increment(self, name, nb=1):
         if name not in self.keys:
             raise ValueError('unknown name')
@@ -36,6 +46,9 @@ class CrawlingStatistics(object):
     def log_all(self):
         elapsed = datetime.utcnow() - self.start
         print("////////// logging ")
+        for key, (numerator, other) in self.ratios.items():
+            total = self.accu[numerator] + self.accu[other]
+            self.accu[key] = float(self.accu[numerator]) / total if total else 0.
         for key in self.keys:
             val = self.accu[key]
             self.lines[key].append([elapsed.seconds/60.0, val])
@@ -1 +1,608 @@
+# -*- encoding: utf-8 -*-
 
+from datetime import date
+from datetime import timedelta
+from multiprocessing import Process
+from multiprocessing import Queue
+import os
+from queue import Empty
+import tempfile
+import time
+import unittest
+
+import gevent
+from gevent.pywsgi import WSGIServer
+
+from urltheory.jointtree import JointPrefTree
+from urltheory.preftree import PrefTree
+from urltheory.smoothing import ConstantDirichlet
+from urltheory.tokenizer import prepare_url
+from urltheory.utils import get_from_workers
+from .cache import LRUCache
+from .forest import URLForest
+from .predictor import URLCategoryPredictor
+from .rwlock import ReadWriteLock
+from .scheduler import HostScheduler
+from .session import PooledSession
+from .spider import Spider
+from .statistics import CrawlingStatistics
+from .urldataset import URLDataset
+from .training import domain_shard
+from .training import train_forest
+
+dataset = [
+    ('2017-01-12', 'pdf', 1., '//arxiv.org/pdf/1410.1454v2'),
+    ('2017-01-12', 'pdf', 0., '//arxiv.org/abs/1410.1454'),
+    ('2017-01-12', 'pdf', 1., '//hal.archives-ouvertes.fr/hal-01164591/document'),
+    ('2017-01-12', 'pdf', 0., '//hal.archives-ouvertes.fr/hal-01164591'),
+    ('2017-01-12', 'custom', 1., '//hal.archives-ouvertes.fr/hal-01164591'),
+    ('2017-01-13', 'pdf', 1., '//eprint.iacr.org/2016/093.pdf'),
+]
+
+class URLForestTest(unittest.TestCase):
+    def test_merge(self):
+        f1 = URLForest()
+        f1.add_tree('pdf')
+        f2 = URLForest()
+        f2.add_tree('pdf')
+        f2.add_tree('custom')
+        for idx, (day, class_id, value, url) in enumerate(dataset):
+            forest = f1 if idx % 2 else f2
+            forest.add_url(class_id, prepare_url(url), value)
+        f1.merge(f2)
+        self.assertTrue('custom' in f1)
+        self.assertTrue(f1.trees['pdf'].check_sanity())
+        self.assertEqual(f1.trees['pdf'].url_count, 5)
+        self.assertEqual(f1.match('pdf', prepare_url('//arxiv.org/pdf/1410.1454v2')),
+                         (1, 1))
+
+    def test_freeze(self):
+        forest = URLForest()
+        forest.add_tree('pdf')
+        forest.add_tree('custom')
+        for day, class_id, value, url in dataset:
+            forest.add_url(class_id, prepare_url(url), value)
+        url = prepare_url('//arxiv.org/pdf/1410.1454v2')
+        expected = forest.match_length('pdf', url)
+        forest.freeze('pdf')
+        forest.locks['pdf'].acquire()
+        self.assertEqual(forest.match_length('pdf', url), expected)
+        forest.locks['pdf'].release()
+        with self.assertRaises(ValueError):
+            forest.add_url('pdf', url, True)
+
+    def test_match_many(self):
+        forest = URLForest()
+        forest.add_tree('pdf')
+        forest.add_tree('custom')
+        for day, class_id, value, url in dataset:
+            forest.add_url(class_id, prepare_url(url), value)
+        urls = [prepare_url(url) for day, class_id, value, url in dataset]
+        counts, successes, lengths = forest.match_many('pdf', urls)
+        self.assertEqual(list(zip(counts, successes, lengths)),
+                         [forest.match_length('pdf', url) for url in urls])
+
+    def test_match_confident(self):
+        forest = URLForest()
+        forest.add_tree('pdf')
+        for day, class_id, value, url in dataset:
+            if class_id == 'pdf':
+                forest.add_url(class_id, prepare_url(url), value)
+        url = prepare_url('//arxiv.org/pdf/1410.1454v2')
+        self.assertEqual(forest.match_confident('pdf', url, ConstantDirichlet(), 1.5),
+                         forest.match_length('pdf', url) + (False,))
+
+    def test_joint_tree(self):
+        forest = URLForest()
+        forest.add_joint_tree(JointPrefTree(['pdf', 'custom']))
+        forest.add_tree('robots')
+        ref = URLForest()
+        for id in ['pdf', 'custom', 'robots']:
+            ref.add_tree(id)
+        for day, class_id, value, url in dataset:
+            forest.add_url(class_id, prepare_url(url), value)
+            ref.add_url(class_id, prepare_url(url), value)
+        self.assertIs(forest.locks['pdf'], forest.locks['custom'])
+        for day, class_id, value, url in dataset:
+            results = forest.match_all(prepare_url(url))
+            self.assertEqual(sorted(results), ['custom', 'pdf', 'robots'])
+            for id, (count, success, length) in results.items():
+                self.assertEqual((count, success), ref.match(id, prepare_url(url)))
+        with self.assertRaises(ValueError):
+            forest.add_joint_tree(JointPrefTree(['pdf']))
+
+    def test_add_urls(self):
+        forest = URLForest()
+        forest.add_tree('pdf')
+        ref = URLForest()
+        ref.add_tree('pdf')
+        history = [(prepare_url(url), value) for day, class_id, value, url in dataset
+                   if class_id == 'pdf']
+        forest.add_urls('pdf', history)
+        for url, value in history:
+            ref.add_url('pdf', url, value)
+        self.assertEqual(sorted(forest.trees['pdf'].urls()), sorted(ref.trees['pdf'].urls()))
+        self.assertFalse(forest.locks['pdf'].locked())
+        with self.assertRaises(ValueError):
+            forest.add_urls('custom', history)
+
+    def test_unlock_on_error(self):
+        forest = URLForest()
+        forest.add_tree('pdf')
+        with self.assertRaises(ValueError):
+            forest.add_url('pdf', prepare_url('//arxiv.org/pdf/1410.1454v2'), 2., 1.)
+        self.assertFalse(forest.locks['pdf'].locked())
+        forest.clear()
+
+    def test_save_binary(self):
+        forest = URLForest()
+        forest.add_tree('pdf')
+        forest.add_tree('custom')
+        for day, class_id, value, url in dataset:
+            forest.add_url(class_id, prepare_url(url), value)
+        urls = [prepare_url(url) for day, class_id, value, url in dataset]
+        urls.append(prepare_url('//arxiv.org/pdf/1410.1454v3'))
+        expected = [forest.match_length('pdf', url) for url in urls]
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            fname = os.path.join(tmpdir, 'forest.bin')
+            forest.save(fname, format='binary')
+            loaded = URLForest()
+            loaded.load(fname)
+            self.assertTrue('custom' in loaded)
+            self.assertEqual([loaded.match_length('pdf', url) for url in urls],
+                             expected)
+            # memory-mapped trees can be saved again in both formats
+            loaded.save(fname+'.pkl')
+            loaded.save(fname+'.2', format='binary')
+            for other_fname in [fname+'.pkl', fname+'.2']:
+                other = URLForest()
+                other.load(other_fname)
+                self.assertEqual([other.match_length('pdf', url) for url in urls],
+                                 expected)
+                other.clear()
+            loaded.clear()
+
+        with self.assertRaises(ValueError):
+            forest.save('forest.bin', format='json')
+
+class ReadWriteLockTest(unittest.TestCase):
+    def test_readers(self):
+        lock = ReadWriteLock()
+        events = []
+        def read(name):
+            with lock.read_locked():
+                events.append(('start', name))
+                gevent.sleep(0.01)
+                events.append(('end', name))
+        def write(name):
+            with lock.write_locked():
+                events.append(('start', name))
+                gevent.sleep(0.01)
+                events.append(('end', name))
+        greenlets = [gevent.spawn(read, 'r1'), gevent.spawn(read, 'r2'),
+                     gevent.spawn(write, 'w'), gevent.spawn(read, 'r3')]
+        gevent.joinall(greenlets)
+        # readers run concurrently, the writer alone, and the
+        # reader arriving after the writer waits for it
+        self.assertEqual(events, [('start', 'r1'), ('start', 'r2'),
+                                  ('end', 'r1'), ('end', 'r2'),
+                                  ('start', 'w'), ('end', 'w'),
+                                  ('start', 'r3'), ('end', 'r3')])
+        self.assertFalse(lock.locked())
+
+    def test_release_errors(self):
+        lock = ReadWriteLock()
+        with self.assertRaises(ValueError):
+            lock.release_read()
+        with self.assertRaises(ValueError):
+            lock.release()
+        lock.acquire()
+        self.assertTrue(lock.locked())
+        lock.release()
+        self.assertFalse(lock.locked())
+
+# number of requests served for each path
+served = {}
+
+def serve_test_pages(environ, start_response):
+    """
+    A tiny web site: /redirect redirects to /page,
+    and /slow takes some time to be served.
+    """
+    path = environ['PATH_INFO']
+    served[path] = served.get(path, 0) + 1
+    if path == '/slow':
+        gevent.sleep(0.05)
+    if path == '/redirect':
+        body = b'moved'
+        start_response('302 Found', [('Location', '/page'),
+                                     ('Content-Length', str(len(body)))])
+    else:
+        body = b'<html>page</html>'
+        start_response('200 OK', [('Content-Type', 'text/html'),
+                                  ('Content-Length', str(len(body)))])
+    return [body]
+
+class ConstantPredictor(URLCategoryPredictor):
+    def predict_after_fetch(self, request, url, tokenized, min_confidence=0.8):
+        request.content
+        return 1.
+
+class LandingPagePredictor(ConstantPredictor):
+    """
+    Predicts /slow from the page it links to.
+    """
+    def predict_after_fetch(self, request, url, tokenized, min_confidence=0.8):
+        request.content
+        if url.endswith('/slow'):
+            return self.spider.predict('custom', url[:-len('/slow')]+'/page')
+        return 1.
+
+class LocalServerMixin(object):
+    """
+    Serves the test pages while the tests run.
+    """
+    def setUp(self):
+        self.server = WSGIServer(('127.0.0.1', 0), serve_test_pages, log=None)
+        self.server.start()
+        self.url = 'http://127.0.0.1:%d' % self.server.server_port
+
+    def tearDown(self):
+        self.server.stop()
+
+class PooledSessionTest(LocalServerMixin, unittest.TestCase):
+    def test_keep_alive(self):
+        stats = CrawlingStatistics()
+        session = PooledSession(stats=stats, host_pool_sizes={'127.0.0.1': 2})
+        for i in range(3):
+            self.assertEqual(session.get(self.url+'/page').status_code, 200)
+        self.assertEqual((session.hits, session.misses), (2, 1))
+        self.assertEqual(stats.accu['http:pool_hit'], 2)
+        self.assertEqual(stats.accu['http:pool_miss'], 1)
+        # the requests went through the adapter of the host,
+        # although the url has a port
+        adapter = session.host_adapters['127.0.0.1']
+        self.assertEqual(adapter._pool_maxsize, 2)
+        self.assertEqual(len(adapter.poolmanager.pools), 1)
+        self.assertEqual(len(session.get_adapter('http://arxiv.org/').poolmanager.pools), 0)
+        self.assertIs(session.get_adapter(self.url), adapter)
+        self.assertIs(session.get_adapter('https://127.0.0.1'), adapter)
+
+    def test_spider_redirect(self):
+        # the redirect is followed once the slot of the host is released
+        spider = Spider(scheduler=HostScheduler(per_host=1, min_delay=0.))
+        spider.add_predictor('custom', ConstantPredictor(), ConstantDirichlet())
+        self.assertEqual(spider.predict('custom', self.url+'/redirect'), 1.)
+        # the redirect is followed with the same connection
+        self.assertEqual((spider.session.hits, spider.session.misses), (1, 1))
+        self.assertEqual(spider.scheduler.held, {})
+        self.assertEqual(spider.forest.match('custom', prepare_url(self.url+'/redirect')),
+                         (1., 1.))
+
+class HostSchedulerTest(unittest.TestCase):
+    def crawl(self, scheduler, urls, duration=0.01):
+        """
+        Fetches the urls concurrently, returning the start times and
+        the maximum number of concurrent requests for each host
+        (None for all hosts).
+        """
+        starts = []
+        active = {}
+        max_active = {}
+        def fetch(url):
+            with scheduler.slot(url) as host:
+                starts.append((host, time.time()))
+                for key in [host, None]:
+                    active[key] = active.get(key, 0) + 1
+                    max_active[key] = max(max_active.get(key, 0), active[key])
+                gevent.sleep(duration)
+                for key in [host, None]:
+                    active[key] -= 1
+        gevent.joinall([gevent.spawn(fetch, url) for url in urls])
+        self.assertEqual(scheduler.held, {})
+        return starts, max_active
+
+    def test_per_host(self):
+        scheduler = HostScheduler(per_host=1, min_delay=0.02)
+        urls = ['http://arxiv.org/abs/%d' % i for i in range(3)] + ['https://hal.science/']
+        starts, max_active = self.crawl(scheduler, urls)
+        self.assertEqual(max_active['arxiv.org'], 1)
+        self.assertEqual(max_active[None], 2)
+        arxiv = [t for host, t in starts if host == 'arxiv.org']
+        self.assertTrue(all(b - a >= 0.019 for a, b in zip(arxiv, arxiv[1:])))
+
+    def test_global(self):
+        scheduler = HostScheduler(max_concurrency=2, per_host=4, min_delay=0.)
+        urls = ['http://host%d.org/' % (i % 3) for i in range(6)]
+        starts, max_active = self.crawl(scheduler, urls)
+        self.assertEqual(max_active[None], 2)
+
+    def test_nested(self):
+        scheduler = HostScheduler(max_concurrency=1, per_host=1, min_delay=0.)
+        with scheduler.slot('http://arxiv.org/abs/1'):
+            with scheduler.slot('http://arxiv.org/pdf/1'):
+                pass
+            with self.assertRaises(ValueError):
+                scheduler.release('hal.science')
+        self.assertEqual(scheduler.held, {})
+        with self.assertRaises(ValueError):
+            HostScheduler(per_host=0)
+
+class CoalescingTest(LocalServerMixin, unittest.TestCase):
+    def test_coalesce(self):
+        served.clear()
+        spider = Spider()
+        spider.add_predictor('custom', ConstantPredictor(), ConstantDirichlet())
+        greenlets = [gevent.spawn(spider.predict, 'custom', self.url+'/slow'),
+                     gevent.spawn(spider.predict, 'custom', self.url+'/slow#top'),
+                     gevent.spawn(spider.predict, 'custom', self.url+'/slow',
+                                  min_confidence=0.9)]
+        gevent.joinall(greenlets)
+        self.assertEqual([g.value for g in greenlets], [1., 1., 1.])
+        # the last prediction requires a higher confidence
+        self.assertEqual(served['/slow'], 2)
+        self.assertEqual(spider.stats.accu['custom:coalesced'], 1)
+        self.assertEqual(spider.in_flight, {})
+        self.assertEqual(spider.waiting, {})
+
+    def test_slot_held(self):
+        # the landing page links to a page which another greenlet is
+        # waiting to fetch: waiting for it while holding the slot of
+        # the host would block both greenlets
+        served.clear()
+        spider = Spider(scheduler=HostScheduler(per_host=1, min_delay=0.))
+        spider.add_predictor('custom', LandingPagePredictor(), ConstantDirichlet())
+        greenlets = [gevent.spawn(spider.predict, 'custom', self.url+'/slow'),
+                     gevent.spawn(spider.predict, 'custom', self.url+'/page')]
+        gevent.joinall(greenlets, timeout=5)
+        self.assertEqual([g.value for g in greenlets], [1., 1.])
+        self.assertEqual(served['/page'], 2)
+        self.assertEqual(spider.stats.accu['custom:coalesced'], 0)
+        self.assertEqual(spider.scheduler.held, {})
+
+class DictRedis(object):
+    """
+    Stores hashes in memory, counting the round trips.
+    """
+    def __init__(self):
+        self.hashes = {}
+        self.round_trips = 0
+
+    def hget(self, name, key):
+        self.round_trips += 1
+        val = self.hashes.get(name, {}).get(key)
+        return val.encode('utf-8') if val is not None else None
+
+    def hset(self, name, key=None, value=None, mapping=None):
+        self.round_trips += 1
+        values = self.hashes.setdefault(name, {})
+        if key is not None:
+            values[key] = value
+        values.update(mapping or {})
+
+    def hmget(self, name, keys):
+        self.round_trips += 1
+        values = self.hashes.get(name, {})
+        return [values[key].encode('utf-8') if key in values else None
+                for key in keys]
+
+    def hscan_iter(self, name, count=None):
+        items = sorted(self.hashes.get(name, {}).items())
+        count = count or 10
+        for start in range(0, len(items), count):
+            self.round_trips += 1
+            for key, val in items[start:start+count]:
+                yield key.encode('utf-8'), val.encode('utf-8')
+
+    def scan_iter(self):
+        self.round_trips += 1
+        return [name.encode('utf-8') for name in sorted(self.hashes)]
+
+    def pipeline(self, transaction=True):
+        return DictRedisPipeline(self)
+
+class DictRedisPipeline(object):
+    """
+    Queues the writes to a :class:`DictRedis`,
+    sending them in a single round trip.
+    """
+    def __init__(self, client):
+        self.client = client
+        self.commands = []
+
+    def hset(self, *args, **kwargs):
+        self.commands.append((args, kwargs))
+
+    def execute(self):
+        for args, kwargs in self.commands:
+            self.client.hset(*args, **kwargs)
+        self.client.round_trips -= max(0, len(self.commands) - 1)
+        self.commands = []
+
+class CacheTest(unittest.TestCase):
+    def test_lru(self):
+        cache = LRUCache(max_size=2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.put('c', 3)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        self.assertEqual(cache.hit_ratio(), 0.5)
+
+    def test_ttl(self):
+        cache = LRUCache(ttl=0.01)
+        cache.put('a', 1)
+        self.assertEqual(cache.get('a'), 1)
+        time.sleep(0.02)
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(len(cache), 0)
+
+    def test_dataset(self):
+        stats = CrawlingStatistics()
+        client = DictRedis()
+        url = 'http://arxiv.org/pdf/1410.1454v2'
+        URLDataset(client).set(url, 'pdf', 1., '2017-01-12')
+        ds = URLDataset(client, stats=stats)
+        for i in range(3):
+            self.assertEqual(ds.get(url, 'pdf'), (1., '2017-01-12'))
+        self.assertEqual(client.round_trips, 2)
+        # writes go through the cache
+        ds.set(url, 'pdf', 0.25, '2017-02-01')
+        ds.set_many('custom', [(url, 1.)], '2017-02-01')
+        self.assertEqual(ds.get(url, 'pdf'), (0.25, '2017-02-01'))
+        self.assertEqual(ds.get(url, 'custom'), (1., '2017-02-01'))
+        self.assertEqual(client.round_trips, 4)
+        self.assertEqual(URLDataset(client).get(url, 'pdf'), (0.25, '2017-02-01'))
+        stats.log_all()
+        self.assertEqual(stats.lines['cache:hit_ratio'][-1][1], 0.8)
+
+class URLDatasetTest(unittest.TestCase):
+    def test_get_many(self):
+        client = DictRedis()
+        ds = URLDataset(client)
+        ds.set_many('pdf', [(url, value) for day, class_id, value, url in dataset
+                            if class_id == 'pdf'], '2017-01-12')
+        urls = ['http://arxiv.org/pdf/1410.1454v2', 'http://arxiv.org/abs/1410.1454',
+                'http://example.com/']
+        ds = URLDataset(client)
+        client.round_trips = 0
+        self.assertEqual(ds.get_many(urls, 'pdf'),
+                         [(1., '2017-01-12'), (0., '2017-01-12'), None])
+        self.assertEqual(client.round_trips, 1)
+        # the unknown URL is cached too
+        self.assertEqual(ds.get(urls[0], 'pdf'), (1., '2017-01-12'))
+        self.assertEqual(ds.get_many(urls, 'pdf')[2], None)
+        self.assertEqual(ds.get(urls[2], 'pdf'), None)
+        self.assertEqual(client.round_trips, 1)
+        self.assertEqual(ds.get_many_if_recent(urls[:1], 'pdf', timedelta(days=1)), [None])
+        ds.set(urls[2], 'pdf', 1., '2017-01-12')
+        self.assertEqual(ds.get(urls[2], 'pdf'), (1., '2017-01-12'))
+        # unless it has expired
+        ds = URLDataset(client, cache_ttl=0.)
+        client.round_trips = 0
+        self.assertEqual(ds.get('http://example.com/other', 'pdf'), None)
+        self.assertEqual(ds.get('http://example.com/other', 'pdf'), None)
+        self.assertEqual(client.round_trips, 2)
+
+    def test_load_save(self):
+        fd, fname = tempfile.mkstemp()
+        try:
+            with os.fdopen(fd, 'w') as f:
+                for fields in dataset:
+                    f.write('\t'.join(map(str, fields))+'\n')
+            client = DictRedis()
+            ds = URLDataset(client)
+            ds.load(fname, batch_size=4)
+            self.assertEqual(client.round_trips, 2)
+            self.assertEqual(ds.get('http://hal.archives-ouvertes.fr/hal-01164591', 'custom'),
+                             (1., '2017-01-12'))
+            client.round_trips = 0
+            ds.save(fname, page_size=2)
+            # one scan of the classes, 3 pages of pdf URLs, 1 of custom URLs
+            self.assertEqual(client.round_trips, 5)
+            with open(fname, 'r') as f:
+                lines = sorted(line.strip().split('\t') for line in f)
+            self.assertEqual(lines, sorted(
+                [day, class_id, '%f' % value, url]
+                for day, class_id, value, url in dataset))
+            # the saved file can be loaded back
+            other = URLDataset(DictRedis())
+            other.load(fname)
+            self.assertEqual(other.client.hashes, client.hashes)
+        finally:
+            os.remove(fname)
+
+    def test_precheck(self):
+        client = DictRedis()
+        stats = CrawlingStatistics()
+        ds = URLDataset(client, stats=stats)
+        spider = Spider(dataset=ds)
+        spider.add_predictor('pdf', ConstantPredictor(), ConstantDirichlet())
+        today = date.today().isoformat()
+        ds.set_many('pdf', [('http://arxiv.org/pdf/1410.1454v2', 1.),
+                            ('http://arxiv.org/abs/1410.1454', 0.5)], today)
+        urls = ['http://arxiv.org/pdf/1410.1454v2', 'http://arxiv.org/abs/1410.1454',
+                b'http://example.com/']
+        ds.cache.clear()
+        client.round_trips = 0
+        self.assertEqual(spider.precheck('pdf', urls), [1., None, None])
+        self.assertEqual(client.round_trips, 1)
+        # the lookups of the precheck are not counted
+        self.assertEqual(stats.accu['dataset:cache_hit'], 0)
+        self.assertEqual(stats.accu['dataset:cache_miss'], 0)
+        self.assertEqual(spider.predict('pdf', urls[0]), 1.)
+        self.assertEqual(ds.get_if_recent('http://example.com/', 'pdf'), None)
+        self.assertEqual(client.round_trips, 1)
+        self.assertEqual(stats.accu['dataset:cache_hit'], 2)
+        self.assertEqual(stats.accu['dataset:cache_miss'], 0)
+        with self.assertRaises(ValueError):
+            spider.precheck('zotero', urls)
+
+def die_after(delay):
+    """
+    Kills the current process after some time.
+    """
+    time.sleep(delay)
+    os._exit(9)
+
+def fail_after(results, delay):
+    """
+    Sends an exception, then exits with an error code.
+    """
+    time.sleep(delay)
+    results.put(ValueError('invalid dump'))
+    raise SystemExit(1)
+
+class TrainingTest(unittest.TestCase):
+    def test_domain_shard(self):
+        self.assertEqual(domain_shard('//arxiv.org/pdf/1410.1454v2', 7),
+                         domain_shard('//export.arxiv.org/abs/1410.1454', 7))
+
+    def test_worker_killed(self):
+        results = Queue()
+        process = Process(target=die_after, args=(0.1,))
+        process.start()
+        with self.assertRaises(RuntimeError):
+            get_from_workers(results, [process], poll_interval=0.1)
+        process.join()
+
+    def test_worker_failed(self):
+        # the error sent by the worker is not mistaken for its death,
+        # even when it arrives just after a timeout
+        class LateQueue(object):
+            def __init__(self, queue):
+                self.queue = queue
+            def get(self, timeout):
+                raise Empty()
+            def get_nowait(self):
+                return self.queue.get(timeout=1)
+        results = Queue()
+        process = Process(target=fail_after, args=(results, 0.1))
+        process.start()
+        process.join()
+        result = get_from_workers(LateQueue(results), [process], poll_interval=0.01)
+        self.assertIsInstance(result, ValueError)
+
+    def test_train_forest(self):
+        fd, fname = tempfile.mkstemp()
+        try:
+            with os.fdopen(fd, 'w') as f:
+                for fields in dataset:
+                    f.write('\t'.join(map(str, fields))+'\n')
+            forest = train_forest(fname, workers=2)
+        finally:
+            os.remove(fname)
+
+        ref = PrefTree()
+        for day, class_id, value, url in dataset:
+            if class_id == 'pdf':
+                ref.add_url(prepare_url(url), value)
+        tree = forest.trees['pdf']
+        self.assertTrue(tree.check_sanity())
+        self.assertEqual(tree.url_count, 5)
+        for day, class_id, value, url in dataset:
+            tokenized = prepare_url(url)
+            self.assertEqual(tree.match_length(tokenized), ref.match_length(tokenized))
@@ -0,0 +1,130 @@
+# -*- encoding: utf-8 -*-
+
+"""
+Trains an URL forest from a dataset dump on multiple cores.
+
+The URLs are split into shards according to their reversed
+domain prefix (top and second level domain), so that the trees
+built for each shard are mostly disjoint. Each shard is built
+by a different process and the resulting forests are merged.
+"""
+
+from multiprocessing import Process
+from multiprocessing import Queue
+from multiprocessing import cpu_count
+import zlib
+
+from requests.compat import urlparse
+from urltheory.tokenizer import prepare_url
+from urltheory.preftree import PrefTree
+from urltheory.sorting import external_sort
+from urltheory.sorting import token_sort_key
+from urltheory.utils import get_from_workers
+from .forest import URLForest
+
+def domain_shard(url, nb_shards):
+    """
+    Returns the shard an URL belongs to, determined by
+    the top and second level domains of the URL.
+    """
+    netloc = urlparse(url).netloc.split(':')[0].lower()
+    domain = '.'.join(netloc.split('.')[-2:])
+    return zlib.crc32(domain.encode('utf-8')) % nb_shards
+
+def train_shard(fname, shard, nb_shards, class_ids=None, tmpdir=None):
+    """
+    Builds the trees for the URLs of one shard of a dataset dump
+    (in the format written by :meth:`URLDataset.save`).
+
+    :param class_ids: only build trees for these classes
+        (all classes are used by default)
+    :returns: a dict mapping class ids to trees
+    """
+    urls = {}
+    with open(fname, 'r') as f:
+        for line in f:
+            fields = line.strip().split('\t')
+            if len(fields) < 4:
+                continue
+            class_id = fields[1]
+            url = fields[3]
+            if class_ids is not None and class_id not in class_ids:
+                continue
+            if domain_shard(url, nb_shards) != shard:
+                continue
+            urls.setdefault(class_id, []).append(
+                (prepare_url(url), 1., float(fields[2])))
+
+    return {
+        class_id : PrefTree.from_sorted(external_sort(tokenized,
+                        key=lambda item: token_sort_key(item[0]),
+                        tmpdir=tmpdir))
+        for class_id, tokenized in list(urls.items())
+    }
+
+def _train_shard(results, *args):
+    """
+    Runs :func:`train_shard` in a worker process and sends
+    back the trees, or the exception raised. The process exits
+    normally in both cases: a nonzero exit code means that it
+    died before sending anything.
+    """
+    try:
+        results.put(train_shard(*args))
+    except Exception as e:
+        results.put(e)
+
+def _get_result(results, processes):
+    """
+    Waits for the trees built by the next worker.
+    """
+    result = get_from_workers(results, processes)
+    if isinstance(result, Exception):
+        raise RuntimeError('A training process failed: %s' % result)
+    return result
+
+def train_forest(fname, class_ids=None, workers=None, forest=None, tmpdir=None):
+    """
+    Trains an URL forest from a dataset dump, using
+    one process per shard.
+
+    We do not use :class:`multiprocessing.Pool` as its
+    internal queues are not compatible with gevent's
+    monkey-patching.
+
+    :param fname: the dataset dump, as written by :meth:`URLDataset.save`
+    :param class_ids: only build trees for these classes
+        (all classes are used by default)
+    :param workers: the number of processes to use (defaults to the
+        number of cores)
+    :param forest: the forest the trees should be merged into (a new
+        one is created by default)
+    :returns: the forest
+    """
+    workers = workers or cpu_count()
+    if forest is None:
+        forest = URLForest()
+
+    results = Queue()
+    processes = [
+        Process(target=_train_shard,
+                args=(results, fname, shard, workers, class_ids, tmpdir))
+        for shard in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    try:
+        for i in range(workers):
+            shard_forest = URLForest()
+            for class_id, tree in list(_get_result(results, processes).items()):
+                shard_forest.add_tree(class_id, tree)
+            forest.merge(shard_forest)
+    except BaseException:
+        # the other workers might be blocked on sending their trees
+        for process in processes:
+            process.terminate()
+        raise
+    finally:
+        for process in processes:
+            process.join()
+    return forest
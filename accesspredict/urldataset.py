@@ -1,17 +1,58 @@
 # -*- encoding: utf-8 -*-
 
 from datetime import date
+from collections import defaultdict
 from datetime import timedelta
+from functools import lru_cache
+from itertools import tee
 from urltheory.tokenizer import normalize_url
-from urltheory.tokenizer import prepare_url
+from urltheory.tokenizer import prepare_urls
+from urltheory.preftree import PrefTree
+from urltheory.sorting import external_sort
+from urltheory.sorting import token_sort_key
+from .cache import LRUCache
+
+@lru_cache(maxsize=4096)
+def parse_datestamp(datestamp):
+    """
+    Parses the date of a classification (as YYYY-MM-DD).
+    """
+    return date(year=int(datestamp[:4]),
+                month=int(datestamp[5:7]),
+                day=int(datestamp[8:10]))
 
 class URLDataset(object):
     """
     A redis-stored database of URLs
+
+    The classifications read or written by this process are
+    also kept in a bounded in-memory cache (written through),
+    so that URLs seen recently do not cost a round trip to redis.
+    The URLs which are not in redis are cached as well (as
+    :attr:`unknown`), with the same time to live.
     """
+    # cached for the URLs which are not in redis
+    # (the cache cannot store None)
+    unknown = object()
 
-    def __init__(self, redis_client):
+    def __init__(self, redis_client, cache_size=100000, cache_ttl=3600., stats=None):
+        """
+        :param cache_size: the number of classifications kept in memory
+            (0 disables the cache)
+        :param cache_ttl: the number of seconds after which cached
+            classifications are read from redis again (for instance
+            to see the updates made by other processes)
+        :param stats: the :class:`CrawlingStatistics` to report the
+            cache hits and misses to (as `dataset:cache_hit` and
+            `dataset:cache_miss`, and their ratio as `cache:hit_ratio`)
+        """
         self.client = redis_client
+        self.cache = LRUCache(max_size=cache_size, ttl=cache_ttl)
+        self.stats = stats
+        if stats is not None:
+            stats.add_key('dataset:cache_hit')
+            stats.add_key('dataset:cache_miss')
+            stats.add_ratio('cache:hit_ratio', 'dataset:cache_hit', 'dataset:cache_miss')
 
     def get(self, url, class_id):
         """
@@ -21,11 +62,54 @@ class URLDataset(object):
         Otherwise None.
         """
         url = normalize_url(url)
+        cached = self._get_cached(class_id, url)
+        if cached is not None:
+            return cached if cached is not self.unknown else None
         val = self.client.hget(class_id, url)
-        if not val:
-            return
-        val = val.decode('utf-8')
-        fields = val.split(':')
+        result = self._parse_value(val) if val else None
+        self.cache.put((class_id, url), result or self.unknown)
+        return result
+
+    def get_many(self, urls, class_id, record=True):
+        """
+        Same as get, for a list of URLs: the URLs which
+        are not cached are looked up in a single round trip
+        to redis.
+
+        :param record: count the lookups in the cache statistics
+            (this is disabled when the URLs are looked up ahead
+            of time, as they are looked up again afterwards)
+        :returns: the list of the results of get for each URL
+        """
+        urls = [normalize_url(url) for url in urls]
+        results = [self._get_cached(class_id, url, record) for url in urls]
+        missing = [idx for idx, result in enumerate(results) if result is None]
+        if missing:
+            values = self.client.hmget(class_id, [urls[idx] for idx in missing])
+            for idx, val in zip(missing, values):
+                results[idx] = self._parse_value(val) if val else self.unknown
+                self.cache.put((class_id, urls[idx]), results[idx])
+        return [result if result is not self.unknown else None
+                for result in results]
+
+    def _get_cached(self, class_id, url, record=True):
+        """
+        Looks up a normalized URL in the cache.
+
+        :param record: count the lookup in the cache statistics
+        """
+        cached = self.cache.get((class_id, url))
+        if self.stats is not None and record:
+            self.stats.increment('dataset:cache_hit' if cached is not None
+                                 else 'dataset:cache_miss')
+        return cached
+
+    @staticmethod
+    def _parse_value(val):
+        """
+        Parses a value stored in redis, as a pair (value, datestamp).
+        """
+        fields = val.decode('utf-8').split(':')
         return (float(fields[0]), fields[1])
 
     def get_if_recent(self, url, class_id, ttl=timedelta(days=6*30)):
@@ -33,14 +117,21 @@ class URLDataset(object):
         Same as get, but only returns only the boolean value,
         and only when the timestamp is fresh enough.
         """
-        v = self.get(url, class_id)
+        return self._if_recent(self.get(url, class_id), ttl)
+
+    def get_many_if_recent(self, urls, class_id, ttl=timedelta(days=6*30), record=True):
+        """
+        Same as get_if_recent, for a list of URLs
+        (see :meth:`get_many`).
+        """
+        return [self._if_recent(v, ttl) for v in self.get_many(urls, class_id, record)]
+
+    @staticmethod
+    def _if_recent(v, ttl):
         if v is None:
             return None
         val, datestamp = v
-        d = date(year=int(datestamp[:4]),
-                month=int(datestamp[5:7]),
-                day=int(datestamp[8:10]))
-        if d+ttl >= date.today():
+        if parse_datestamp(datestamp)+ttl >= date.today():
             return val
 
     def set(self, url, class_id, value, datestring=None):
@@ -49,53 +140,116 @@ class URLDataset(object):
         If a date string is not provided, it will be set to today.
         """
         url = normalize_url(url)
-        val = '%f:%s' % (
-                 value,
-                 datestring or date.today().isoformat())
+        datestring = datestring or date.today().isoformat()
+        val = '%f:%s' % (value, datestring)
         self.client.hset(class_id, url, val)
+        self.cache.put((class_id, url), (float('%f' % value), datestring))
+
+    def set_many(self, class_id, items, datestring=None):
+        """
+        Stores the values of the classification of many URLs
+        for the same class, in a single round trip to redis.
+
+        :param items: an iterable of pairs (url, value)
+        """
+        datestring = datestring or date.today().isoformat()
+        mapping = {normalize_url(url): '%f:%s' % (value, datestring)
+                   for url, value in items}
+        if mapping:
+            self.client.hset(class_id, mapping=mapping)
+        for url, val in mapping.items():
+            self.cache.put((class_id, url), (float(val.split(':')[0]), datestring))
 
-    def load(self, fname):
+    def load(self, fname, batch_size=10000):
         """
-        Loads the dataset from a text file
+        Loads the dataset from a text file.
+        The URLs are sent to redis in batches, each of them
+        in a single round trip. They are not cached in memory.
+
+        :param batch_size: the number of lines sent in each batch
         """
         with open(fname, 'r') as f:
+            batch = defaultdict(dict)
+            nb_lines = 0
             for line in f:
                 fields = line.strip().split('\t')
                 day = fields[0]
                 class_id = fields[1]
                 value = float(fields[2])
                 url = fields[3]
-                self.set(url, class_id, value, day)
+                batch[class_id][normalize_url(url)] = '%f:%s' % (value, day)
+                nb_lines += 1
+                if nb_lines % batch_size == 0:
+                    self._write_batch(batch)
+                    batch = defaultdict(dict)
+            self._write_batch(batch)
+
+    def _write_batch(self, batch):
+        """
+        Writes the values of many URLs, for many classes,
+        in a single round trip.
+
+        :param batch: a dictionary mapping each class to
+            a dictionary of URLs and their values in redis
+        """
+        if not batch:
+            return
+        pipeline = self.client.pipeline(transaction=False)
+        for class_id, mapping in batch.items():
+            pipeline.hset(class_id, mapping=mapping)
+            for url in mapping:
+                self.cache.invalidate((class_id, url))
+        pipeline.execute()
 
-    def feed_to_tree(self, class_id, tree):
+    def feed_to_tree(self, class_id, tree, tmpdir=None, workers=None):
         """
-        Adds all the URLs in the dataset to a given tree
+        Adds all the URLs in the dataset to a given tree.
+        If the tree is an empty :class:`PrefTree`, a new one
+        is built in one pass from the sorted URLs instead
+        (they are sorted on disk in `tmpdir` if they do not
+        fit in memory). The tree returned should then be used.
+
+        :param workers: the number of processes tokenizing the URLs
+            (see :func:`urltheory.tokenizer.prepare_urls`)
         """
-        for url, val, datestamp in self._iterate_urls(class_id):
-            tree.add_url(prepare_url(url), val)
+        items, urls = tee(self._iterate_urls(class_id))
+        tokenized = zip(prepare_urls((url for url, val, datestamp in urls),
+                                     workers=workers),
+                        items)
+        if type(tree) == PrefTree and tree.url_count == 0 and not tree.children:
+            return PrefTree.from_sorted(external_sort(
+                        ((tokens, 1., val) for tokens, (url, val, datestamp) in tokenized),
+                        key=lambda item: token_sort_key(item[0]),
+                        tmpdir=tmpdir))
+
+        for tokens, (url, val, datestamp) in tokenized:
+            tree.add_url(tokens, val)
         return tree
 
-    def feed_to_forest(self, forest):
+    def feed_to_forest(self, forest, workers=None):
         """
         Dumps the dataset into an URLForest.
         This bypasses the locks in the URLForest as it
         isn't designed for concurrent usage.
+
+        :param workers: the number of processes tokenizing the URLs
+            (defaults to the number of cores)
         """
         for class_id in self._iterate_classes():
             class_id = class_id.decode('utf-8')
-            new_tree = self.feed_to_tree(class_id, forest.trees[class_id])
+            new_tree = self.feed_to_tree(class_id, forest.trees[class_id],
+                                         workers=workers)
             forest.trees[class_id] = new_tree
 
-    def _iterate_urls(self, class_id):
+    def _iterate_urls(self, class_id, page_size=10000):
         """
-        Iterates over the contents of a class
+        Iterates over the contents of a class, fetching
+        them from redis in pages of about `page_size` URLs.
         """
-        for item in self.client.hscan_iter(class_id):
+        for item in self.client.hscan_iter(class_id, count=page_size):
             url, redis_val = item
             url = url.decode('utf-8')
-            parsed = redis_val.decode('utf-8').split(':')
-            val = float(parsed[0])
-            datestamp = parsed[1]
+            val, datestamp = self._parse_value(redis_val)
             yield (url, val, datestamp)
 
     def _iterate_classes(self):
@@ -104,13 +258,16 @@ class URLDataset(object):
         """
         return self.client.scan_iter()
 
-    def save(self, fname):
+    def save(self, fname, page_size=10000):
         """
-        Saves the dataset to a file
+        Saves the dataset to a file (which can be read by :meth:`load`).
+
+        :param page_size: the number of URLs fetched from redis
+            in each round trip
         """
         with open(fname, 'w') as f:
             for class_id in self._iterate_classes():
-                for (url, val, datestamp) in self._iterate_urls(class_id):
-                    class_id = class_id.decode('utf-8')
-                    f.write(str('\t').join([datestamp, class_id, val, url])+str('\n'))
+                class_id = class_id.decode('utf-8')
+                for (url, val, datestamp) in self._iterate_urls(class_id, page_size):
+                    f.write('\t'.join([datestamp, class_id, '%f' % val, url])+'\n')
 
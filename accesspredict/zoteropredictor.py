@@ -46,7 +46,8 @@ class ZoteroFullTextPredictor(URLCategoryPredictor):
             return 0.
 
         try:
-            r = requests.post(self.zotero_endpoint,
+            http = self.spider.session if self.spider is not None else requests
+            r = http.post(self.zotero_endpoint,
                     headers=headers,
                     data=json.dumps(zotero_data))
             r.raise_for_status()
@@ -0,0 +1,104 @@
+# -*- encoding: utf-8 -*-
+
+"""
+Measures the lookup throughput of an :class:`URLForest` with 1, 10
+and 100 greenlets matching URLs concurrently, while another greenlet
+keeps adding URLs to the same tree.
+
+The forest locks its trees with a :class:`ReadWriteLock`. It is
+compared to the previous behaviour, where every method of a tree
+(reads included) was run under the same exclusive lock.
+
+Usage: python benchmarks/forest_concurrency.py [delay]
+
+Lookups never yield to other greenlets on plain trees, so both locks
+behave the same there apart from their overhead. The `delay` (in
+seconds, default 0.001) is spent in each lookup, yielding, to show
+how lookups which wait on I/O are serialized by an exclusive lock.
+"""
+
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import gevent
+
+from accesspredict.forest import URLForest
+from accesspredict.rwlock import ReadWriteLock
+from urltheory.tokenizer import prepare_url
+
+class ExclusiveLock(ReadWriteLock):
+    """
+    A lock held for writing even by readers.
+    """
+    def acquire_read(self):
+        self.acquire_write()
+
+    def release_read(self):
+        self.release_write()
+
+class YieldingTree(object):
+    """
+    Wraps a tree, yielding for `delay` seconds during lookups.
+    """
+    def __init__(self, tree, delay):
+        self.tree = tree
+        self.delay = delay
+
+    def match_length(self, url):
+        if self.delay:
+            gevent.sleep(self.delay)
+        return self.tree.match_length(url)
+
+    def add_url(self, *args, **kwargs):
+        return self.tree.add_url(*args, **kwargs)
+
+def synthetic_urls(n, seed=42):
+    rnd = random.Random(seed)
+    hosts = ['arxiv.org', 'hal.archives-ouvertes.fr', 'link.springer.com',
+             'onlinelibrary.wiley.com', 'repository.example.edu']
+    return ['http://%s/%s/%d' % (rnd.choice(hosts),
+                                 rnd.choice(['pdf', 'abs', 'article', 'files']),
+                                 rnd.randint(0, 100000))
+            for _ in range(n)]
+
+def run(lock_class, nb_greenlets, urls, delay, lookups=2000):
+    """
+    Returns the number of lookups per second.
+    """
+    forest = URLForest()
+    forest.add_tree('pdf')
+    for url in urls[:len(urls)//2]:
+        forest.add_url('pdf', url, True)
+    forest.trees['pdf'] = YieldingTree(forest.trees['pdf'], delay)
+    forest.locks['pdf'] = lock_class()
+
+    per_greenlet = max(1, lookups // nb_greenlets)
+    def reader(offset):
+        for i in range(per_greenlet):
+            forest.match_length('pdf', urls[(offset + i) % len(urls)])
+    def writer():
+        for url in urls[len(urls)//2:]:
+            forest.add_url('pdf', url, False)
+            gevent.sleep(0)
+
+    start = time.perf_counter()
+    writing = gevent.spawn(writer)
+    gevent.joinall([gevent.spawn(reader, 97*i) for i in range(nb_greenlets)])
+    elapsed = time.perf_counter() - start
+    writing.kill()
+    return per_greenlet * nb_greenlets / elapsed
+
+if __name__ == '__main__':
+    delay = float(sys.argv[1]) if len(sys.argv) > 1 else 0.001
+    urls = [prepare_url(url) for url in synthetic_urls(20000)]
+    for current_delay in sorted(set([0., delay])):
+        print('delay per lookup: %gs' % current_delay)
+        for nb_greenlets in [1, 10, 100]:
+            exclusive = run(ExclusiveLock, nb_greenlets, urls, current_delay)
+            shared = run(ReadWriteLock, nb_greenlets, urls, current_delay)
+            print('  %3d greenlets: exclusive lock %8.0f lookups/s, '
+                  'read-write lock %8.0f lookups/s' % (nb_greenlets, exclusive, shared))
@@ -0,0 +1,98 @@
+# -*- encoding: utf-8 -*-
+
+"""
+Compares a :class:`JointPrefTree` storing the URLs of several classes
+with one :class:`CompactPrefTree` per class: memory used, and time
+needed to look up an URL in all classes.
+
+Usage: python benchmarks/jointtree.py [urls.txt]
+
+Without a file of URLs (one per line), a synthetic sample is used.
+The URLs are spread over the classes at random, most of them being
+seen in more than one class (as when a crawled URL is classified
+for each task).
+"""
+
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from urltheory.compacttree import CompactPrefTree
+from urltheory.jointtree import JointPrefTree
+from urltheory.tokenizer import prepare_url
+
+classes = ['pdf', 'custom', 'robots', 'landing']
+
+def synthetic_urls(n, seed=42):
+    """
+    Generates URLs looking like those found in the datasets.
+    """
+    rnd = random.Random(seed)
+    hosts = ['www.sciencedirect.com', 'arxiv.org', 'hal.archives-ouvertes.fr',
+             'link.springer.com', 'dx.doi.org', 'onlinelibrary.wiley.com',
+             'repository.example.edu', 'hdl.handle.net']
+    urls = []
+    for i in range(n):
+        host = rnd.choice(hosts)
+        path = '/'.join(rnd.choice(['pdf', 'abs', 'article', 'files', 'doc'])
+                        + rnd.choice(['', '-', '_v']) + str(rnd.randint(0, 100000))
+                        for _ in range(rnd.randint(1, 4)))
+        urls.append('http://' + host + '/' + path)
+    return urls
+
+def build(cls, samples):
+    """
+    Builds the trees and returns them with the memory they use.
+    """
+    tracemalloc.start()
+    if cls is JointPrefTree:
+        trees = JointPrefTree(classes)
+        for class_id, url, success in samples:
+            trees.add_url(class_id, url, success)
+    else:
+        trees = {class_id: cls() for class_id in classes}
+        for class_id, url, success in samples:
+            trees[class_id].add_url(url, success)
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return trees, size
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        with open(sys.argv[1], 'r') as f:
+            urls = [line.strip() for line in f if line.strip()]
+    else:
+        urls = synthetic_urls(50000)
+
+    rnd = random.Random(1)
+    tokenized = [prepare_url(url) for url in urls]
+    samples = []
+    for url in tokenized:
+        for class_id in rnd.sample(classes, rnd.randint(1, len(classes))):
+            samples.append((class_id, url, rnd.random() < 0.5))
+
+    separate, separate_size = build(CompactPrefTree, samples)
+    joint, joint_size = build(JointPrefTree, samples)
+    print('%d urls, %d samples' % (len(urls), len(samples)))
+    print('separate trees: %d nodes, %.1f MB' % (
+        sum(t.node_count() for t in separate.values()), separate_size / 1e6))
+    print('joint tree:     %d nodes, %.1f MB' % (joint.node_count(), joint_size / 1e6))
+
+    queries = [tokenized[rnd.randrange(len(tokenized))] for _ in range(20000)]
+    start = time.perf_counter()
+    expected = [[separate[class_id].match(url) for class_id in classes]
+                for url in queries]
+    separate_time = time.perf_counter() - start
+    start = time.perf_counter()
+    results = [joint.match_all(url) for url in queries]
+    joint_time = time.perf_counter() - start
+
+    mismatches = sum(1 for e, (counts, successes, _) in zip(expected, results)
+                     if e != list(zip(counts.tolist(), successes.tolist())))
+    print('lookup in all classes: separate %.2fs, joint %.2fs (%.1fx)' % (
+        separate_time, joint_time, separate_time / joint_time))
+    print('mismatches: %d' % mismatches)
@@ -0,0 +1,70 @@
+# -*- encoding: utf-8 -*-
+
+"""
+Compares the time needed to match a large batch of URLs with a
+:class:`FrozenPrefTree`, one URL at a time with `match_length`
+and all at once with `match_many`.
+
+Usage: python benchmarks/match_many.py [urls.txt] [batch size]
+
+Without a file of URLs (one per line), a synthetic sample is used.
+"""
+
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from urltheory.preftree import PrefTree
+from urltheory.tokenizer import prepare_url
+
+def synthetic_urls(n, seed=42):
+    """
+    Generates URLs looking like those found in the datasets.
+    """
+    rnd = random.Random(seed)
+    hosts = ['www.sciencedirect.com', 'arxiv.org', 'hal.archives-ouvertes.fr',
+             'link.springer.com', 'dx.doi.org', 'onlinelibrary.wiley.com',
+             'repository.example.edu', 'hdl.handle.net']
+    urls = []
+    for i in range(n):
+        host = rnd.choice(hosts)
+        path = '/'.join(rnd.choice(['pdf', 'abs', 'article', 'files', 'doc'])
+                        + rnd.choice(['', '-', '_v']) + str(rnd.randint(0, 100000))
+                        for _ in range(rnd.randint(1, 4)))
+        urls.append('http://' + host + '/' + path)
+    return urls
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        with open(sys.argv[1], 'r') as f:
+            urls = [line.strip() for line in f if line.strip()]
+    else:
+        urls = synthetic_urls(50000)
+    batch_size = int(sys.argv[2]) if len(sys.argv) > 2 else 1000000
+
+    rnd = random.Random(1)
+    tokenized = [prepare_url(url) for url in urls]
+    tree = PrefTree()
+    for url in tokenized:
+        tree.add_url(url, rnd.random() < 0.5)
+    tree, _ = tree.prune(confidence_threshold=0.8)
+    frozen = tree.freeze()
+    print('%d urls, %d nodes' % (len(urls), frozen.node_count()))
+
+    queries = [tokenized[rnd.randrange(len(tokenized))] for _ in range(batch_size)]
+    start = time.perf_counter()
+    expected = [frozen.match_length(url) for url in queries]
+    loop_time = time.perf_counter() - start
+    start = time.perf_counter()
+    counts, successes, lengths = frozen.match_many(queries)
+    batch_time = time.perf_counter() - start
+
+    mismatches = sum(1 for e, r in zip(expected, zip(counts.tolist(), successes.tolist(),
+                                                     lengths.tolist()))
+                     if e != r)
+    print('%d lookups: one by one %.2fs, batched %.2fs (%.1fx)' % (
+        batch_size, loop_time, batch_time, loop_time / batch_time))
+    print('mismatches: %d' % mismatches)
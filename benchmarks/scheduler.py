@@ -0,0 +1,117 @@
+# -*- encoding: utf-8 -*-
+
+"""
+Measures the crawl throughput allowed by a :class:`HostScheduler`
+at various levels of concurrency, against a local stub server which
+answers each request after a fixed latency.
+
+Usage: python benchmarks/scheduler.py [nb_hosts] [urls_per_host]
+
+The hosts are distinct loopback addresses (127.0.0.1, 127.0.0.2, …)
+served by the same server, which records for each host the maximum
+number of concurrent requests and the minimum delay between two
+requests, to check that the politeness limits hold. The server runs
+in its own process, so that its measures are not delayed by the
+crawling greenlets. The delays are enforced when the requests are
+sent: the delays measured by the server also include the jitter of
+opening connections and of scheduling both processes.
+"""
+
+import json
+from multiprocessing import Process
+from multiprocessing import Queue
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import gevent
+from gevent.pool import Pool
+from gevent.pywsgi import WSGIServer
+
+from accesspredict.scheduler import HostScheduler
+from accesspredict.session import PooledSession
+
+latency = 0.05
+per_host = 2
+min_delay = 0.1
+
+class StubServer(object):
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.active = {}
+        self.max_active = {}
+        self.last_start = {}
+        self.min_gap = {}
+
+    def __call__(self, environ, start_response):
+        if environ['PATH_INFO'] == '/stats':
+            body = json.dumps([self.max_active, self.min_gap]).encode('utf-8')
+            self.reset()
+            start_response('200 OK', [('Content-Length', str(len(body)))])
+            return [body]
+        host = environ['HTTP_HOST']
+        now = time.time()
+        if host in self.last_start:
+            self.min_gap[host] = min(self.min_gap.get(host, float('inf')),
+                                     now - self.last_start[host])
+        self.last_start[host] = now
+        self.active[host] = self.active.get(host, 0) + 1
+        self.max_active[host] = max(self.max_active.get(host, 0), self.active[host])
+        gevent.sleep(latency)
+        self.active[host] -= 1
+        body = b'%PDF-1.4'
+        start_response('200 OK', [('Content-Type', 'application/pdf'),
+                                  ('Content-Length', str(len(body)))])
+        return [body]
+
+def serve(ports):
+    server = WSGIServer(('', 0), StubServer(), log=None)
+    server.start()
+    ports.put(server.server_port)
+    server.serve_forever()
+
+def crawl(urls, concurrency, scheduler):
+    session = PooledSession(pool_maxsize=per_host)
+    def fetch(url):
+        if scheduler is None:
+            return session.get(url).status_code
+        with scheduler.slot(url):
+            return session.get(url).status_code
+    start = time.perf_counter()
+    statuses = list(Pool(concurrency).imap_unordered(fetch, urls))
+    elapsed = time.perf_counter() - start
+    assert statuses == [200]*len(urls)
+    return len(urls) / elapsed
+
+if __name__ == '__main__':
+    nb_hosts = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    urls_per_host = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+
+    ports = Queue()
+    server = Process(target=serve, args=(ports,))
+    server.start()
+    port = ports.get()
+    stats_url = 'http://127.0.0.1:%d/stats' % port
+    # requests are interleaved between the hosts, as in a crawl
+    urls = ['http://127.0.0.%d:%d/paper/%d.pdf' % (h+1, port, i)
+            for i in range(urls_per_host) for h in range(nb_hosts)]
+
+    print('%d hosts, %d urls, latency %gs, per host: %d requests, %gs apart' % (
+          nb_hosts, len(urls), latency, per_host, min_delay))
+    for concurrency in [1, 4, 16, 64]:
+        for name, scheduler in [
+                ('unscheduled', None),
+                ('scheduled', HostScheduler(max_concurrency=concurrency,
+                                            per_host=per_host, min_delay=min_delay))]:
+            PooledSession().get(stats_url)
+            throughput = crawl(urls, concurrency, scheduler)
+            max_active, min_gap = PooledSession().get(stats_url).json()
+            print('  concurrency %2d, %-11s: %6.1f requests/s, '
+                  'max %d concurrent requests per host, min delay %.3fs' % (
+                  concurrency, name, throughput, max(max_active.values()),
+                  min(min_gap.values())))
+    server.terminate()
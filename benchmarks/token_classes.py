@@ -0,0 +1,76 @@
+# -*- encoding: utf-8 -*-
+
+"""
+Reports the size of the :class:`PrefTree` built from a sample of URLs
+with various sets of token classes (see
+:func:`urltheory.tokenizer.set_token_classes`).
+
+Usage: python benchmarks/token_classes.py [urls.txt]
+
+Without a file of URLs (one per line), a synthetic sample of
+repository URLs is used.
+"""
+
+import os
+import random
+import sys
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from urltheory.preftree import PrefTree
+from urltheory.tokenizer import prepare_url
+from urltheory.tokenizer import set_token_classes
+
+configurations = [
+    ['digits'],
+    ['uuid', 'digits'],
+    ['uuid', 'hex', 'digits'],
+    ['uuid', 'hex', 'base64', 'digits'],
+]
+
+def synthetic_urls(n, seed=42):
+    """
+    Generates URLs in the style of institutional repositories,
+    full of identifiers.
+    """
+    rnd = random.Random(seed)
+    b64 = 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789-_'
+    def hexid(length):
+        return ''.join(rnd.choice('0123456789abcdef') for _ in range(length))
+    def handle():
+        while True:
+            h = ''.join(rnd.choice(b64) for _ in range(28))
+            if any(c.isdigit() for c in h):
+                return h
+    templates = [
+        lambda: 'https://repository.example.edu/bitstream/handle/%s/article.pdf' % uuid.UUID(int=rnd.getrandbits(128)),
+        lambda: 'https://dspace.example.org/server/api/core/bitstreams/%s/content' % uuid.UUID(int=rnd.getrandbits(128)),
+        lambda: 'https://figshare.example.com/files/%s' % hexid(24),
+        lambda: 'https://cdn.example.net/%s/fulltext.pdf' % hexid(40),
+        lambda: 'https://drive.example.com/file/d/%s/view' % handle(),
+        lambda: 'https://arxiv.org/pdf/%d.%05d' % (rnd.randint(1000, 2000), rnd.randint(0, 99999)),
+    ]
+    return [(rnd.choice(templates)(), rnd.random() < 0.5) for i in range(n)]
+
+def tree_size(urls, classes):
+    set_token_classes(classes)
+    tree = PrefTree()
+    for url, success in urls:
+        tree.add_url(prepare_url(url), success)
+    return tree.node_count()
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        with open(sys.argv[1], 'r') as f:
+            urls = [(line.strip(), False) for line in f if line.strip()]
+    else:
+        urls = synthetic_urls(20000)
+
+    reference = None
+    print('%d URLs' % len(urls))
+    for classes in configurations:
+        size = tree_size(urls, classes)
+        reference = reference or size
+        print('%-30s %8d nodes (%5.1f%%)' % (
+            ', '.join(classes), size, 100.*size/reference))
@@ -0,0 +1,63 @@
+# -*- encoding: utf-8 -*-
+
+"""
+Micro-benchmark of :func:`urltheory.tokenizer.prepare_url` against
+its reference implementation (the previous one, still used for the
+URLs that the fast path does not handle), which parses and cleans up
+each URL twice.
+
+Usage: python benchmarks/tokenizer.py [urls.txt]
+
+Without a file of URLs (one per line), a synthetic sample is used.
+"""
+
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from urltheory.tokenizer import _prepare_url_reference
+from urltheory.tokenizer import prepare_url
+
+def synthetic_urls(n, seed=42):
+    """
+    Generates URLs looking like those found in the datasets.
+    """
+    rnd = random.Random(seed)
+    hosts = ['www.sciencedirect.com', 'arxiv.org', 'hal.archives-ouvertes.fr',
+             'link.springer.com', 'dx.doi.org', 'onlinelibrary.wiley.com',
+             'repository.example.edu:8080', 'hdl.handle.net']
+    urls = []
+    for i in range(n):
+        host = rnd.choice(hosts)
+        path = '/'.join(rnd.choice(['pdf', 'abs', 'article', 'files', 'doc'])
+                        + str(rnd.randint(0, 100000)) for _ in range(rnd.randint(1, 4)))
+        query = rnd.choice(['', '', '?id=%d' % i, '?id=%d&format=pdf' % i,
+                            '?id=%d&utm_source=twitter' % i, '?q=a+b&jsessionid=12ab'])
+        urls.append(rnd.choice(['http://', 'https://']) + host + '/' + path + query)
+    return urls
+
+def timed(f, urls):
+    start = time.perf_counter()
+    results = [f(url) for url in urls]
+    return time.perf_counter() - start, results
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        with open(sys.argv[1], 'r') as f:
+            urls = [line.strip() for line in f if line.strip()]
+    else:
+        urls = synthetic_urls(200000)
+
+    reference_time, expected = timed(_prepare_url_reference, urls)
+    fast_time, results = timed(prepare_url, urls)
+    mismatches = sum(1 for a, b in zip(expected, results) if a != b)
+
+    print('%d URLs' % len(urls))
+    print('reference: %.3f s (%.1f us/url)' % (reference_time, 1e6*reference_time/len(urls)))
+    print('current:   %.3f s (%.1f us/url)' % (fast_time, 1e6*fast_time/len(urls)))
+    print('speedup:   %.1fx' % (reference_time / fast_time))
+    print('mismatches: %d' % mismatches)
+    sys.exit(1 if mismatches else 0)
@@ -0,0 +1,198 @@
+# -*- encoding: utf-8 -*-
+
+"""
+Compares the round trips to redis done by an :class:`URLDataset`
+when URLs are looked up, stored, loaded and saved one by one,
+and in batches (with HMGET, pipelines and HSCAN pages).
+
+Usage: python benchmarks/urldataset.py [nb_urls] [latency]
+
+The dataset talks to a small redis-compatible server (implementing
+only the commands used by the dataset), running in its own process,
+which waits for `latency` seconds (default 0.0005) before answering
+each packet it receives, to simulate the network between the crawler
+and redis. Pipelined commands arriving in the same packet are answered
+together.
+"""
+
+from collections import OrderedDict
+from multiprocessing import Process
+from multiprocessing import Queue
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from gevent.server import StreamServer
+import redis
+
+from accesspredict.urldataset import URLDataset
+
+latency = 0.0005
+
+def encode(reply):
+    if reply is None:
+        return b'$-1\r\n'
+    elif isinstance(reply, int):
+        return b':%d\r\n' % reply
+    elif isinstance(reply, bytes):
+        return b'$%d\r\n%s\r\n' % (len(reply), reply)
+    elif isinstance(reply, str):
+        return b'+%s\r\n' % reply.encode('utf-8')
+    return b'*%d\r\n' % len(reply) + b''.join(encode(item) for item in reply)
+
+def parse(buf):
+    """
+    Parses the commands at the beginning of the buffer.
+
+    :returns: the list of commands and the unparsed rest of the buffer
+    """
+    commands = []
+    while buf.startswith(b'*'):
+        pos = buf.find(b'\r\n')
+        if pos < 0:
+            break
+        nb_args = int(buf[1:pos])
+        pos += 2
+        args = []
+        for _ in range(nb_args):
+            end = buf.find(b'\r\n', pos)
+            if end < 0:
+                break
+            length = int(buf[pos+1:end])
+            if len(buf) < end + 2 + length + 2:
+                break
+            args.append(buf[end+2:end+2+length])
+            pos = end + 2 + length + 2
+        if len(args) < nb_args:
+            break
+        commands.append(args)
+        buf = buf[pos:]
+    return commands, buf
+
+class StubRedis(object):
+    def __init__(self):
+        self.hashes = {}
+
+    def scan(self, hashes, args):
+        cursor = int(args[0])
+        count = int(args[args.index(b'COUNT')+1]) if b'COUNT' in args else 10
+        keys = list(hashes)
+        page = keys[cursor:cursor+count]
+        next_cursor = cursor + count if cursor + count < len(keys) else 0
+        return [b'%d' % next_cursor, page]
+
+    def execute(self, args):
+        name = args[0].upper()
+        if name == b'HGET':
+            return self.hashes.get(args[1], {}).get(args[2])
+        elif name == b'HMGET':
+            values = self.hashes.get(args[1], {})
+            return [values.get(key) for key in args[2:]]
+        elif name == b'HSET':
+            values = self.hashes.setdefault(args[1], OrderedDict())
+            for i in range(2, len(args), 2):
+                values[args[i]] = args[i+1]
+            return (len(args) - 2) // 2
+        elif name == b'HSCAN':
+            values = self.hashes.get(args[1], {})
+            cursor, page = self.scan(values, args[2:])
+            return [cursor, [item for key in page for item in (key, values[key])]]
+        elif name == b'SCAN':
+            return self.scan(self.hashes, args[1:])
+        elif name == b'FLUSHALL':
+            self.hashes.clear()
+        return 'OK'
+
+    def handle(self, sock, address):
+        buf = b''
+        while True:
+            data = sock.recv(1 << 16)
+            if not data:
+                break
+            commands, buf = parse(buf + data)
+            if commands:
+                time.sleep(latency)
+                sock.sendall(b''.join(encode(self.execute(args)) for args in commands))
+
+def serve(ports):
+    server = StreamServer(('127.0.0.1', 0), StubRedis().handle)
+    server.start()
+    ports.put(server.server_port)
+    server.serve_forever()
+
+def timed(f):
+    start = time.perf_counter()
+    f()
+    return time.perf_counter() - start
+
+if __name__ == '__main__':
+    nb_urls = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    latency = float(sys.argv[2]) if len(sys.argv) > 2 else latency
+
+    ports = Queue()
+    server = Process(target=serve, args=(ports,))
+    server.start()
+    # the stub server only speaks RESP2
+    client = redis.Redis(port=ports.get(), protocol=2)
+
+    urls = ['http://repository.example.edu/%s/%d' % (kind, i)
+            for i in range(nb_urls//2) for kind in ['abs', 'pdf']]
+    day = '2017-01-12'
+    fd, fname = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        def set_each():
+            ds = URLDataset(client)
+            for i, url in enumerate(urls):
+                ds.set(url, 'pdf', float(i % 2), day)
+        def set_batched():
+            URLDataset(client).set_many('pdf',
+                [(url, float(i % 2)) for i, url in enumerate(urls)], day)
+        def get_each():
+            ds = URLDataset(client, cache_size=0)
+            assert all(ds.get(url, 'pdf') is not None for url in urls)
+        def get_batched():
+            ds = URLDataset(client, cache_size=0)
+            for start in range(0, len(urls), 1000):
+                assert None not in ds.get_many(urls[start:start+1000], 'pdf')
+        def save_each():
+            # HSCAN pages of the default size (10 URLs), as before
+            ds = URLDataset(client)
+            with open(fname, 'w') as f:
+                for name in client.scan_iter():
+                    class_id = name.decode('utf-8')
+                    for url, val in client.hscan_iter(class_id):
+                        val, datestamp = ds._parse_value(val)
+                        f.write('\t'.join([datestamp, class_id, '%f' % val,
+                                           url.decode('utf-8')])+'\n')
+        def save_paged():
+            URLDataset(client).save(fname)
+        def load_each():
+            ds = URLDataset(client)
+            with open(fname, 'r') as f:
+                for line in f:
+                    day, class_id, value, url = line.strip().split('\t')
+                    ds.set(url, class_id, float(value), day)
+        def load_pipelined():
+            URLDataset(client).load(fname)
+
+        print('%d urls, latency %gs per round trip' % (len(urls), latency))
+        for operation, each, batched in [
+                ('set', set_each, set_batched),
+                ('get', get_each, get_batched),
+                ('save', save_each, save_paged),
+                ('load', load_each, load_pipelined)]:
+            client.flushall()
+            set_batched()
+            one_by_one = timed(each)
+            client.flushall()
+            set_batched()
+            in_batches = timed(batched)
+            print('  %-4s: one by one %7.3fs, batched %7.3fs (%5.1fx faster)' % (
+                  operation, one_by_one, in_batches, one_by_one / in_batches))
+    finally:
+        os.remove(fname)
+        server.terminate()
@@ -0,0 +1,27 @@
+# -*- encoding: utf-8 -*-
+
+# Scores a file of URLs (one per line) offline with a trained forest,
+# writing the url, probability and confidence of each URL:
+# python score.py data/crossref.train/forest.pkl pdf urls.txt scores.tsv
+# The URLs are tokenized on all cores.
+
+from accesspredict.forest import URLForest
+from urltheory.smoothing import ExponentialDirichlet
+from urltheory.tokenizer import prepare_urls
+from urltheory.utils import proba_confidence_many
+import sys
+
+if __name__ == '__main__':
+    forest = URLForest()
+    forest.load(sys.argv[1])
+    class_id = sys.argv[2]
+    with open(sys.argv[3], 'r') as f:
+        urls = [line.strip() for line in f if line.strip()]
+
+    counts, successes, lengths = forest.match_many(class_id,
+                                        list(prepare_urls(urls)))
+    probas = ExponentialDirichlet().evaluate(counts, successes, lengths)
+    confidences = proba_confidence_many(probas)
+    with open(sys.argv[4], 'w') as f:
+        for url, proba, confidence in zip(urls, probas, confidences):
+            f.write('%s\t%f\t%f\n' % (url, proba, confidence))
@@ -8,6 +8,7 @@ from accesspredict.forest import URLForest
 from accesspredict.spider import *
 from accesspredict.urldataset import URLDataset
 from accesspredict.combinedpredictor import P
+from accesspredict.scheduler import HostScheduler
 from accesspredict.statistics import CrawlingStatistics
 from urltheory.smoothing import ExponentialDirichlet
 
@@ -25,16 +26,18 @@ uf.add_tree('custom')
 #uf.add_tree('zotero')
 #uf.add_tree('diff')
 
-ud = URLDataset(redis_client)
+stats = CrawlingStatistics()
+
+ud = URLDataset(redis_client, stats=stats)
 # this loads up all the cached URLs we have in redis
 ud.feed_to_forest(uf)
 
-stats = CrawlingStatistics()
-
 dumpname = 'crossref.train'
 #dumpname = 'pdftest'
 
-spider = Spider(forest=uf, dataset=ud, stats=stats)
+# at most 2 concurrent requests per repository, started 1s apart
+scheduler = HostScheduler(max_concurrency=32, per_host=2, min_delay=1.)
+spider = Spider(forest=uf, dataset=ud, stats=stats, scheduler=scheduler)
 spider.add_predictor('pdf', PDFPredictor(), ExponentialDirichlet())
 spider.add_predictor('custom', ScraperFullTextPredictor(), ExponentialDirichlet())
 #spider.add_predictor('zotero', ZoteroFullTextPredictor())
@@ -46,7 +49,7 @@ def update_stats(for_greenlet):
         stats.log_all()
         stats.write('www/stats_%s.html' % dumpname)
 
-pool = Pool(1)
+pool = Pool(32)
 
 def urls():
     with codecs.open('data/%s/urls.txt' % dumpname, 'r', 'utf-8') as f:
@@ -55,8 +58,24 @@ def urls():
             u = fields[0]
             yield u
 
+def prechecked(urls, chunk_size=1000):
+    """
+    Looks up the URLs in redis by chunks before they are predicted
+    """
+    chunk = []
+    for u in urls:
+        chunk.append(u)
+        if len(chunk) == chunk_size:
+            spider.precheck('custom', chunk)
+            for u in chunk:
+                yield u
+            chunk = []
+    spider.precheck('custom', chunk)
+    for u in chunk:
+        yield u
+
 def crawler():
-    for result in pool.imap_unordered(lambda u: spider.predict('custom',u), urls()):
+    for result in pool.imap_unordered(lambda u: spider.predict('custom',u), prechecked(urls())):
         print("-- final result: {}".format(result))
 
 crawler_greenlet = gevent.Greenlet(crawler)
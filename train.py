@@ -0,0 +1,12 @@
+# -*- encoding: utf-8 -*-
+
+# Trains an URL forest from a dataset dump on all cores:
+# python train.py data/crossref.train/dataset.tsv data/crossref.train/forest.pkl
+
+from accesspredict.training import train_forest
+import sys
+
+if __name__ == '__main__':
+    workers = int(sys.argv[3]) if len(sys.argv) > 3 else None
+    forest = train_forest(sys.argv[1], workers=workers)
+    forest.save(sys.argv[2])
@@ -0,0 +1,571 @@
+# -*- encoding: utf-8 -*-
+
+from array import array
+
+from urltheory import utils
+from urltheory.preftree import PrefTree
+from urltheory.preftree import RevPrefTree
+from urltheory.smoothing import ConstantDirichlet
+from urltheory import tokenizer
+from urltheory.tokenizer import TokenVocabulary
+from urltheory.utils import proba_confidence
+
+class _CompactStructure(object):
+    """
+    The structure shared by :class:`CompactPrefTree` and
+    :class:`urltheory.jointtree.JointPrefTree`: the nodes are stored
+    in the parallel arrays `first_child`, `next_sibling`, `label_start`
+    and `label_length`, and the labels in `labels`, as token ids
+    of `vocabulary`. Subclasses store the counts of the nodes and
+    allocate them with `_new_node`.
+    """
+
+    def _init_vocabulary(self, vocabulary):
+        """
+        Sets the vocabulary of the labels: see :class:`CompactPrefTree`.
+        """
+        self.vocabulary = vocabulary if vocabulary is not None else TokenVocabulary()
+
+    def __getstate__(self):
+        """
+        Token ids are only valid in the current process, so the
+        tokens used in the labels are pickled with the tree and
+        the labels are renumbered accordingly. The tokens which are
+        no longer used (for instance after a prune) are dropped.
+        """
+        state = self.__dict__.copy()
+        del state['child_index']
+        del state['vocabulary']
+        used = set()
+        stack = [0]
+        while stack:
+            node = stack.pop()
+            start = self.label_start[node]
+            used.update(self.labels[start:start+self.label_length[node]])
+            stack.extend(self._children(node))
+        used = sorted(used)
+        # the labels of the nodes removed from the tree are not used
+        unknown = TokenVocabulary.unknown
+        local_ids = {tid: i for i, tid in enumerate(used)}
+        state['labels'] = array('I', [local_ids.get(tid, unknown) for tid in self.labels])
+        state['tokens'] = self.vocabulary.decode(used)
+        state['shared_vocabulary'] = self.vocabulary is tokenizer.vocabulary
+        return state
+
+    def __setstate__(self, state):
+        tokens = state.pop('tokens')
+        shared = state.pop('shared_vocabulary', False)
+        state.pop('token_ids', None)
+        self.__dict__.update(state)
+        self.child_index = {}
+        self._init_vocabulary(tokenizer.vocabulary if shared else None)
+        ids = self.vocabulary.encode(tokens).tolist()
+        unknown = TokenVocabulary.unknown
+        self.labels = array('I', [ids[i] if i != unknown else unknown
+                                  for i in self.labels])
+
+    def _new_leaf(self, parent, ids, *counts):
+        """
+        Creates a new node labelled by the token ids `ids`
+        and adds it to the children of `parent`. The counts
+        are passed to `_new_node`.
+        """
+        start = len(self.labels)
+        self.labels.extend(ids)
+        leaf = self._new_node(start, len(ids), *counts)
+        self.next_sibling[leaf] = self.first_child[parent]
+        self.first_child[parent] = leaf
+        index = self.child_index.get(parent)
+        if index is not None:
+            index[ids[0]] = leaf
+        return leaf
+
+    # number of children above which the children of a node are indexed
+    index_threshold = 8
+
+    def _find_child(self, node, tid):
+        """
+        Returns the child of `node` whose label starts with
+        the token id `tid`, or -1 if there is none.
+        """
+        index = self.child_index.get(node)
+        if index is not None:
+            return index.get(tid, -1)
+        labels = self.labels
+        label_start = self.label_start
+        next_sibling = self.next_sibling
+        child = self.first_child[node]
+        scanned = 0
+        while child != -1:
+            if labels[label_start[child]] == tid:
+                return child
+            child = next_sibling[child]
+            scanned += 1
+        if scanned > self.index_threshold:
+            self.child_index[node] = {labels[label_start[c]]: c
+                                      for c in self._children(node)}
+        return -1
+
+    def _children(self, node):
+        """
+        Iterates over the children of a node.
+        """
+        child = self.first_child[node]
+        while child != -1:
+            yield child
+            child = self.next_sibling[child]
+
+    def _label(self, node):
+        """
+        Returns the label leading to a node, as a list of tokens.
+        """
+        start = self.label_start[node]
+        return self.vocabulary.decode(self.labels[start:start+self.label_length[node]])
+
+class CompactPrefTree(_CompactStructure):
+    """
+    A prefix tree with the same semantics as :class:`PrefTree`,
+    but whose nodes are stored in parallel typed arrays instead
+    of being individual Python objects. This makes it possible
+    to hold very large trees in memory, and the garbage collector
+    does not need to walk through millions of small objects.
+
+    Node `i` is described by:
+    - `url_counts[i]` and `success_counts[i]`, as in :class:`PrefTree`
+    - `first_child[i]` and `next_sibling[i]`, the offsets of its
+      first child and of its next sibling (-1 if there is none)
+    - `label_start[i]` and `label_length[i]`, the position of the
+      label of the edge leading to that node in `labels`
+    - `wildcards[i]`, set to 1 when the node is a wildcard.
+
+    The labels are stored as arrays of token ids of `vocabulary`,
+    and compared by slices. Each tree has its own vocabulary by
+    default, so that the tokens of the URLs it stores (host names,
+    ports…) are freed with it rather than accumulating in the
+    process. It only grows as new tokens are added, even when they
+    are pruned away: pickling the tree compacts it, as only the
+    tokens still used are pickled. Trees sharing the global
+    :data:`urltheory.tokenizer.vocabulary` add and match URLs encoded
+    with `prepare_url(url, encode=True)` without converting their tokens.
+    Node 0 is the root.
+
+    Children are found by scanning the list of siblings, except for
+    nodes with many children, whose children are indexed by the first
+    token id of their label in `child_index` (which is rebuilt lazily).
+
+    Nodes which are removed from the tree when it is pruned are
+    not reclaimed: their space is only freed when the tree is
+    rebuilt (for instance with :meth:`from_preftree`).
+    """
+
+    def __init__(self, count_typecode='d', vocabulary=None):
+        """
+        Creates an empty tree.
+
+        :param count_typecode: the typecode of the arrays storing
+            the counts: 'd' (float64) or 'f' (float32, which halves
+            the memory used by counts but looses precision above
+            2^24 urls).
+        :param vocabulary: the :class:`TokenVocabulary` of the labels
+            (by default, a new one is created for this tree). Arrays
+            of token ids passed to the methods are ids of this vocabulary.
+        """
+        if count_typecode not in ['d', 'f']:
+            raise ValueError('Invalid typecode for counts: %s' % count_typecode)
+        self._init_vocabulary(vocabulary)
+        self.url_counts = array(count_typecode)
+        self.success_counts = array(count_typecode)
+        self.first_child = array('i')
+        self.next_sibling = array('i')
+        self.label_start = array('I')
+        self.label_length = array('I')
+        self.wildcards = array('B')
+        self.labels = array('I')
+        self.child_index = {}
+        self._new_node(0, 0)
+
+    def node_count(self):
+        """
+        Returns the number of nodes allocated in this tree.
+        """
+        return len(self.url_counts)
+
+    def _new_node(self, label_start, label_length, url_count=0., success_count=0.):
+        """
+        Allocates a new node, without attaching it to the tree.
+        """
+        self.url_counts.append(url_count)
+        self.success_counts.append(success_count)
+        self.first_child.append(-1)
+        self.next_sibling.append(-1)
+        self.label_start.append(label_start)
+        self.label_length.append(label_length)
+        self.wildcards.append(0)
+        return len(self.url_counts) - 1
+
+    def _remaining_counts(self, node):
+        """
+        Counts of the urls ending exactly at this node.
+        """
+        url_count = self.url_counts[node]
+        success_count = self.success_counts[node]
+        for child in self._children(node):
+            url_count -= self.url_counts[child]
+            success_count -= self.success_counts[child]
+        return (url_count, success_count)
+
+    def add_url(self, url, success_count=0., url_count=1., prune_kwargs=None):
+        """
+        Adds an URL to the prefix tree. See :meth:`PrefTree.add_url`.
+        The URL can be a list of tokens or an array of token ids of
+        `vocabulary` (see :func:`urltheory.tokenizer.prepare_url`
+        for the global vocabulary). A wildcard in
+        the URL turns the node where the prefix before it ends into
+        a wildcard.
+
+        :param prune_kwargs: should we simultaneously keep the tree pruned?
+            if so, this parameter should contain the dict of parameters
+            used by prune() (passed as **kwargs).
+        """
+        success_count = float(success_count)
+        url_count = float(url_count)
+        if not url_count >= 0:
+            raise ValueError('Invalid url count, must be nonnegative')
+        if not success_count >= 0:
+            raise ValueError('Invalid success count, must be nonnegative')
+        if url_count < success_count:
+            raise ValueError('url count has to be greater than success count')
+
+        ids = url if isinstance(url, array) else self.vocabulary.encode(url)
+        wildcard = self.vocabulary.wildcard in ids
+        if wildcard:
+            # the wildcard is set at the end of the prefix,
+            # splitting a label if needed
+            ids = ids[:ids.index(self.vocabulary.wildcard)]
+        labels = self.labels
+
+        # nodes where the tree has been modified below, with their depth
+        modified = []
+        node = 0
+        pos = 0
+        n = len(ids)
+        # the node where the url ends
+        end = None
+        while True:
+            self.url_counts[node] += url_count
+            self.success_counts[node] += success_count
+            if self.wildcards[node]:
+                break
+            if pos == n:
+                end = node
+                break
+
+            modified.append((node, pos))
+            child = self._find_child(node, ids[pos])
+            if child == -1:
+                end = self._new_leaf(node, ids[pos:], url_count, success_count)
+                break
+
+            start = self.label_start[child]
+            length = self.label_length[child]
+            if labels[start:start+length] == ids[pos:pos+length]:
+                common = length
+            else:
+                common = 1
+                while (common < length and pos + common < n and
+                       labels[start+common] == ids[pos+common]):
+                    common += 1
+
+            if common < length:
+                # We need to create an intermediate internal node.
+                # The existing child becomes the intermediate node, so that
+                # it keeps its position among its siblings, and its contents
+                # are moved to a new node below it.
+                lower = self._new_node(start+common, length-common,
+                        self.url_counts[child], self.success_counts[child])
+                self.first_child[lower] = self.first_child[child]
+                if child in self.child_index:
+                    self.child_index[lower] = self.child_index.pop(child)
+                self.wildcards[lower] = self.wildcards[child]
+                self.label_length[child] = common
+                self.first_child[child] = lower
+                self.wildcards[child] = 0
+                self.url_counts[child] += url_count
+                self.success_counts[child] += success_count
+                if pos + common < n:
+                    end = self._new_leaf(child, ids[pos+common:], url_count, success_count)
+                else:
+                    end = child
+                break
+
+            pos += length
+            node = child
+
+        if wildcard and end is not None:
+            self.wildcards[end] = 1
+            self.first_child[end] = -1
+            self.child_index.pop(end, None)
+            modified.append((end, n))
+
+        if prune_kwargs is not None and modified:
+            kwargs = prune_kwargs.copy()
+            kwargs['recurse'] = False
+            kwargs.pop('depth', None)
+            if kwargs.pop('reverse', False):
+                raise ValueError('Reversing subtrees is not supported.')
+            for node, depth in modified:
+                self._prune_from(node, depth=depth, **kwargs)
+                if self.wildcards[node]:
+                    break
+
+    def confidence(self, node, smoothing, depth):
+        """
+        Returns the confidence for a node given a particular smoothing
+        strategy and its depth in the tree.
+        """
+        return proba_confidence(smoothing.evaluate(
+            self.url_counts[node], self.success_counts[node], depth))
+
+    def match(self, url):
+        """
+        Matches the URL to the tree and returns the statistics (occurrence count,
+        success count) of the end node.
+
+        :returns: a pair of integers
+        """
+        tot_count, success_count, _ = self.match_length(url)
+        return (tot_count, success_count)
+
+    def match_length(self, url):
+        """
+        Matches the URL to the tree and returns the statistics of the node,
+        plus the length of the matching prefix. See :meth:`PrefTree.match_length`.
+        The URL can be a list of tokens or an array of token ids
+        of `vocabulary`.
+        """
+        if not isinstance(url, array):
+            url = self.vocabulary.encode(url, add=False)
+        labels = self.labels
+        node = 0
+        pos = 0
+        n = len(url)
+        while True:
+            if self.wildcards[node]:
+                return (self.url_counts[node], self.success_counts[node], pos+1)
+            if pos == n:
+                url_count, success_count = self._remaining_counts(node)
+                return (url_count, success_count, pos)
+
+            child = self._find_child(node, url[pos])
+            if child == -1:
+                return (0, 0, pos+1)
+
+            start = self.label_start[child]
+            length = self.label_length[child]
+            if pos + length > n or labels[start:start+length] != url[pos:pos+length]:
+                return (0, 0, pos+1)
+
+            pos += length
+            node = child
+
+    def match_confident(self, url, smoothing, min_confidence, stop_early=False,
+                        strict=False):
+        """
+        Matches the URL to the tree, checking the confidence of the
+        nodes on the way down. See :meth:`PrefTree.match_confident`.
+        """
+        return utils.match_confident(self._descend(url), smoothing,
+                                     min_confidence, stop_early, strict)
+
+    def _descend(self, url):
+        """
+        Walks down the tree as :meth:`match_length` does, yielding the
+        counts of the nodes met on the way down. See :meth:`PrefTree._descend`.
+        """
+        if not isinstance(url, array):
+            url = self.vocabulary.encode(url, add=False)
+        labels = self.labels
+        node = 0
+        pos = 0
+        n = len(url)
+        while True:
+            if self.wildcards[node]:
+                yield (self.url_counts[node], self.success_counts[node], pos+1)
+                return
+            if pos == n:
+                yield self._remaining_counts(node) + (pos,)
+                return
+
+            child = self._find_child(node, url[pos])
+            if child == -1:
+                yield (0, 0, pos+1)
+                return
+            start = self.label_start[child]
+            length = self.label_length[child]
+            if pos + length > n or labels[start:start+length] != url[pos:pos+length]:
+                yield (0, 0, pos+1)
+                return
+
+            pos += length
+            node = child
+            yield (self.url_counts[node], self.success_counts[node], pos)
+
+    def match_many(self, urls):
+        """
+        Matches a batch of URLs: see :meth:`PrefTree.match_many`.
+        """
+        return utils.batch_match_length(self.match_length, urls)
+
+    def prune(self, smoothing=ConstantDirichlet(), depth=0, confidence_threshold=1.0, recurse=True):
+        """
+        Replaces subtrees where the confidence is higher than the
+        threshold by a wildcard, with the same url and success counts.
+        See :meth:`PrefTree.prune` (reversing subtrees is not supported).
+
+        :returns: a pair: the tree itself (for compatibility with
+            :meth:`PrefTree.prune`), and a boolean indicating whether
+            some part of the tree has been pruned
+        """
+        return (self, self._prune_from(0, smoothing, depth,
+                        confidence_threshold, recurse))
+
+    def _prune_from(self, node, smoothing=ConstantDirichlet(), depth=0,
+                    confidence_threshold=1.0, recurse=True):
+        """
+        Prunes the subtree rooted at the given node.
+        """
+        if confidence_threshold <= 0:
+            raise ValueError('The confidence threshold has to be positive.')
+
+        has_been_pruned = False
+        stack = [(node, depth)]
+        while stack:
+            node, depth = stack.pop()
+            if self.url_counts[node] == 0:
+                continue
+            if (self.first_child[node] != -1 and
+                smoothing.is_confident(self.url_counts[node], self.success_counts[node],
+                                       depth, confidence_threshold)):
+                self.wildcards[node] = 1
+                self.first_child[node] = -1
+                self.child_index.pop(node, None)
+                has_been_pruned = True
+            elif recurse:
+                for child in self._children(node):
+                    stack.append((child, depth+self.label_length[child]))
+        return has_been_pruned
+
+    def urls(self, prepend=[]):
+        """
+        Returns the list of URLs contained in the prefix tree.
+        See :meth:`PrefTree.urls`.
+        """
+        res = []
+        stack = [(0, list(prepend))]
+        while stack:
+            node, path = stack.pop()
+            if self.first_child[node] == -1:
+                if self.wildcards[node]:
+                    path = path + [utils.WildcardCharacter()]
+                res.append((path, self.url_counts[node], self.success_counts[node]))
+                continue
+            url_count, success_count = self._remaining_counts(node)
+            if url_count > 0:
+                res.append((path, url_count, success_count))
+            for child in self._children(node):
+                stack.append((child, path + self._label(child)))
+        return res
+
+    def has_wildcard(self):
+        """
+        Returns True when there is at least one wildcard in this tree.
+        """
+        stack = [0]
+        while stack:
+            node = stack.pop()
+            if self.wildcards[node]:
+                return True
+            stack.extend(self._children(node))
+        return False
+
+    def check_sanity(self):
+        """
+        Check that the tree is valid (see :meth:`PrefTree.check_sanity`).
+
+        :returns: True if the tree is valid
+        """
+        stack = [0]
+        while stack:
+            node = stack.pop()
+            children = list(self._children(node))
+
+            # 1 / Check that no children share a common prefix
+            first_tokens = set(self.labels[self.label_start[c]] for c in children)
+            if len(first_tokens) != len(children):
+                return False
+
+            # 2 / Check that the number of urls and successes are consistent
+            url_count, success_count = self._remaining_counts(node)
+            if not (url_count >= 0 and
+                    success_count >= 0 and
+                    success_count <= url_count and
+                    (node == 0 or self.url_counts[node] > 0)):
+                return False
+
+            # 3 / A wildcard has no children
+            if self.wildcards[node] and children:
+                return False
+
+            # 4 / Internal nodes have non-null labels
+            if any(self.label_length[c] == 0 for c in children):
+                return False
+
+            stack.extend(children)
+        return True
+
+    @classmethod
+    def from_preftree(cls, tree, count_typecode='d'):
+        """
+        Converts a :class:`PrefTree` to a compact tree.
+        Reversed subtrees (:class:`RevPrefTree`) are not supported.
+        """
+        compact = cls(count_typecode=count_typecode)
+        stack = [(tree, 0)]
+        while stack:
+            subtree, node = stack.pop()
+            if isinstance(subtree, RevPrefTree):
+                raise ValueError('Reversed subtrees cannot be converted.')
+            compact.url_counts[node] = subtree.url_count
+            compact.success_counts[node] = subtree.success_count
+            compact.wildcards[node] = int(subtree.is_wildcard)
+            for key, child in list(subtree.children.items()):
+                if not len(key):
+                    # empty labels only store remaining counts
+                    continue
+                child_node = compact._new_leaf(node, compact.vocabulary.encode(key), 0., 0.)
+                stack.append((child, child_node))
+        return compact
+
+    def to_preftree(self):
+        """
+        Converts this tree back to a :class:`PrefTree`
+        (for instance, to inspect it with :meth:`PrefTree.print_as_tree`).
+        """
+        root = PrefTree()
+        stack = [(0, root)]
+        while stack:
+            node, subtree = stack.pop()
+            subtree.url_count = self.url_counts[node]
+            subtree.success_count = self.success_counts[node]
+            subtree.is_wildcard = bool(self.wildcards[node])
+            for child in self._children(node):
+                child_tree = PrefTree()
+                subtree[self._label(child)] = child_tree
+                stack.append((child, child_tree))
+        return root
+
+    def print_as_tree(self, *args, **kwargs):
+        """
+        Prints the tree as it is stored
+        """
+        self.to_preftree().print_as_tree(*args, **kwargs)
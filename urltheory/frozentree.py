@@ -0,0 +1,594 @@
+# -*- encoding: utf-8 -*-
+
+from array import array
+from bisect import bisect_left
+import itertools
+import numpy
+
+from urltheory import utils
+from urltheory.preftree import RevPrefTree
+from urltheory.utils import proba_confidence_many
+
+# token id used for tokens which cannot be matched by any URL
+unmatchable_token_id = 0xFFFFFFFF
+# token id given to tokens of URLs which do not appear in the tree
+unknown_token_id = 0xFFFFFFFE
+
+def encode_token(token):
+    """
+    Encodes a token as bytes, so that tokens can be sorted
+    and stored. Returns None for tokens which are neither
+    strings nor integers (these cannot be matched).
+
+    >>> encode_token('a')
+    b'\\x01a'
+    >>> encode_token(0)
+    b'\\x000'
+    """
+    if type(token) == str:
+        return b'\x01' + token.encode('utf-8')
+    elif type(token) == int:
+        return b'\x00' + str(token).encode('ascii')
+
+def decode_token(encoded):
+    """
+    Inverse of :func:`encode_token`.
+
+    >>> decode_token(encode_token(0))
+    0
+    >>> decode_token(encode_token('.org'))
+    '.org'
+    """
+    if encoded[:1] == b'\x00':
+        return int(encoded[1:].decode('ascii'))
+    return encoded[1:].decode('utf-8')
+
+class TokenTable(object):
+    """
+    A sorted table of encoded tokens (see :func:`encode_token`),
+    stored as the concatenation `blob` of the encoded tokens and
+    the array of their `offsets` (plus a final offset). Token ids
+    are found by binary search, so the table can be used directly
+    from a memory-mapped file, without building a dictionary of
+    all the tokens. The tokens looked up recently are cached.
+
+    >>> table = TokenTable.from_tokens(['a', 'b', 0])
+    >>> table.get('b'), table.get(0), table.get('c')
+    (2, 0, None)
+    >>> list(table)
+    [0, 'a', 'b']
+    """
+    cache_size = 100000
+
+    def __init__(self, offsets, blob):
+        self.offsets = offsets
+        self.blob = blob
+        self._ids = {}
+        self._tokens = {}
+
+    @classmethod
+    def from_tokens(cls, tokens):
+        """
+        Builds a table from a list of tokens.
+        """
+        encoded = sorted(set(encode_token(t) for t in tokens) - {None})
+        offsets = array('Q', [0])
+        for e in encoded:
+            offsets.append(offsets[-1] + len(e))
+        return cls(offsets, b''.join(encoded))
+
+    def encoded(self, idx):
+        """
+        Returns the encoded token with the given id.
+        """
+        return bytes(self.blob[self.offsets[idx]:self.offsets[idx+1]])
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx):
+        if not 0 <= idx < len(self):
+            raise IndexError('token id out of range')
+        token = self._tokens.get(idx)
+        if token is None:
+            if len(self._tokens) >= self.cache_size:
+                self._tokens.clear()
+            token = decode_token(self.encoded(idx))
+            self._tokens[idx] = token
+        return token
+
+    def get(self, token, default=None):
+        """
+        Returns the id of a token, or `default` if it is not in the table.
+        """
+        idx = self._ids.get(token)
+        if idx is None:
+            if len(self._ids) >= self.cache_size:
+                self._ids.clear()
+            idx = self._search(encode_token(token))
+            self._ids[token] = idx
+        return default if idx == -1 else idx
+
+    def _search(self, encoded):
+        """
+        Binary search of an encoded token, returning its id or -1.
+        """
+        if encoded is None:
+            return -1
+        lo = 0
+        hi = len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.encoded(mid) < encoded:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(self) and self.encoded(lo) == encoded:
+            return lo
+        return -1
+
+class LabelTokens(object):
+    """
+    The tokens of the labels of a :class:`FrozenPrefTree`, decoded
+    lazily from the token ids in `labels`. Ids which do not belong
+    to the tokens (such as `unmatchable_token_id`) are decoded
+    to an object which is not equal to any token.
+    """
+    def __init__(self, labels, tokens):
+        self.labels = labels
+        self.tokens = tokens
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self._token(i) for i in self.labels[idx]]
+        return self._token(self.labels[idx])
+
+    def _token(self, token_id):
+        if token_id < len(self.tokens):
+            return self.tokens[token_id]
+        return object()
+
+class FrozenPrefTree(object):
+    """
+    An immutable, compiled version of a :class:`PrefTree`,
+    obtained with :meth:`PrefTree.freeze`. It answers
+    :meth:`match_length` like the original tree, but cannot be
+    modified, so it does not need any lock.
+
+    The nodes are numbered in breadth-first order, so that the
+    children of a node are contiguous, sorted by the id of
+    the first token of their label. Node `i` is described by:
+    - `url_counts[i]` and `success_counts[i]`, as in :class:`PrefTree`
+    - `end_url_counts[i]` and `end_success_counts[i]`, the counts
+      of the URLs ending exactly at that node
+    - `wildcards[i]`, set to 1 for wildcards
+    - `reversed[i]`, set to 1 when the subtree rooted at that node is
+      a :class:`RevPrefTree`
+    - `child_start[i]`: its children are the nodes from `child_start[i]`
+      to `child_start[i+1]` (excluded)
+    - `label_start[i]`: the label of the edge leading to that node is
+      `labels[label_start[i]:label_start[i+1]]`, and `first_tokens[i]`
+      is its first token.
+    Labels are stored as token ids, allocated in the order of the
+    encoded tokens (see :func:`encode_token`) and listed in `tokens`.
+    The tokens themselves are also kept in `label_tokens`, parallel
+    to `labels`, so that the remainder of a label can be compared
+    to the URL in one step.
+
+    The arrays can also be memoryviews of a memory-mapped file
+    (see :meth:`from_arrays`), in which case the tokens are
+    a :class:`TokenTable`.
+
+    When the tree is frozen with a smoothing strategy, the smoothed
+    probability of the answer returned when a URL ends at each node
+    is stored in `probas`, and its confidence in `confidences`.
+    """
+    read_only = True
+
+    # the arrays describing the tree, with their type codes
+    array_types = [
+        ('url_counts', 'd'),
+        ('success_counts', 'd'),
+        ('end_url_counts', 'd'),
+        ('end_success_counts', 'd'),
+        ('wildcards', 'B'),
+        ('reversed', 'B'),
+        ('child_start', 'I'),
+        ('label_start', 'I'),
+        ('first_tokens', 'I'),
+        ('labels', 'I'),
+        ('probas', 'd'),
+        ('confidences', 'd'),
+    ]
+
+    def __init__(self, tree, smoothing=None):
+        """
+        Compiles a tree.
+
+        :param tree: the :class:`PrefTree` to compile
+        :param smoothing: if provided, the smoothing strategy used to
+            precompute probabilities for :meth:`match_proba`.
+        """
+        # allocate the token ids
+        encoded = set()
+        stack = [tree]
+        while stack:
+            node = stack.pop()
+            for key, child in list(node.children.items()):
+                encoded.update(encode_token(token) for token in key)
+                stack.append(child)
+        encoded.discard(None)
+        self.tokens = [decode_token(e) for e in sorted(encoded)]
+        self.token_ids = {t: i for i, t in enumerate(self.tokens)}
+
+        self.url_counts = array('d')
+        self.success_counts = array('d')
+        self.end_url_counts = array('d')
+        self.end_success_counts = array('d')
+        self.wildcards = array('B')
+        self.reversed = array('B')
+        self.child_start = array('I')
+        self.label_start = array('I')
+        self.first_tokens = array('I')
+        self.labels = array('I')
+        self.label_tokens = []
+        self.probas = array('d') if smoothing is not None else None
+        self.confidences = array('d') if smoothing is not None else None
+
+        depths = []
+
+        # breadth-first traversal: (node, label, label ids, depth)
+        queue = [(tree, [], [], 0)]
+        idx = 0
+        while idx < len(queue):
+            node, label, label_ids, depth = queue[idx]
+            queue[idx] = None
+            idx += 1
+
+            children = []
+            end_url_count = node.url_count
+            end_success_count = node.success_count
+            for key, child in list(node.children.items()):
+                end_url_count -= child.url_count
+                end_success_count -= child.success_count
+                if len(key):
+                    ids = [self.token_ids.get(t, unmatchable_token_id) for t in key]
+                    children.append((key, ids, child))
+            children.sort(key=lambda c: c[1][0])
+
+            self.url_counts.append(node.url_count)
+            self.success_counts.append(node.success_count)
+            self.end_url_counts.append(end_url_count)
+            self.end_success_counts.append(end_success_count)
+            self.wildcards.append(int(node.is_wildcard))
+            self.reversed.append(int(isinstance(node, RevPrefTree)))
+            self.child_start.append(len(queue))
+            self.label_start.append(len(self.labels))
+            self.first_tokens.append(label_ids[0] if label_ids else 0)
+            self.labels.extend(label_ids)
+            self.label_tokens.extend(label)
+
+            if smoothing is not None:
+                depths.append(depth+1 if node.is_wildcard else depth)
+
+            for key, ids, child in children:
+                queue.append((child, key, ids, depth+len(ids)))
+
+        self.child_start.append(len(queue))
+        self.label_start.append(len(self.labels))
+
+        if smoothing is not None:
+            # wildcards have no children, so their end counts are their counts
+            with numpy.errstate(divide='ignore', invalid='ignore'):
+                probas = smoothing.evaluate_many(self.end_url_counts,
+                                    self.end_success_counts, depths)
+            self.probas = array('d', probas.tolist())
+            self.confidences = array('d', proba_confidence_many(probas).tolist())
+
+    @classmethod
+    def from_arrays(cls, arrays, tokens):
+        """
+        Rebuilds a frozen tree from its arrays, without compiling it again.
+
+        :param arrays: a dictionary from the names in `array_types` to
+            sequences of the corresponding types, such as arrays or
+            memoryviews. `probas` and `confidences` can be omitted.
+        :param tokens: the list of tokens, or a :class:`TokenTable`
+        """
+        tree = cls.__new__(cls)
+        for name, typecode in cls.array_types:
+            setattr(tree, name, arrays.get(name))
+        tree._set_tokens(tokens)
+        return tree
+
+    def _set_tokens(self, tokens):
+        """
+        Sets the tokens and the structures derived from them.
+        """
+        self.tokens = tokens
+        if isinstance(tokens, TokenTable):
+            self.token_ids = tokens
+            self.label_tokens = LabelTokens(self.labels, tokens)
+        else:
+            self.token_ids = {t: i for i, t in enumerate(tokens)}
+            self.label_tokens = list(LabelTokens(self.labels, tokens)[:])
+
+    def __getstate__(self):
+        """
+        Pickles the arrays (copying memoryviews) and the tokens only.
+        """
+        state = dict(self.__dict__)
+        del state['token_ids']
+        del state['label_tokens']
+        state.pop('_keys', None)
+        for name, typecode in self.array_types:
+            if state[name] is not None and not isinstance(state[name], array):
+                state[name] = array(typecode, bytes(state[name]))
+        state['tokens'] = list(self.tokens)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._set_tokens(self.tokens)
+
+    def node_count(self):
+        """
+        Returns the number of nodes in this tree.
+        """
+        return len(self.url_counts)
+
+    def add_url(self, *args, **kwargs):
+        raise ValueError('A frozen tree cannot be modified.')
+
+    def _lookup(self, url):
+        """
+        Walks down the tree, returning the node where the url ends,
+        the length of the matching prefix and whether the url matched.
+        """
+        if not isinstance(url, list):
+            url = list(url)
+        if self.reversed[0]:
+            url = url[::-1]
+        node = 0
+        base = 0
+        pos = 0
+        n = len(url)
+        get_id = self.token_ids.get
+        wildcards = self.wildcards
+        first_tokens = self.first_tokens
+        label_tokens = self.label_tokens
+        label_start = self.label_start
+        child_start = self.child_start
+        while not wildcards[node]:
+            if pos == n:
+                return (node, base+pos, True)
+
+            tid = get_id(url[pos], unknown_token_id)
+            hi = child_start[node+1]
+            child = bisect_left(first_tokens, tid, child_start[node], hi)
+            if child == hi or first_tokens[child] != tid:
+                return (node, base+pos+1, False)
+
+            start = label_start[child]
+            length = label_start[child+1] - start
+            if length > 1 and (pos + length > n or
+                    label_tokens[start+1:start+length] != url[pos+1:pos+length]):
+                return (node, base+pos+1, False)
+
+            pos += length
+            node = child
+            if self.reversed[node]:
+                # reversed subtrees match the end of the url
+                base += pos
+                url = url[:pos-1:-1] if pos else url[::-1]
+                n = len(url)
+                pos = 0
+
+        return (node, base+pos+1, True)
+
+    def match(self, url):
+        """
+        Matches the URL to the tree and returns the statistics (occurrence count,
+        success count) of the end node. See :meth:`PrefTree.match`.
+        """
+        tot_count, success_count, _ = self.match_length(url)
+        return (tot_count, success_count)
+
+    def match_length(self, url):
+        """
+        Matches the URL to the tree and returns the statistics of the node,
+        plus the length of the matching prefix. See :meth:`PrefTree.match_length`.
+        """
+        node, length, matched = self._lookup(url)
+        if not matched:
+            return (0, 0, length)
+        if self.wildcards[node]:
+            return (self.url_counts[node], self.success_counts[node], length)
+        return (self.end_url_counts[node], self.end_success_counts[node], length)
+
+    def match_confident(self, url, smoothing, min_confidence, stop_early=False,
+                        strict=False):
+        """
+        Matches the URL to the tree, checking the confidence of the
+        nodes on the way down. See :meth:`PrefTree.match_confident`.
+        """
+        return utils.match_confident(self._descend(url), smoothing,
+                                     min_confidence, stop_early, strict)
+
+    def _descend(self, url):
+        """
+        Walks down the tree as :meth:`_lookup` does, yielding the
+        counts of the nodes met on the way down. See :meth:`PrefTree._descend`.
+        """
+        if not isinstance(url, list):
+            url = list(url)
+        if self.reversed[0]:
+            url = url[::-1]
+        node = 0
+        base = 0
+        pos = 0
+        n = len(url)
+        get_id = self.token_ids.get
+        url_counts = self.url_counts
+        success_counts = self.success_counts
+        first_tokens = self.first_tokens
+        label_tokens = self.label_tokens
+        label_start = self.label_start
+        child_start = self.child_start
+        while True:
+            if self.wildcards[node]:
+                yield (url_counts[node], success_counts[node], base+pos+1)
+                return
+            if pos == n:
+                yield (self.end_url_counts[node], self.end_success_counts[node], base+pos)
+                return
+
+            tid = get_id(url[pos], unknown_token_id)
+            hi = child_start[node+1]
+            child = bisect_left(first_tokens, tid, child_start[node], hi)
+            if child == hi or first_tokens[child] != tid:
+                yield (0, 0, base+pos+1)
+                return
+            start = label_start[child]
+            length = label_start[child+1] - start
+            if length > 1 and (pos + length > n or
+                    label_tokens[start+1:start+length] != url[pos+1:pos+length]):
+                yield (0, 0, base+pos+1)
+                return
+
+            pos += length
+            node = child
+            yield (url_counts[node], success_counts[node], base+pos)
+            if self.reversed[node]:
+                # reversed subtrees match the end of the url
+                base += pos
+                url = url[:pos-1:-1] if pos else url[::-1]
+                n = len(url)
+                pos = 0
+
+    def match_many(self, urls):
+        """
+        Matches a batch of URLs: see :meth:`PrefTree.match_many`.
+
+        Unlike the other trees, all the URLs are walked down together,
+        one level of the tree at a time, with NumPy operations on
+        the whole batch: the children are looked up with a single
+        binary search (see :meth:`_child_keys`) and the labels are
+        compared token by token for all the URLs at once. Only the
+        tokens are converted to ids in Python. The URLs reaching
+        reversed subtrees are finished one by one.
+
+        :param urls: an iterable of tokenized URLs
+        :returns: a triple of NumPy arrays: the url counts,
+            the success counts and the lengths of the matching prefixes
+        """
+        urls = [url if isinstance(url, list) else list(url) for url in urls]
+        if self.reversed[0]:
+            urls = [url[::-1] for url in urls]
+        nb_urls = len(urls)
+        sizes = numpy.fromiter(map(len, urls), dtype=numpy.intp, count=nb_urls)
+        offsets = numpy.zeros(nb_urls, dtype=numpy.intp)
+        numpy.cumsum(sizes[:-1], out=offsets[1:])
+        ids = numpy.fromiter(map(self.token_ids.get, itertools.chain.from_iterable(urls),
+                                 itertools.repeat(unknown_token_id)),
+                             dtype=numpy.uint64, count=int(sizes.sum()))
+
+        url_counts = numpy.frombuffer(self.url_counts, dtype=numpy.float64)
+        success_counts = numpy.frombuffer(self.success_counts, dtype=numpy.float64)
+        end_url_counts = numpy.frombuffer(self.end_url_counts, dtype=numpy.float64)
+        end_success_counts = numpy.frombuffer(self.end_success_counts, dtype=numpy.float64)
+        wildcards = numpy.frombuffer(self.wildcards, dtype=numpy.uint8)
+        reversed_nodes = numpy.frombuffer(self.reversed, dtype=numpy.uint8)
+        label_start = numpy.frombuffer(self.label_start, dtype=numpy.uint32).astype(numpy.intp)
+        labels = numpy.frombuffer(self.labels, dtype=numpy.uint32)
+        keys = self._child_keys()
+
+        res_counts = numpy.zeros(nb_urls)
+        res_successes = numpy.zeros(nb_urls)
+        res_lengths = numpy.zeros(nb_urls, dtype=numpy.intp)
+        # the URLs still walking down, with their node and position
+        active = numpy.arange(nb_urls)
+        node = numpy.zeros(nb_urls, dtype=numpy.intp)
+        pos = numpy.zeros(nb_urls, dtype=numpy.intp)
+        while active.size:
+            wild = wildcards[node] != 0
+            done = active[wild]
+            res_counts[done] = url_counts[node[wild]]
+            res_successes[done] = success_counts[node[wild]]
+            res_lengths[done] = pos[wild] + 1
+            ended = ~wild & (pos == sizes[active])
+            done = active[ended]
+            res_counts[done] = end_url_counts[node[ended]]
+            res_successes[done] = end_success_counts[node[ended]]
+            res_lengths[done] = pos[ended]
+            going = ~(wild | ended)
+            active, node, pos = active[going], node[going], pos[going]
+
+            # look up the child starting with the next token
+            start = offsets[active] + pos
+            wanted = (node.astype(numpy.uint64) << numpy.uint64(32)) | ids[start]
+            child = numpy.searchsorted(keys, wanted)
+            found = keys[numpy.minimum(child, len(keys)-1)] == wanted if len(keys) else \
+                    numpy.zeros(active.size, dtype=bool)
+            # children are numbered from 1, in the order of their keys
+            child += 1
+            child[~found] = 0
+            label = label_start[child]
+            label_length = label_start[child+1] - label
+            matched = found & (pos + label_length <= sizes[active])
+            for k in range(1, int(label_length[matched].max(initial=0))):
+                check = matched & (label_length > k)
+                matched[check] = ids[start[check]+k] == labels[label[check]+k]
+            res_lengths[active[~matched]] = pos[~matched] + 1
+            active, node, pos = active[matched], child[matched], (pos + label_length)[matched]
+
+            # reversed subtrees match the end of the url
+            rev = reversed_nodes[node] != 0
+            for idx in active[rev]:
+                res_counts[idx], res_successes[idx], res_lengths[idx] = \
+                        self.match_length(urls[idx][::-1] if self.reversed[0] else urls[idx])
+            going = ~rev
+            active, node, pos = active[going], node[going], pos[going]
+
+        return (res_counts, res_successes, res_lengths)
+
+    def _child_keys(self):
+        """
+        Returns the sorted array of the keys of the nodes (the root
+        excepted): `(parent << 32) | first_token`, where `parent` is
+        the parent of the node and `first_token` the id of the
+        first token of its label. As the children of a node are
+        contiguous and sorted by first token, node `i` has key
+        number `i-1`. The array is computed once.
+        """
+        keys = getattr(self, '_keys', None)
+        if keys is None:
+            child_start = numpy.frombuffer(self.child_start, dtype=numpy.uint32)
+            nb_nodes = self.node_count()
+            parents = numpy.repeat(numpy.arange(nb_nodes, dtype=numpy.uint64),
+                                   numpy.diff(child_start.astype(numpy.intp)))
+            first_tokens = numpy.frombuffer(self.first_tokens, dtype=numpy.uint32)
+            keys = (parents << numpy.uint64(32)) | first_tokens[1:].astype(numpy.uint64)
+            self._keys = keys
+        return keys
+
+    def match_proba(self, url):
+        """
+        Returns the precomputed smoothed probability for this URL and
+        its confidence, together with the length of the matching prefix,
+        or None if the URL does not match any URL of the tree.
+        This requires the tree to be frozen with a smoothing strategy.
+
+        :returns: a triple: (probability, confidence, length)
+        """
+        if self.probas is None:
+            raise ValueError('The tree was frozen without smoothing.')
+        node, length, matched = self._lookup(url)
+        if not matched:
+            return None
+        if not self.wildcards[node] and not self.end_url_counts[node]:
+            return None
+        return (self.probas[node], self.confidences[node], length)
@@ -0,0 +1,549 @@
+# -*- encoding: utf-8 -*-
+
+from array import array
+
+import numpy
+
+from urltheory import utils
+from urltheory.compacttree import _CompactStructure
+from urltheory.preftree import PrefTree
+from urltheory.preftree import RevPrefTree
+
+class JointPrefTree(_CompactStructure):
+    """
+    A prefix tree storing the URLs of several classes at once
+    (for instance `pdf` and `custom`), so that the prefixes they
+    share are stored once, and a URL can be matched against all
+    the classes in a single traversal (see :meth:`match_all`).
+
+    The structure of the tree is stored as in :class:`CompactPrefTree`
+    (the two classes share it), but each node holds a vector of counts, indexed by the position
+    of the class in `classes`: the counts of class `k` at node `i` are
+    `url_counts[i*K + k]` and `success_counts[i*K + k]`, where `K`
+    is the number of classes. Wildcards are also set per class, in
+    `wildcards`: a wildcard of one class does not stop the URLs of
+    the other classes.
+
+    For each class, the counts and lengths returned when matching an
+    URL are the same as with a :class:`PrefTree` built from the URLs
+    of that class only. The URLs of the other classes split the labels
+    of that tree into several nodes: the nodes where the URLs of the
+    class neither end nor branch are skipped (see :meth:`_is_node_of`).
+
+    As its methods take the class as first argument, a joint tree
+    cannot stand in for a :class:`CompactPrefTree`: use
+    :meth:`class_view` to get the tree of a single class.
+
+    Joint trees cannot be pruned or contain reversed subtrees:
+    they are meant to be built from trees which have already been
+    pruned, with :meth:`from_preftrees`.
+    """
+
+    def __init__(self, class_ids=None, count_typecode='d', vocabulary=None):
+        """
+        Creates an empty tree.
+
+        :param class_ids: the classes to allocate counts for (other
+            classes are added when URLs are added to them)
+        :param count_typecode: see :class:`CompactPrefTree`
+        :param vocabulary: see :class:`CompactPrefTree`
+        """
+        if count_typecode not in ['d', 'f']:
+            raise ValueError('Invalid typecode for counts: %s' % count_typecode)
+        self._init_vocabulary(vocabulary)
+        self.classes = []
+        self.class_index = {}
+        self.url_counts = array(count_typecode)
+        self.success_counts = array(count_typecode)
+        self.first_child = array('i')
+        self.next_sibling = array('i')
+        self.label_start = array('I')
+        self.label_length = array('I')
+        self.wildcards = array('B')
+        self.labels = array('I')
+        self.child_index = {}
+        self._new_node(0, 0)
+        for class_id in class_ids or []:
+            self.add_class(class_id)
+
+    def add_class(self, class_id):
+        """
+        Allocates the counts of a new class (if needed)
+        and returns its position in the count vectors.
+        """
+        k = self.class_index.get(class_id)
+        if k is not None:
+            return k
+        k = len(self.classes)
+        nodes = self.node_count()
+        for name in ['url_counts', 'success_counts', 'wildcards']:
+            old = getattr(self, name)
+            new = array(old.typecode, bytes(old.itemsize*nodes*(k+1)))
+            for i in range(k):
+                new[i::k+1] = old[i::k]
+            setattr(self, name, new)
+        self.classes.append(class_id)
+        self.class_index[class_id] = k
+        return k
+
+    def _class(self, class_id):
+        """
+        Returns the position of a class in the count vectors.
+        """
+        k = self.class_index.get(class_id)
+        if k is None:
+            raise ValueError('Unknown class: %s' % class_id)
+        return k
+
+    def node_count(self):
+        """
+        Returns the number of nodes allocated in this tree.
+        """
+        return len(self.first_child)
+
+    def _new_node(self, label_start, label_length):
+        """
+        Allocates a new node, without attaching it to the tree.
+        Its counts are zero for all classes.
+        """
+        nb_classes = len(self.classes)
+        self.url_counts.extend([0.]*nb_classes)
+        self.success_counts.extend([0.]*nb_classes)
+        self.wildcards.extend([0]*nb_classes)
+        self.first_child.append(-1)
+        self.next_sibling.append(-1)
+        self.label_start.append(label_start)
+        self.label_length.append(label_length)
+        return len(self.first_child) - 1
+
+    def _split(self, node, common):
+        """
+        Cuts the label leading to a node after `common` tokens: the
+        node keeps the beginning of the label, and its contents are
+        moved to a new node below it, labelled by the rest.
+        """
+        nb_classes = len(self.classes)
+        start = self.label_start[node]
+        lower = self._new_node(start+common, self.label_length[node]-common)
+        base = node*nb_classes
+        lower_base = lower*nb_classes
+        self.url_counts[lower_base:lower_base+nb_classes] = self.url_counts[base:base+nb_classes]
+        self.success_counts[lower_base:lower_base+nb_classes] = self.success_counts[base:base+nb_classes]
+        self.wildcards[lower_base:lower_base+nb_classes] = self.wildcards[base:base+nb_classes]
+        self.wildcards[base:base+nb_classes] = array('B', bytes(nb_classes))
+        self.first_child[lower] = self.first_child[node]
+        if node in self.child_index:
+            self.child_index[lower] = self.child_index.pop(node)
+        self.first_child[node] = lower
+        self.label_length[node] = common
+
+    def add_url(self, class_id, url, success_count=0., url_count=1.):
+        """
+        Adds an URL of a class to the tree. See :meth:`PrefTree.add_url`.
+        The URL can be a list of tokens or an array of token ids. A list
+        ending with a :class:`urltheory.utils.WildcardCharacter` adds
+        a wildcard for this class.
+        """
+        success_count = float(success_count)
+        url_count = float(url_count)
+        if not url_count >= 0:
+            raise ValueError('Invalid url count, must be nonnegative')
+        if not success_count >= 0:
+            raise ValueError('Invalid success count, must be nonnegative')
+        if url_count < success_count:
+            raise ValueError('url count has to be greater than success count')
+
+        ids = url if isinstance(url, array) else self.vocabulary.encode(url)
+        wildcard = self.vocabulary.wildcard in ids
+        if wildcard:
+            # the wildcard is set at the end of the prefix,
+            # splitting the labels of the other classes if needed
+            ids = ids[:ids.index(self.vocabulary.wildcard)]
+        k = self.add_class(class_id)
+        nb_classes = len(self.classes)
+        labels = self.labels
+
+        node = 0
+        pos = 0
+        n = len(ids)
+        while True:
+            idx = node*nb_classes + k
+            self.url_counts[idx] += url_count
+            self.success_counts[idx] += success_count
+            if self.wildcards[idx]:
+                return
+            if pos == n:
+                break
+
+            child = self._find_child(node, ids[pos])
+            if child == -1:
+                node = self._new_leaf(node, ids[pos:])
+                pos = n
+                continue
+
+            start = self.label_start[child]
+            length = self.label_length[child]
+            if labels[start:start+length] == ids[pos:pos+length]:
+                common = length
+            else:
+                common = 1
+                while (common < length and pos + common < n and
+                       labels[start+common] == ids[pos+common]):
+                    common += 1
+                self._split(child, common)
+            pos += common
+            node = child
+
+        if wildcard:
+            self.wildcards[node*nb_classes + k] = 1
+            self._clear_class(node, k)
+
+    def _clear_class(self, node, k):
+        """
+        Removes the urls of class `k` below a node (the nodes
+        are kept, as they can be used by other classes).
+        """
+        nb_classes = len(self.classes)
+        stack = list(self._children(node))
+        while stack:
+            node = stack.pop()
+            idx = node*nb_classes + k
+            if self.url_counts[idx] or self.wildcards[idx]:
+                self.url_counts[idx] = 0.
+                self.success_counts[idx] = 0.
+                self.wildcards[idx] = 0
+                stack.extend(self._children(node))
+
+    def _remaining_counts(self, node, k):
+        """
+        Counts of the urls of class `k` ending exactly at this node.
+        """
+        nb_classes = len(self.classes)
+        url_count = self.url_counts[node*nb_classes + k]
+        success_count = self.success_counts[node*nb_classes + k]
+        for child in self._children(node):
+            url_count -= self.url_counts[child*nb_classes + k]
+            success_count -= self.success_counts[child*nb_classes + k]
+        return (url_count, success_count)
+
+    def _is_node_of(self, node, k):
+        """
+        Returns True when the node is also a node of the tree of class
+        `k` alone: the root, a wildcard, or a node where URLs of the
+        class end or branch. The other nodes are in the middle of the
+        labels of that tree.
+        """
+        nb_classes = len(self.classes)
+        idx = node*nb_classes + k
+        if not node or self.wildcards[idx]:
+            return True
+        url_count = self.url_counts[idx]
+        live = 0
+        for child in self._children(node):
+            idx = child*nb_classes + k
+            if self.url_counts[idx] or self.wildcards[idx]:
+                url_count -= self.url_counts[idx]
+                live += 1
+        return live != 1 or url_count > 0
+
+    def _descend(self, k, url):
+        """
+        Matches the URL against the URLs of class `k`, yielding the counts
+        of the nodes met on the way down. See :meth:`PrefTree._descend`.
+        """
+        if not isinstance(url, array):
+            url = self.vocabulary.encode(url, add=False)
+        nb_classes = len(self.classes)
+        url_counts = self.url_counts
+        success_counts = self.success_counts
+        wildcards = self.wildcards
+        labels = self.labels
+        node = 0
+        pos = 0
+        # the length of the prefix leading to the last node of class k
+        last = 0
+        n = len(url)
+        while True:
+            idx = node*nb_classes + k
+            if wildcards[idx]:
+                yield (url_counts[idx], success_counts[idx], pos+1)
+                return
+            if pos == n:
+                if last == pos:
+                    yield self._remaining_counts(node, k) + (pos,)
+                else:
+                    yield (0, 0, last+1)
+                return
+
+            child = self._find_child(node, url[pos])
+            idx = child*nb_classes + k
+            if child == -1 or not (url_counts[idx] or wildcards[idx]):
+                yield (0, 0, last+1)
+                return
+            start = self.label_start[child]
+            length = self.label_length[child]
+            if pos + length > n or labels[start:start+length] != url[pos:pos+length]:
+                yield (0, 0, last+1)
+                return
+
+            pos += length
+            node = child
+            if self._is_node_of(node, k):
+                last = pos
+                yield (url_counts[idx], success_counts[idx], pos)
+
+    def match(self, class_id, url):
+        """
+        Matches the URL to the URLs of a class and returns the statistics
+        (occurrence count, success count) of the end node.
+        """
+        tot_count, success_count, _ = self.match_length(class_id, url)
+        return (tot_count, success_count)
+
+    def match_length(self, class_id, url):
+        """
+        Matches the URL to the URLs of a class and returns the statistics
+        of the node, plus the length of the matching prefix.
+        See :meth:`PrefTree.match_length`.
+        """
+        for counts in self._descend(self._class(class_id), url):
+            pass
+        return counts
+
+    def match_many(self, class_id, urls):
+        """
+        Matches a batch of URLs: see :meth:`PrefTree.match_many`.
+        """
+        return utils.batch_match_length(lambda url: self.match_length(class_id, url), urls)
+
+    def match_confident(self, class_id, url, smoothing, min_confidence,
+                        stop_early=False, strict=False):
+        """
+        Matches the URL to the URLs of a class, checking the confidence
+        of the nodes on the way down. See :meth:`PrefTree.match_confident`.
+        """
+        return utils.match_confident(self._descend(self._class(class_id), url),
+                                     smoothing, min_confidence, stop_early, strict)
+
+    def match_all(self, url):
+        """
+        Matches the URL to the URLs of all classes at once, walking
+        down the tree only once.
+
+        :returns: a triple of NumPy arrays, indexed as `classes`:
+            the url counts, the success counts and the lengths of the
+            matching prefixes (see :meth:`match_length`)
+        """
+        if not isinstance(url, array):
+            url = self.vocabulary.encode(url, add=False)
+        nb_classes = len(self.classes)
+        labels = self.labels
+        # the nodes on the path of the url, with the length of their prefix
+        path = [(0, 0)]
+        node = 0
+        pos = 0
+        n = len(url)
+        ended = False
+        while True:
+            if pos == n:
+                ended = True
+                break
+            child = self._find_child(node, url[pos])
+            if child == -1:
+                break
+            start = self.label_start[child]
+            length = self.label_length[child]
+            if pos + length > n or labels[start:start+length] != url[pos:pos+length]:
+                break
+            pos += length
+            node = child
+            path.append((node, pos))
+
+        url_counts = numpy.zeros(nb_classes)
+        success_counts = numpy.zeros(nb_classes)
+        lengths = numpy.zeros(nb_classes, dtype=numpy.intp)
+        for k in range(nb_classes):
+            # the length of the prefix leading to the last node of class k
+            last = 0
+            for node, pos in path:
+                idx = node*nb_classes + k
+                if self.wildcards[idx]:
+                    url_counts[k] = self.url_counts[idx]
+                    success_counts[k] = self.success_counts[idx]
+                    lengths[k] = pos+1
+                    break
+                if node and not self.url_counts[idx]:
+                    # the url leaves the urls of this class
+                    lengths[k] = last+1
+                    break
+                if node and self._is_node_of(node, k):
+                    last = pos
+            else:
+                node, pos = path[-1]
+                if ended and last == pos:
+                    url_counts[k], success_counts[k] = self._remaining_counts(node, k)
+                    lengths[k] = pos
+                else:
+                    lengths[k] = last+1
+        return (url_counts, success_counts, lengths)
+
+    def urls(self, class_id, prepend=[]):
+        """
+        Returns the list of URLs of a class contained in the tree,
+        with their counts (wildcards are marked as in
+        :meth:`PrefTree.urls`).
+        """
+        k = self._class(class_id)
+        nb_classes = len(self.classes)
+        res = []
+        stack = [(0, list(prepend))]
+        while stack:
+            node, path = stack.pop()
+            idx = node*nb_classes + k
+            if self.wildcards[idx]:
+                res.append((path + [utils.WildcardCharacter()],
+                            self.url_counts[idx], self.success_counts[idx]))
+                continue
+            url_count, success_count = self._remaining_counts(node, k)
+            if url_count > 0:
+                res.append((path, url_count, success_count))
+            for child in self._children(node):
+                if self.url_counts[child*nb_classes + k]:
+                    stack.append((child, path + self._label(child)))
+        return res
+
+    def has_wildcard(self):
+        """
+        Returns True when there is at least one wildcard in this tree.
+        """
+        return any(self.wildcards)
+
+    def check_sanity(self):
+        """
+        Check that the tree is valid (see :meth:`PrefTree.check_sanity`),
+        for each class.
+
+        :returns: True if the tree is valid
+        """
+        nb_classes = len(self.classes)
+        stack = [0]
+        while stack:
+            node = stack.pop()
+            children = list(self._children(node))
+            first_tokens = set(self.labels[self.label_start[c]] for c in children)
+            if len(first_tokens) != len(children):
+                return False
+            if any(self.label_length[c] == 0 for c in children):
+                return False
+            for k in range(nb_classes):
+                url_count, success_count = self._remaining_counts(node, k)
+                if not (url_count >= 0 and success_count >= 0 and
+                        success_count <= url_count):
+                    return False
+            stack.extend(children)
+        return True
+
+    @classmethod
+    def from_preftrees(cls, trees, count_typecode='d'):
+        """
+        Builds a joint tree from a dictionary mapping class ids
+        to :class:`PrefTree`. Reversed subtrees (:class:`RevPrefTree`)
+        are not supported.
+        """
+        joint = cls(count_typecode=count_typecode)
+        for class_id, tree in sorted(trees.items()):
+            stack = [tree]
+            while stack:
+                subtree = stack.pop()
+                if isinstance(subtree, RevPrefTree):
+                    raise ValueError('Reversed subtrees cannot be converted.')
+                stack.extend(subtree.children.values())
+            joint.add_class(class_id)
+            for url, url_count, success_count in tree.iter_urls():
+                joint.add_url(class_id, url, success_count, url_count)
+        return joint
+
+    def to_preftree(self, class_id):
+        """
+        Extracts the tree of a class as a :class:`PrefTree`.
+        Nodes which are only needed by the other classes are merged.
+        """
+        k = self._class(class_id)
+        nb_classes = len(self.classes)
+        def live_children(node):
+            return [c for c in self._children(node)
+                    if self.url_counts[c*nb_classes + k] or self.wildcards[c*nb_classes + k]]
+
+        root = PrefTree()
+        stack = [(0, root)]
+        while stack:
+            node, subtree = stack.pop()
+            idx = node*nb_classes + k
+            subtree.url_count = self.url_counts[idx]
+            subtree.success_count = self.success_counts[idx]
+            subtree.is_wildcard = bool(self.wildcards[idx])
+            if subtree.is_wildcard:
+                continue
+            for child in live_children(node):
+                label = self._label(child)
+                children = live_children(child)
+                while (len(children) == 1 and not self.wildcards[child*nb_classes + k] and
+                       not self._remaining_counts(child, k)[0]):
+                    child = children[0]
+                    label += self._label(child)
+                    children = live_children(child)
+                child_tree = PrefTree()
+                subtree[label] = child_tree
+                stack.append((child, child_tree))
+        return root
+
+    def print_as_tree(self, class_id, *args, **kwargs):
+        """
+        Prints the tree of a class.
+        """
+        self.to_preftree(class_id).print_as_tree(*args, **kwargs)
+
+    def class_view(self, class_id):
+        """
+        Returns an object behaving as the tree of a single class
+        (with `match`, `match_length`, `match_many`, `match_confident`
+        and `add_url` methods), so that the joint tree can be stored
+        in a :class:`accesspredict.forest.URLForest` for each class.
+        """
+        self.add_class(class_id)
+        return JointClassView(self, class_id)
+
+class JointClassView(object):
+    """
+    The tree of a single class of a :class:`JointPrefTree`
+    (see :meth:`JointPrefTree.class_view`).
+    """
+    def __init__(self, joint, class_id):
+        self.joint = joint
+        self.class_id = class_id
+
+    def match(self, url):
+        return self.joint.match(self.class_id, url)
+
+    def match_length(self, url):
+        return self.joint.match_length(self.class_id, url)
+
+    def match_many(self, urls):
+        return self.joint.match_many(self.class_id, urls)
+
+    def match_confident(self, url, *args, **kwargs):
+        return self.joint.match_confident(self.class_id, url, *args, **kwargs)
+
+    def add_url(self, url, success_count=0., url_count=1., prune_kwargs=None):
+        if prune_kwargs is not None:
+            raise ValueError('Joint trees cannot be pruned.')
+        self.joint.add_url(self.class_id, url, success_count, url_count)
+
+    def urls(self, prepend=[]):
+        return self.joint.urls(self.class_id, prepend)
+
+    def print_as_tree(self, *args, **kwargs):
+        self.joint.print_as_tree(self.class_id, *args, **kwargs)
+
+    def freeze(self, smoothing=None):
+        return self.joint.to_preftree(self.class_id).freeze(smoothing)
@@ -35,6 +35,18 @@ class PrefTree(object):
     The keys of children in internal nodes are required not
     to share any common prefix (if so, we need to refactor them
     by adding an intermediate internal node) and to be non-null.
+    Therefore, the children can be indexed by the first token
+    of their key: this is the `index` dictionary, mapping
+    first tokens to keys of `children`.
+
+    Nodes whose counts have changed since they were last
+    considered for pruning are marked as `dirty`, so that
+    :meth:`prune_dirty` only needs to look at them.
+
+    The postfix tree of the URLs of a node, used by :meth:`prune`
+    to try reversing subtrees, is cached in `_reversed` (see
+    :meth:`reversed_tree`). :meth:`add_url` keeps it up to date,
+    and it is dropped when the subtree is changed in other ways.
     """
 
     def __init__(self, url_count=0, success_count=0):
@@ -45,6 +57,7 @@ class PrefTree(object):
         :param success_count: the number of successful urls leading to that leaf
         """
         self.children = {}
+        self.index = {}
         if not url_count >= 0:
             raise ValueError('Invalid url count, must be nonnegative')
         if not success_count >= 0:
@@ -54,6 +67,8 @@ class PrefTree(object):
         self.url_count = url_count
         self.success_count = success_count
         self.is_wildcard = False
+        self.dirty = True
+        self._reversed = None
 
     def assign(self, other):
         """
@@ -62,6 +77,34 @@ class PrefTree(object):
         self.__dict__ = other.__dict__.copy()
         self.__class__ = other.__class__
 
+    def __setstate__(self, state):
+        """
+        Restores a pickled tree, rebuilding the index of
+        children if it was not stored. Trees pickled before
+        nodes were marked as dirty are considered dirty.
+
+        Older trees can also contain children with an empty key,
+        for URLs ending at an internal node: they are dropped, as
+        their counts are already included in the counts of this node.
+        """
+        self.__dict__.update(state)
+        for key in [key for key in self.children if not len(key)]:
+            del self.children[key]
+        if 'dirty' not in state:
+            self.dirty = True
+        if '_reversed' not in state:
+            self._reversed = None
+        if 'index' not in state:
+            self.index = {key[0]: key for key in self.children if len(key)}
+
+    def __getstate__(self):
+        """
+        Pickles the tree without its cached postfix tree.
+        """
+        state = self.__dict__.copy()
+        state.pop('_reversed', None)
+        return state
+
     def __getitem__(self, key):
         """
         Shorthand for `children[key]`
@@ -75,19 +118,41 @@ class PrefTree(object):
         """
         Shorthand for `children[key] = value`
         """
-        if isinstance(key, hashable.hashable_list):
-            self.children[key] = value
-        else:
-            self.children[hashable.hashable_list(key)] = value
+        if not isinstance(key, hashable.hashable_list):
+            key = hashable.hashable_list(key)
+        self.children[key] = value
+        self._reversed = None
+        if len(key):
+            self.index[key[0]] = key
 
     def __delitem__(self, key):
         """
         Shorthand for `del children[key]`.
         """
-        if isinstance(key, hashable.hashable_list):
-            del self.children[key]
-        else:
-            del self.children[hashable.hashable_list(key)]
+        if not isinstance(key, hashable.hashable_list):
+            key = hashable.hashable_list(key)
+        del self.children[key]
+        self._reversed = None
+        if len(key) and self.index.get(key[0]) == key:
+            del self.index[key[0]]
+
+    def clear_children(self):
+        """
+        Removes all the children of this node.
+        """
+        self.children.clear()
+        self.index.clear()
+        self._reversed = None
+
+    def child_for(self, url):
+        """
+        Returns the key of the child whose key starts
+        with the same token as the url, or None if there is no
+        such child (or if the url is empty).
+        """
+        if len(url) == 0:
+            return None
+        return self.index.get(url[0])
 
     def add_url(self, url, success_count=0., url_count=1., prune_kwargs=None):
         """
@@ -103,7 +168,23 @@ class PrefTree(object):
             this parameter should contain the dict of parameters used by prune()
             (passed as **kwargs).
         """
+        self._add_url(url, success_count, url_count, prune_kwargs)
+
+    def _add_url(self, url, success_count, url_count, prune_kwargs, absorbed=None):
+        """
+        Implements :meth:`add_url`, also updating the cached postfix
+        trees along the way.
+
+        :param absorbed: whether the url ends up in a wildcard, if known
+        :returns: True when the structure of the tree has changed
+            in a way which is not reflected in the cached postfix trees
+            (for instance when a subtree was pruned)
+        """
         found = False
+        restructured = False
+        reversed_tree = self._reversed
+        if reversed_tree is not None and absorbed is None:
+            absorbed = self._absorbs(url)
 
         # convert boolean or integer values to floats
         if type(success_count) != float:
@@ -114,22 +195,25 @@ class PrefTree(object):
         leaf_node = PrefTree(url_count=url_count, success_count=success_count)
         self.url_count += leaf_node.url_count
         self.success_count += leaf_node.success_count
+        self.dirty = True
 
         if self.is_wildcard:
             # a wildcard already matches the url to be added
-            return
+            self._reversed = None
+            return restructured
 
-        for key in self.children:
+        key = self.child_for(url)
+        if key is not None:
             lcp = utils.longest_common_prefix(url, key)
-            if len(lcp) == 0:
-                continue
             if len(lcp) < len(key):
                 # We need to create an intermediate internal node
                 new_node = PrefTree()
                 old_node = self[key]
                 new_node[key[len(lcp):]] = old_node
 
-                new_node[url[len(lcp):]] = leaf_node
+                if len(lcp) < len(url):
+                    new_node[url[len(lcp):]] = leaf_node
+                # otherwise the url ends at the intermediate node
 
                 new_node.url_count = old_node.url_count + leaf_node.url_count
                 new_node.success_count = old_node.success_count + leaf_node.success_count
@@ -137,11 +221,15 @@ class PrefTree(object):
                 self[lcp] = new_node
             else: # in this case, len(lcp) == len(key)
                 # Recursively add the url to the next internal node
-                self.children[key].add_url(url[len(lcp):],
+                child = self.children[key]
+                if isinstance(child, RevPrefTree):
+                    restructured = child.add_url(url[len(lcp):],
                         url_count=url_count, success_count=success_count,
                         prune_kwargs=prune_kwargs)
+                else:
+                    restructured = child._add_url(url[len(lcp):],
+                        success_count, url_count, prune_kwargs, absorbed)
             found = True
-            break
 
         if not found and len(url) > 0 and not self.is_wildcard:
             found = True
@@ -149,12 +237,19 @@ class PrefTree(object):
             if url[0] == utils.WildcardCharacter():
                 # then just convert the tree to a wildcard
                 self.is_wildcard = True
-                self.children.clear()
+                self.clear_children()
             else:
                 # if no internal node with a matching prefix was found
                 # then add a new one with that prefix
                 self[url] = leaf_node
 
+        if reversed_tree is not None and not (absorbed or restructured):
+            reversed_tree.add_url(url, url_count=url_count,
+                                  success_count=success_count)
+            self._reversed = reversed_tree
+        else:
+            self._reversed = None
+
         if found and prune_kwargs is not None:
             # We have added a node to our tree, so we should try to prune (non-recursively)
             kwargs = prune_kwargs.copy()
@@ -162,6 +257,168 @@ class PrefTree(object):
             pruned, success = self.prune(**kwargs)
             if success:
                 self.assign(pruned)
+                restructured = True
+        return restructured
+
+    def _absorbs(self, url):
+        """
+        Returns True when the url would end in a wildcard
+        if it was added to the tree.
+        """
+        node = self
+        pos = 0
+        while not node.is_wildcard:
+            key = node.index.get(url[pos]) if pos < len(url) else None
+            if key is None or list(url[pos:pos+len(key)]) != key:
+                return False
+            pos += len(key)
+            node = node.children[key]
+            if isinstance(node, RevPrefTree):
+                return PrefTree._absorbs(node, list(reversed(url[pos:])))
+        return True
+
+    @classmethod
+    def from_sorted(cls, urls):
+        """
+        Builds a prefix tree in one pass from a stream of tokenized
+        URLs, which is much faster than adding them one by one.
+        The URLs have to be sorted by their tokens (for instance
+        with :func:`urltheory.sorting.external_sort` and
+        :func:`urltheory.sorting.token_sort_key`), or at least
+        grouped so that URLs sharing a prefix are contiguous.
+        The URLs should not contain wildcards.
+
+        :param urls: an iterable of (tokens, url_count, success_count)
+        :returns: the new tree
+        """
+        root = cls()
+        # the nodes along the branch of the previous url, with
+        # the position of their end in this url and their key.
+        # Their counts only include the urls ending at them and the
+        # nodes popped from the stack so far.
+        stack = [(root, 0, None)]
+        prev = []
+        for tokens, url_count, success_count in urls:
+            leaf_node = PrefTree(url_count=float(url_count),
+                                 success_count=float(success_count))
+
+            lcp = 0
+            max_lcp = min(len(prev), len(tokens))
+            while lcp < max_lcp and prev[lcp] == tokens[lcp]:
+                lcp += 1
+
+            # finalize the nodes which are not shared with the new url
+            while stack[-1][1] > lcp:
+                node, depth, key = stack.pop()
+                parent, parent_depth, parent_key = stack[-1]
+                if parent_depth < lcp:
+                    # We need to create an intermediate internal node
+                    new_node = PrefTree(url_count=node.url_count,
+                                        success_count=node.success_count)
+                    new_node[key[lcp-parent_depth:]] = node
+                    del parent[key]
+                    new_key = key[:lcp-parent_depth]
+                    parent[new_key] = new_node
+                    stack.append((new_node, lcp, new_key))
+                    break
+                parent.url_count += node.url_count
+                parent.success_count += node.success_count
+
+            node = stack[-1][0]
+            if lcp < len(tokens):
+                if node.child_for(tokens[lcp:]) is not None:
+                    raise ValueError('The urls are not sorted.')
+                key = hashable.hashable_list(tokens[lcp:])
+                node[key] = leaf_node
+                stack.append((leaf_node, len(tokens), key))
+            else:
+                node.url_count += leaf_node.url_count
+                node.success_count += leaf_node.success_count
+            prev = tokens
+
+        while len(stack) > 1:
+            node, depth, key = stack.pop()
+            parent = stack[-1][0]
+            parent.url_count += node.url_count
+            parent.success_count += node.success_count
+        return root
+
+    def merge(self, other):
+        """
+        Adds all the URLs stored in another tree to this tree,
+        summing the counts along shared prefixes and splitting
+        edges where their labels diverge. Wildcards absorb the
+        URLs merged below them, as with :meth:`add_url`.
+
+        Subtrees of `other` can be reused in this tree, so `other`
+        should not be used after the merge.
+        """
+        if isinstance(self, RevPrefTree) != isinstance(other, RevPrefTree):
+            # the trees are not stored in the same direction
+            for url, url_count, success_count in other.iter_urls():
+                self.add_url(url, success_count=success_count, url_count=url_count)
+            return
+
+        self.url_count += other.url_count
+        self.success_count += other.success_count
+        self.dirty = True
+        self._reversed = None
+        if self.is_wildcard:
+            return
+        if other.is_wildcard:
+            self.is_wildcard = True
+            self.clear_children()
+            return
+
+        for key, child in list(other.children.items()):
+            self._merge_child(key, child)
+
+    def _merge_child(self, key, child):
+        """
+        Merges a subtree at the given key, assuming the counts
+        of this node already include the counts of the subtree.
+        """
+        if len(key) == 0:
+            # the counts of a child with an empty key are already
+            # stored as the remaining counts of this node
+            for child_key, grandchild in list(child.children.items()):
+                self._merge_child(child_key, grandchild)
+            return
+
+        existing = self.child_for(key)
+        if existing is None:
+            self[key] = child
+            return
+
+        lcp = len(utils.longest_common_prefix(key, existing))
+        node = self[existing]
+        if lcp < len(existing):
+            # We need to create an intermediate internal node
+            new_node = PrefTree(url_count=node.url_count,
+                                success_count=node.success_count)
+            new_node[existing[lcp:]] = node
+            del self[existing]
+            self[existing[:lcp]] = new_node
+            node = new_node
+
+        if lcp < len(key):
+            # the subtree has to be merged below the node
+            wrapper = PrefTree(url_count=child.url_count,
+                               success_count=child.success_count)
+            wrapper[key[lcp:]] = child
+            child = wrapper
+        node.merge(child)
+
+    def freeze(self, smoothing=None):
+        """
+        Compiles this tree to an immutable :class:`FrozenPrefTree`,
+        which matches URLs faster and uses less memory.
+
+        :param smoothing: if provided, the smoothing strategy used to
+            precompute the probabilities and confidences of each node.
+        """
+        from urltheory.frozentree import FrozenPrefTree
+        return FrozenPrefTree(self, smoothing=smoothing)
 
     def confidence(self, smoothing, depth):
         """
@@ -177,7 +434,7 @@ class PrefTree(object):
 
         :returns: a pair of integers
         """
-        tot_count, success_count, _ = self.match_with_branch(url)
+        tot_count, success_count, _ = self.match_length(url)
         return (tot_count, success_count)
 
     def match_length(self, url):
@@ -185,14 +442,130 @@ class PrefTree(object):
         Matches the URL to the tree and returns the statistics of the node,
         plus the length of the matching prefix.
 
+        This walks down the tree iteratively, keeping track of the
+        position in the url: no list is built along the way.
+        Use :meth:`match_with_branch` to get the matching branch itself.
+
         :returns: a triple of integers:
         - the number of times URLs matching with the node were added
         - the number of times they were marked as a success
-        - the length of the matching prefix
+        - the length of the matching prefix (the wildcard or unknown
+          token ending the branch counts as one)
+        """
+        node = self
+        pos = 0
+        n = len(url)
+        while not node.is_wildcard:
+            if pos == n:
+                # the url ends here: we substract the counts seen in the children
+                # to the node counts
+                url_count = node.url_count
+                success_count = node.success_count
+                for child in node.children.values():
+                    url_count -= child.url_count
+                    success_count -= child.success_count
+                return (url_count, success_count, pos)
+
+            key = node.index.get(url[pos])
+            if key is None:
+                return (0, 0, pos+1)
+            length = len(key)
+            if pos + length > n:
+                return (0, 0, pos+1)
+            i = 1
+            while i < length:
+                if url[pos+i] != key[i]:
+                    return (0, 0, pos+1)
+                i += 1
+
+            pos += length
+            node = node.children[key]
+            if isinstance(node, RevPrefTree):
+                # reversed subtrees match the end of the url
+                url_count, success_count, length = node.match_length(url[pos:])
+                return (url_count, success_count, pos+length)
+
+        return (node.url_count, node.success_count, pos+1)
+
+    def match_confident(self, url, smoothing, min_confidence, stop_early=False,
+                        strict=False, depth=0):
+        """
+        Matches the URL to the tree as :meth:`match_length` does, but
+        also checks the smoothed confidence of the nodes on the way down
+        (the root excepted), as a prefix of the url can have confident
+        counts even if the node where the url ends has too few
+        observations to be conclusive.
+
+        :param smoothing: the smoothing strategy used to evaluate the nodes
+        :param min_confidence: the confidence a node needs to decide
+        :param stop_early: return the first confident node met, instead
+            of the deepest one
+        :param strict: require confidences strictly higher than `min_confidence`
+        :param depth: the length of the prefix leading to this tree
+        :returns: a quadruple: the url and success counts of the node
+            which decided, the length of its prefix, and whether it was
+            confident. If no node is confident, the counts and length are
+            those returned by :meth:`match_length`.
         """
-        tot_count, success_count, branch = self.match_with_branch(url)
-        return (tot_count, success_count, len(branch))
+        return utils.match_confident(self._descend(url, depth), smoothing,
+                                     min_confidence, stop_early, strict)
+
+    def _descend(self, url, depth=0):
+        """
+        Walks down the tree as :meth:`match_length` does, yielding the
+        counts and prefix lengths of the nodes met on the way down (the
+        root excepted), then the triple returned by :meth:`match_length`.
+        """
+        node = self
+        pos = 0
+        n = len(url)
+        while not node.is_wildcard:
+            if pos == n:
+                url_count = node.url_count
+                success_count = node.success_count
+                for child in node.children.values():
+                    url_count -= child.url_count
+                    success_count -= child.success_count
+                yield (url_count, success_count, depth+pos)
+                return
+
+            key = node.index.get(url[pos])
+            length = len(key) if key is not None else 0
+            i = 1
+            if key is not None and pos + length <= n:
+                while i < length and url[pos+i] == key[i]:
+                    i += 1
+            if key is None or pos + length > n or i < length:
+                yield (0, 0, depth+pos+1)
+                return
+
+            pos += length
+            node = node.children[key]
+            yield (node.url_count, node.success_count, depth+pos)
+            if isinstance(node, RevPrefTree):
+                # reversed subtrees match the end of the url
+                for counts in node._descend(url[pos:], depth+pos):
+                    yield counts
+                return
 
+        yield (node.url_count, node.success_count, depth+pos+1)
+
+    def match_many(self, urls):
+        """
+        Matches a batch of URLs with :meth:`match_length`.
+        The results can be passed directly to the `evaluate`
+        method of a smoothing strategy.
+
+        The URLs are matched one by one here: only the smoothing
+        of the results, done on whole arrays, is vectorized. To match
+        large batches, freeze the tree first: :meth:`FrozenPrefTree.match_many`
+        walks down with all the URLs at once.
+
+        :param urls: an iterable of tokenized URLs
+        :returns: a triple of NumPy arrays: the url counts,
+            the success counts and the lengths of the matching prefixes
+        """
+        return utils.batch_match_length(self.match_length, urls)
 
     def match_with_branch(self, url):
         """
@@ -211,27 +584,20 @@ class PrefTree(object):
         if type(url) != list:
             url = [c for c in url]
 
-        urls = 0
-        successes = 0
-        for path in self.children:
-            subtree = self[path]
-
-            # we keep track of the counts seen in the children,
-            # so that we can substract them later on to the root counts
-            # if the url ends at the root
-            urls += subtree.url_count
-            successes += subtree.success_count
-
-            if list(url[:len(path)]) == list(path):
-                # we found a matching branch
-                tot_count, suc_count, sub_branch = subtree.match_with_branch(
-                        url[len(path):])
-                return (tot_count, suc_count, path + sub_branch)
-
         if len(url) == 0:
-            # the url ends here
+            # the url ends here: we substract the counts seen in the children
+            # to the root counts
+            urls = sum([c.url_count for c in list(self.children.values())])
+            successes = sum([c.success_count for c in list(self.children.values())])
             return (self.url_count - urls, self.success_count - successes, [])
 
+        path = self.child_for(url)
+        if path is not None and list(url[:len(path)]) == list(path):
+            # we found a matching branch
+            tot_count, suc_count, sub_branch = self[path].match_with_branch(
+                    url[len(path):])
+            return (tot_count, suc_count, path + sub_branch)
+
         # the url did not match anything in the tree.
         return (0,0, ['<unk>'])
 
@@ -247,10 +613,10 @@ class PrefTree(object):
             self.print_as_tree()
             return
 
-        for path in self.children:
-            if list(url[:len(path)]) == list(path):
-                self[path].print_subtree(url[len(path):])
-                return
+        path = self.child_for(url)
+        if path is not None and list(url[:len(path)]) == list(path):
+            self[path].print_subtree(url[len(path):])
+            return
 
         print("unmatched: ")
         print(url)
@@ -277,15 +643,17 @@ class PrefTree(object):
             raise ValueError('The confidence threshold has to be positive.')
         if self.url_count == 0:
             return (self, False)
+        self.dirty = False
 
         # Is this a good candidate for a prune ?
-        should_be_pruned = (self.confidence(smoothing, depth) >= confidence_threshold and
-                            len(self.children) > 0)
+        should_be_pruned = (len(self.children) > 0 and
+                            smoothing.is_confident(self.url_count, self.success_count,
+                                                   depth, confidence_threshold))
         has_been_pruned = False
 
         if should_be_pruned:
             self.is_wildcard = True
-            self.children.clear()
+            self.clear_children()
             has_been_pruned = True
 
         if recurse:
@@ -303,17 +671,109 @@ class PrefTree(object):
         # If it is a good candidate for a prune, but has not been pruned,
         # we can try reversing the urls
         if (reverse and not has_been_pruned):
-            urls = self.urls()
+            rev = self.reversed_tree()
+            if rev.would_prune(confidence_threshold=confidence_threshold):
+                self._reversed = None
+                rev, pruned = rev.prune(confidence_threshold=confidence_threshold,
+                         reverse=False, recurse=True)
+                return (rev, True)
+
+        if has_been_pruned:
+            self._reversed = None
+        return (self, has_been_pruned)
+
+    def reversed_tree(self):
+        """
+        Returns the postfix tree of the URLs of this tree.
+        It is cached, so that :meth:`prune` does not rebuild it
+        every time it tries to reverse this subtree, and updated
+        by :meth:`add_url`. It should not be modified.
+        Use :meth:`forget_reversed` to free the memory it uses.
+
+        :returns: a :class:`RevPrefTree`
+        """
+        rev = self._reversed
+        if rev is None:
             rev = RevPrefTree()
-            for u, match_count, success_count in urls:
+            for u, match_count, success_count in self.iter_urls():
                 rev.add_url(u, url_count=match_count, success_count=success_count)
+            if not isinstance(self, RevPrefTree):
+                self._reversed = rev
+        return rev
 
-            rev, pruned = rev.prune(confidence_threshold=confidence_threshold,
-                     reverse=False, recurse=True)
-            if pruned:
-                return (rev, True)
+    def forget_reversed(self):
+        """
+        Drops the postfix trees cached in this tree (see :meth:`reversed_tree`).
+        """
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            node._reversed = None
+            stack.extend(node.children.values())
 
-        return (self, has_been_pruned)
+    def would_prune(self, smoothing=ConstantDirichlet(), depth=0, confidence_threshold=1.0):
+        """
+        Returns True when :meth:`prune` (without reversing subtrees)
+        would prune some part of this tree, without modifying it.
+        """
+        stack = [(self, depth)]
+        while stack:
+            node, depth = stack.pop()
+            if node.url_count == 0:
+                continue
+            if (len(node.children) > 0 and
+                smoothing.is_confident(node.url_count, node.success_count,
+                                       depth, confidence_threshold)):
+                return True
+            for key, child in node.children.items():
+                stack.append((child, depth+len(key)))
+        return False
+
+    def prune_dirty(self, smoothing=ConstantDirichlet(), depth=0, confidence_threshold=1.0):
+        """
+        Prunes the tree as :meth:`prune` does (without reversing
+        subtrees), but only considers the nodes which are marked as dirty,
+        i.e. whose counts have changed since they were last considered
+        for pruning. The other nodes would not be pruned if the tree has
+        already been pruned with the same parameters, so the cost of this
+        scales with the number of URLs added since the last prune.
+
+        :param confidence_threshold: the confidence above which we should
+            replace subtrees by a wildcard
+        :returns: a triple: the tree itself (for compatibility with
+            :meth:`prune`), a boolean indicating whether some part
+            of the tree has been pruned, and the number of nodes visited
+        """
+        if confidence_threshold <= 0:
+            raise ValueError('The confidence threshold has to be positive.')
+
+        has_been_pruned = False
+        visited = []
+        stack = [(self, depth)]
+        while stack:
+            node, depth = stack.pop()
+            node.dirty = False
+            visited.append(node)
+            if node.url_count == 0:
+                continue
+
+            if (len(node.children) > 0 and
+                smoothing.is_confident(node.url_count, node.success_count,
+                                       depth, confidence_threshold)):
+                node.is_wildcard = True
+                node.clear_children()
+                has_been_pruned = True
+                continue
+
+            for key, child in list(node.children.items()):
+                if child.dirty:
+                    stack.append((child, depth+len(key)))
+
+        if has_been_pruned:
+            # the cached postfix trees of the ancestors of pruned nodes are stale
+            for node in visited:
+                node._reversed = None
+        return (self, has_been_pruned, len(visited))
 
     def urls(self, prepend=[]):
         """
@@ -322,25 +782,59 @@ class PrefTree(object):
         :param prepend: first part of the URL, to be prepended to all URLs
         :returns: a list of tuples: (url, matches_count, success_count)
         """
-        if len(self.children) == 0:
-            if self.is_wildcard:
-                return [(prepend + [utils.WildcardCharacter()],self.url_count,self.success_count)]
-            return [(prepend,self.url_count,self.success_count)]
-        else:
-            res = []
-            total_url_count = 0
-            total_success_count = 0
-            for key in self.children:
-                new_prepend = prepend + key
-                child_urls = self[key].urls(new_prepend)
-                res += child_urls
-                total_url_count += sum([c for u, c, s in child_urls])
-                total_success_count += sum([s for u, c, s in child_urls])
-
-            if total_url_count < self.url_count:
-                res.append((prepend, (self.url_count - total_url_count),
-                              (self.success_count - total_success_count)))
-            return res
+        return list(self.iter_urls(prepend))
+
+    def iter_urls(self, prepend=[]):
+        """
+        Generates the URLs contained in the prefix tree, in the same
+        order as :meth:`urls`, without building the whole list.
+        The tree is walked with an explicit stack and a single path
+        buffer, so the memory used does not depend on the size of the
+        tree (only on its depth). Each URL yielded is a fresh list.
+
+        :param prepend: first part of the URL, to be prepended to all URLs
+        :returns: a generator of tuples: (url, matches_count, success_count)
+        """
+        path = list(prepend)
+        # stack of [node, children iterator, label length,
+        #           url count of the children, success count of the children]
+        stack = [[self, None, 0, 0, 0]]
+        while stack:
+            entry = stack[-1]
+            node = entry[0]
+            if entry[1] is None:
+                if node is not self and isinstance(node, RevPrefTree):
+                    # reversed subtrees generate their urls themselves
+                    for url in node.iter_urls(path):
+                        yield url
+                    stack.pop()
+                    del path[len(path)-entry[2]:]
+                    continue
+                elif not node.children:
+                    if node.is_wildcard:
+                        yield (path + [utils.WildcardCharacter()],
+                               node.url_count, node.success_count)
+                    else:
+                        yield (list(path), node.url_count, node.success_count)
+                    stack.pop()
+                    del path[len(path)-entry[2]:]
+                    continue
+                entry[1] = iter(list(node.children.items()))
+
+            child_entry = next(entry[1], None)
+            if child_entry is not None:
+                key, child = child_entry
+                entry[3] += child.url_count
+                entry[4] += child.success_count
+                path.extend(key)
+                stack.append([child, None, len(key), 0, 0])
+                continue
+
+            if entry[3] < node.url_count:
+                yield (list(path), node.url_count - entry[3],
+                       node.success_count - entry[4])
+            stack.pop()
+            del path[len(path)-entry[2]:]
 
     def has_wildcard(self):
         """
@@ -353,6 +847,18 @@ class PrefTree(object):
                 return True
         return False
 
+    def node_count(self):
+        """
+        Returns the number of nodes in this tree.
+        """
+        count = 0
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            count += 1
+            stack.extend(node.children.values())
+        return count
+
     def print_as_tree(self, levels=[], last_label='ROOT', is_last_child=True):
         """
         Prints the tree as it is stored
@@ -392,7 +898,8 @@ class PrefTree(object):
         """
         if len(self.children) == 0:
             if (2*self.success_count < self.url_count or
-                self.confidence(smoothing, depth) < confidence_threshold):
+                not smoothing.is_confident(self.url_count, self.success_count,
+                                           depth, confidence_threshold)):
                 return ''
             else:
                 return '.*' if self.is_wildcard else ''
@@ -470,7 +977,14 @@ class PrefTree(object):
         if self.is_wildcard and len(keys):
             return False
 
-        # 4 / Recursively check the children
+        # 4 / The keys are not empty, and the index of children is
+        # consistent with them
+        if (any(not len(key) for key in keys) or
+            len(self.index) != len(keys) or
+            any(self.index.get(key[0]) != key for key in keys)):
+            return False
+
+        # 5 / Recursively check the children
         for val in list(self.children.values()):
             if not val.check_sanity(True):
                 return False
@@ -483,13 +997,28 @@ class RevPrefTree(PrefTree):
     All urls sent to it are reversed.
     See :class:`PrefTree` for the documentation.
     """
-    def add_url(self, url, success_count=False, url_count=1):
+    def add_url(self, url, success_count=False, url_count=1, prune_kwargs=None):
         """
         Recursively adds an URL to the postfix tree
+
+        :returns: True when the structure of the tree has changed
+            (see :meth:`PrefTree._add_url`), so that the parent
+            tree knows its cached postfix tree is outdated
+        """
+        return self._add_url(list(reversed(url)), success_count,
+                             url_count, prune_kwargs)
+
+    def match_length(self, url):
+        """
+        Matches the reversed URL to the tree: see :meth:`PrefTree.match_length`.
+        """
+        return super(RevPrefTree, self).match_length(url[::-1])
+
+    def _descend(self, url, depth=0):
+        """
+        Walks down the tree with the reversed URL: see :meth:`PrefTree._descend`.
         """
-        super(RevPrefTree, self).add_url(list(reversed(url)),
-            success_count=success_count,
-            url_count=url_count)
+        return super(RevPrefTree, self)._descend(url[::-1], depth)
 
     def match_with_branch(self, url, **kwargs):
         """
@@ -500,15 +1029,16 @@ class RevPrefTree(PrefTree):
                     self).match_with_branch(list(reversed(url)), **kwargs)
         return tot, suc, list(reversed(branch))
 
-    def urls(self, prepend=[]):
+    def iter_urls(self, prepend=[]):
         """
-        Prints the list of URLs contained in the prefix tree
+        Generates the URLs contained in the postfix tree, in their
+        original order: see :meth:`PrefTree.iter_urls`.
 
         :param prepend: first part of the URL, to be prepended to all URLs
         """
-        reversed_urls = [(list(reversed(l)), u, s) for l, u, s in
-                super(RevPrefTree, self).urls()]
-        return [(prepend+url,c,s) for url, c, s in reversed_urls]
+        for url, c, s in super(RevPrefTree, self).iter_urls():
+            url.reverse()
+            yield (prepend+url, c, s)
 
     def print_as_tree(self, levels=[], last_label='ROOT', is_last_child=True):
         """
@@ -1,4 +1,4 @@
-# -*- encoding: utf-8 -*-
+# -*- encoding: utf-8 -*-
 
 """
 A smoothing strategy takes raw occurrence
@@ -7,7 +7,11 @@ the length of the corresponding URL prefixes,
 and returns smoothed probability estimates.
 """
 
-import math
+import numpy
+
+from urltheory.utils import inverse_proba_confidence
+from urltheory.utils import proba_confidence
+from urltheory.utils import proba_confidence_many
 
 class SmoothingStrategy(object):
     """
@@ -22,38 +26,234 @@ class SmoothingStrategy(object):
         of the prefix can also be taken into account
         (this amounts to putting a different smoothing
         on each level of the prefix tree).
+
+        The arguments can also be NumPy arrays of the
+        same shape (as returned by `match_many`), in which
+        case an array of estimates is returned.
         """
         raise NotImplemented
 
-class NoSmoothing(SmoothingStrategy):
+    def evaluate_many(self, counts, successes, lengths):
+        """
+        Vectorized version of :meth:`evaluate`: returns the
+        array of the estimates for arrays (or lists) of counts.
+        """
+        return self.evaluate(numpy.asarray(counts, dtype=float),
+                             numpy.asarray(successes, dtype=float),
+                             numpy.asarray(lengths, dtype=numpy.intp))
+
+    def is_confident(self, count, success, length, threshold, strict=False):
+        """
+        Returns True when the confidence of the smoothed estimate
+        (see :func:`urltheory.utils.proba_confidence`) is at least
+        the threshold.
+
+        :param strict: require the confidence to be strictly
+            higher than the threshold
+        """
+        confidence = proba_confidence(self.evaluate(count, success, length))
+        return confidence > threshold if strict else confidence >= threshold
+
+    def is_confident_many(self, counts, successes, lengths, threshold, strict=False):
+        """
+        Vectorized version of :meth:`is_confident`, returning
+        an array of booleans.
+        """
+        confidences = proba_confidence_many(
+            self.evaluate_many(counts, successes, lengths))
+        return confidences > threshold if strict else confidences >= threshold
+
+class DirichletSmoothing(SmoothingStrategy):
+    """
+    A smoothing strategy which puts a Dirichlet prior
+    (alpha, beta) on the distribution of each node, depending
+    only on its depth. The priors of the first levels are
+    tabulated, and confidence checks are reduced to comparisons
+    of the counts with bounds precomputed for each threshold.
+
+    Subclasses only need to implement :meth:`prior`.
+    """
+    # number of depths tabulated in advance
+    table_size = 64
+
+    def prior(self, length):
+        """
+        Returns the prior (alpha, beta) put on the nodes
+        at a given depth.
+        """
+        raise NotImplementedError
+
+    def _priors(self, length):
+        """
+        Looks up the prior of a depth in the table,
+        growing it if needed.
+        """
+        if type(length) != int or length < 0:
+            return self.prior(length)
+        table = self.__dict__.get('_prior_list')
+        if table is None or length >= len(table):
+            self._grow_tables(max(2*length+1, self.table_size))
+            table = self._prior_list
+        return table[length]
+
+    def _grow_tables(self, size):
+        """
+        Tabulates the priors of the depths up to `size`.
+        """
+        self._prior_list = [self.prior(length) for length in range(size)]
+        self._alphas = numpy.array([p[0] for p in self._prior_list], dtype=float)
+        self._betas = numpy.array([p[1] for p in self._prior_list], dtype=float)
+        self._min_counts = {}
+
+    def prior_tables(self, max_length):
+        """
+        Returns the arrays of the alphas and betas of
+        the depths from 0 to at least `max_length`.
+        """
+        table = self.__dict__.get('_prior_list')
+        if table is None or len(table) <= max_length:
+            self._grow_tables(max(2*max_length+1, self.table_size))
+        return self._alphas, self._betas
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for key in ['_prior_list', '_alphas', '_betas', '_min_counts']:
+            state.pop(key, None)
+        return state
+
+    def evaluate(self, count, success, length):
+        if isinstance(length, numpy.ndarray):
+            return self.evaluate_many(count, success, length)
+        alpha, beta = self._priors(length)
+        return (alpha + success) / (alpha + beta + count)
+
+    def evaluate_many(self, counts, successes, lengths):
+        counts = numpy.asarray(counts, dtype=float)
+        successes = numpy.asarray(successes, dtype=float)
+        lengths = numpy.asarray(lengths)
+        if lengths.size == 0:
+            return numpy.zeros(lengths.shape)
+        if lengths.dtype.kind not in 'iu' or lengths.min() < 0:
+            alphas, betas = numpy.vectorize(self.prior)(lengths)
+        else:
+            alphas, betas = self.prior_tables(int(lengths.max()))
+            alphas = alphas[lengths]
+            betas = betas[lengths]
+        return (alphas + successes) / (alphas + betas + counts)
+
+    def _bounds(self, threshold):
+        """
+        Returns the probability an estimate has to reach (or stay below,
+        symmetrically) to be confident at this threshold, and the
+        table of the minimum counts of each depth. They are cached
+        for each threshold.
+        """
+        bounds = self._min_counts.get(threshold)
+        if bounds is None:
+            r = inverse_proba_confidence(threshold, epsilon=1e-12)
+            min_counts = [
+                ((alpha + beta)*r - max(alpha, beta)) / (1. - r) if r < 1. else float('inf')
+                for alpha, beta in self._prior_list]
+            bounds = (r, min_counts)
+            self._min_counts[threshold] = bounds
+        return bounds
+
+    def min_count(self, threshold, length):
+        """
+        Returns the number of observations a node at the given depth
+        needs for its estimate to reach the confidence threshold
+        (when all of them agree). Nodes with fewer observations are
+        never confident.
+
+        >>> int(ConstantDirichlet().min_count(proba_confidence(0.9), 0))
+        8
+        """
+        self._priors(length)
+        return self._bounds(threshold)[1][length]
+
+    def is_confident(self, count, success, length, threshold, strict=False):
+        """
+        Returns True when the confidence of the smoothed estimate
+        (see :func:`urltheory.utils.proba_confidence`) is at least
+        the threshold. As the confidence only depends on the distance
+        of the estimate to 1/2, this amounts to comparing the counts
+        with bounds precomputed for this threshold.
+
+        >>> s = ConstantDirichlet()
+        >>> s.is_confident(10, 10, 3, 0.5), s.is_confident(10, 5, 3, 0.5)
+        (True, False)
+
+        :param strict: require the confidence to be strictly
+            higher than the threshold
+        """
+        if threshold > 1. or (strict and threshold >= 1.):
+            return False
+        if threshold <= 0. and not strict:
+            return True
+        if type(length) != int or length < 0:
+            return SmoothingStrategy.is_confident(self, count, success,
+                                                  length, threshold, strict)
+        alpha, beta = self._priors(length)
+        r, min_counts = self._bounds(threshold)
+        if count < min_counts[length]:
+            return False
+        total = alpha + beta + count
+        success = alpha + success
+        if strict:
+            return success > r*total or success < (1. - r)*total
+        return success >= r*total or success <= (1. - r)*total
+
+class NoSmoothing(DirichletSmoothing):
     """
     No smoothing at all, just returns bare probability estimates.
 
     >>> NoSmoothing().evaluate(5,4,3)
     0.8
+    >>> NoSmoothing().evaluate(numpy.array([5,2]),numpy.array([4,1]),numpy.array([3,3])).tolist()
+    [0.8, 0.5]
     """
+    def prior(self, length):
+        return (0., 0.)
+
     def evaluate(self, count, success, length):
-        return float(success)/count
+        return success / count
 
-class ConstantDirichlet(SmoothingStrategy):
+class ConstantDirichlet(DirichletSmoothing):
     """
     Put the same Dirichlet prior on the distribution of
     each node
 
     >>> ConstantDirichlet().evaluate(0,0,5)
     0.5
+    >>> ConstantDirichlet().evaluate(numpy.array([0,2]),numpy.array([0,2]),numpy.array([5,5])).tolist()
+    [0.5, 0.75]
     """
     def __init__(self, alpha=1., beta=1.):
         self.alpha = alpha
+        self.beta = beta
         self.alphabeta = alpha + beta
 
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if 'beta' not in state:
+            self.beta = self.alphabeta - self.alpha
+
+    def prior(self, length):
+        return (self.alpha, self.beta)
+
     def evaluate(self, count, success, length):
         return (self.alpha + success) / (self.alphabeta + count)
 
-class ExponentialDirichlet(SmoothingStrategy):
+class ExponentialDirichlet(DirichletSmoothing):
     """
     The (symmetric) Dirichlet prior constants vary exponentially
     depending on the length
+
+    >>> s = ExponentialDirichlet()
+    >>> round(s.evaluate(10, 10, 40), 4)
+    0.7484
+    >>> s.evaluate_many([10, 0], [10, 0], [40, 3]).round(4).tolist()
+    [0.7484, 0.5]
     """
 
     def __init__(self, k=1.5, a=8., b=0.1):
@@ -61,10 +261,6 @@ class ExponentialDirichlet(SmoothingStrategy):
         self.a = a
         self.b = b
 
-    def evaluate(self, count, success, length):
-        p = math.pow(self.k, (self.a - self.b*length))
-        print('count: {}, success: {}, length: {}'.format(count, success, length))
-        from urltheory.utils import min_count_for_confidence
-        print('prior: {}, min_count at 0.8: {}'.format(p, min_count_for_confidence(0.8,(p,p))))
-        return ConstantDirichlet(p,p).evaluate(count, success, length)
-
+    def prior(self, length):
+        p = self.k ** (self.a - self.b*length)
+        return (p, p)
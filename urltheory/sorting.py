@@ -0,0 +1,82 @@
+# -*- encoding: utf-8 -*-
+
+"""
+Sorting tokenized URLs, for instance to build a
+:class:`PrefTree` in one pass with :meth:`PrefTree.from_sorted`.
+"""
+
+import heapq
+import os
+import pickle
+import tempfile
+
+def token_sort_key(tokens):
+    """
+    A sorting key for tokenized URLs. Tokens can be strings or
+    integers (see :func:`urltheory.tokenizer.prepare_url`), which
+    cannot be compared directly, so integers are sorted first.
+
+    >>> sorted([['a', 'b'], ['a', 0], ['a']], key=token_sort_key)
+    [['a'], ['a', 0], ['a', 'b']]
+    """
+    return [(0, t) if type(t) == int else (1, t) for t in tokens]
+
+def external_sort(items, key=None, chunk_size=1000000, tmpdir=None):
+    """
+    Sorts a stream of items which might not fit in memory.
+    The items are sorted by chunks of `chunk_size` items,
+    which are pickled to temporary files and then merged.
+    If there is only one chunk, everything happens in memory.
+
+    >>> list(external_sort([3, 1, 4, 1, 5, 9, 2, 6], chunk_size=3))
+    [1, 1, 2, 3, 4, 5, 6, 9]
+    >>> list(external_sort(['ab', 'b', 'a'], key=len))
+    ['b', 'a', 'ab']
+
+    :param items: the items to sort (they have to be picklable)
+    :param key: the sorting key, as for :func:`sorted`
+    :param chunk_size: the number of items to sort in memory
+    :param tmpdir: the directory where temporary files are stored
+    :returns: a generator of the sorted items
+    """
+    chunk = []
+    files = []
+    try:
+        for item in items:
+            chunk.append(item)
+            if len(chunk) >= chunk_size:
+                files.append(_dump_chunk(sorted(chunk, key=key), tmpdir))
+                chunk = []
+        chunk.sort(key=key)
+        if not files:
+            for item in chunk:
+                yield item
+            return
+
+        files.append(_dump_chunk(chunk, tmpdir))
+        chunk = []
+        for item in heapq.merge(*[_load_chunk(f) for f in files], key=key):
+            yield item
+    finally:
+        for f in files:
+            f.close()
+
+def _dump_chunk(chunk, tmpdir):
+    """
+    Writes a sorted chunk to an anonymous temporary file.
+    """
+    f = tempfile.TemporaryFile(dir=tmpdir)
+    for item in chunk:
+        pickle.dump(item, f, protocol=pickle.HIGHEST_PROTOCOL)
+    f.seek(0, os.SEEK_SET)
+    return f
+
+def _load_chunk(f):
+    """
+    Reads back the items written by :func:`_dump_chunk`.
+    """
+    while True:
+        try:
+            yield pickle.load(f)
+        except EOFError:
+            return
@@ -1,6 +1,10 @@
 # -*- encoding: utf-8 -*-
 
 
+import os
+import pickle
+import random
+import re
 import unittest
 import doctest
 from hashable_collections.hashable_collections import hashable_list
@@ -9,10 +13,23 @@ import urltheory
 import urltheory.smoothing
 import urltheory.tokenizer
 import urltheory.preftree
-from urltheory.smoothing import NoSmoothing
-from urltheory.tokenizer import prepare_url
+import urltheory.sorting
+import urltheory.frozentree
+from urltheory.smoothing import NoSmoothing, ConstantDirichlet
+from urltheory.tokenizer import prepare_url, prepare_urls, flatten_to_re
 from urltheory.preftree import PrefTree, RevPrefTree
-from urltheory.utils import flatten, proba_confidence
+from urltheory.compacttree import CompactPrefTree
+from urltheory.jointtree import JointPrefTree
+from urltheory.sorting import external_sort, token_sort_key
+from urltheory.utils import flatten, proba_confidence, proba_confidence_many
+from urltheory.utils import WildcardCharacter
+
+class ExitOnUnpickle(object):
+    """
+    Kills the worker process receiving it.
+    """
+    def __reduce__(self):
+        return (os._exit, (9,))
 
 class PrefTreeTest(unittest.TestCase):
     def test_empty(self):
@@ -40,6 +57,23 @@ class PrefTreeTest(unittest.TestCase):
             t.add_url(u)
         self.assertEqual(len(t.urls()), 4)
 
+    def test_iter_urls(self):
+        t = PrefTree()
+        for u in ['arxiv.org/abs/1410.1454', 'arxiv.org/pdf/1410.1454v2', 'arxiv.org/']:
+            t.add_url(u, True)
+        urls = t.iter_urls(['http://'])
+        self.assertEqual(next(urls), (['http://'] + list('arxiv.org/abs/1410.1454'), 1, 1))
+        self.assertEqual(sorted([flatten(u) for u, c, s in urls]),
+                         ['http://arxiv.org/', 'http://arxiv.org/pdf/1410.1454v2'])
+
+        # deep trees are generated without recursion
+        depth = 2000
+        t = PrefTree.from_sorted([('a'*i, 1, i % 2) for i in range(1, depth+1)])
+        urls = list(t.iter_urls())
+        self.assertEqual(len(urls), depth)
+        self.assertEqual(urls[0], (['a']*depth, 1, 0))
+        self.assertEqual(urls[-1], (['a'], 1, 1))
+
     def test_wildcard(self):
         t = PrefTree()
         t.add_url('arxiv.org/pdf/', True)
@@ -79,6 +113,27 @@ class PrefTreeTest(unittest.TestCase):
         self.assertEqual((c,s),(1,1))
         self.assertEqual(''.join(b), 'aab/ced')
 
+    def test_match_length(self):
+        t = PrefTree()
+        for url, success in [
+            ('researchgate.net/publication/233865122_uriset', False),
+            ('researchgate.net/publication/143874230_albtedru', False),
+            ('researchgate.net/publication/233865122_uriset.pdf', True),
+            ('researchgate.net/publication/143874230_albtedru.pdf', True),
+            ('researchgate.net/publication/320748374_kelbcad.pdf', True),
+            ('arxiv.org/abs/1410.1454', False),
+            ]:
+            t.add_url(url, success)
+        t, pruned = t.prune(confidence_threshold=0.2, reverse=True)
+        for url in ['researchgate.net/publication/7489168_lopdetu.pdf',
+                    'researchgate.net/publication/7489168_lopdetu',
+                    'arxiv.org/abs/1410.1454',
+                    'arxiv.org/abs',
+                    'arxiv.org/pdf',
+                    '']:
+            c, s, b = t.match_with_branch(url)
+            self.assertEqual(t.match_length(url), (c, s, len(b)))
+
     def test_with_tokenization(self):
         t = PrefTree()
         t.add_url(prepare_url('eprint.iacr.org/2016/093'), False)
@@ -140,6 +195,39 @@ class PrefTreeTest(unittest.TestCase):
         t, pruned = t.prune()
         self.assertFalse(pruned)
 
+    def test_prune_dirty(self):
+        t = PrefTree()
+        for url, success in [
+                ('arxiv.org/pdf/1410.1234', True),
+                ('arxiv.org/pdf/1409.1094', True),
+                ('arxiv.org/pdf/1201.5480', True),
+                ('arxiv.org/pdf/1601.01234', True),
+                ('arxiv.org/pdf/1602.01i34', False),
+                ('gnu.org/about.html', False),
+                ]:
+            t.add_url(url, success)
+        kwargs = {'confidence_threshold':proba_confidence(0.7),
+                  'smoothing':NoSmoothing()}
+        t, pruned = t.prune(**kwargs)
+        self.assertTrue(pruned)
+
+        # nothing has changed since the last prune
+        t, pruned, visited = t.prune_dirty(**kwargs)
+        self.assertFalse(pruned)
+        self.assertEqual(visited, 1)
+
+        t.add_url('gnu.org/licenses/gpl.html', False)
+        t.add_url('gnu.org/licenses/lgpl.html', False)
+        t, pruned, visited = t.prune_dirty(**kwargs)
+        self.assertTrue(pruned)
+        self.assertEqual(visited, 2)
+        self.assertTrue(t.check_sanity())
+        self.assertEqual(t.match('gnu.org/software/'), (3,0))
+
+        t, pruned, visited = t.prune_dirty(**kwargs)
+        self.assertFalse(pruned)
+        self.assertEqual(visited, 1)
+
     def test_prune_with_reverse(self):
         t = PrefTree()
         for url, success in [
@@ -159,6 +247,226 @@ class PrefTreeTest(unittest.TestCase):
         for u, c, s in t.urls():
             print(flatten(u), c, s)
 
+    def test_add_url_with_reverse(self):
+        t = PrefTree()
+        kwargs = {'confidence_threshold': 0.2, 'reverse': True}
+        for url, success in [
+            ('researchgate.net/publication/233865122_uriset', False),
+            ('researchgate.net/publication/143874230_albtedru', False),
+            ('researchgate.net/publication/233865122_uriset.pdf', True),
+            ('researchgate.net/publication/143874230_albtedru.pdf', True),
+            ('researchgate.net/publication/320748374_kelbcad.pdf', True)]:
+            t.add_url(url, success)
+        t, pruned = t.prune(**kwargs)
+        self.assertTrue(pruned)
+        # URLs can be added through the reversed subtree while keeping it pruned
+        t.add_url('researchgate.net/publication/7489168_lopdetu.pdf', True,
+                  prune_kwargs=kwargs)
+        self.assertTrue(t.check_sanity())
+        self.assertEqual(t.match('researchgate.net/publication/90127_uzotr.pdf'),
+                         (4, 4))
+
+    def test_add_url_prunes_reversed_child(self):
+        t = PrefTree()
+        for c in 'abcdefgh':
+            t.add_url(['k', c], False)
+        rev = RevPrefTree()
+        for c in 'abcdefgh':
+            rev.add_url([c, 'q', 'x'], True)
+        t[['h']] = rev
+        t.url_count += rev.url_count
+        t.success_count += rev.success_count
+        t.reversed_tree()
+        # the reversed child becomes a wildcard: the cached
+        # postfix tree of the root is outdated
+        t.add_url(['h', 'z', 'q', 'x'], True, prune_kwargs={
+                  'smoothing': NoSmoothing(), 'confidence_threshold': 0.5})
+        self.assertTrue(t[['h']].is_wildcard)
+        self.assertIsNone(t._reversed)
+        self.assertEqual(t.reversed_tree().url_count, 17)
+        self.assertEqual(t.reversed_tree().match(['h', 'a', 'q', 'x']), (0, 0))
+
+    def test_reversed_tree(self):
+        t = PrefTree()
+        urls = [('researchgate.net/publication/233865122_uriset', False),
+                ('researchgate.net/publication/143874230_albtedru', False),
+                ('researchgate.net/publication/233865122_uriset.pdf', True)]
+        for url, success in urls:
+            t.add_url(url, success)
+        t, pruned = t.prune(confidence_threshold=0.25, reverse=True)
+        self.assertFalse(pruned)
+        rev = t.reversed_tree()
+        self.assertTrue(rev is t.reversed_tree())
+
+        # the cached postfix tree is updated when urls are added
+        t.add_url('researchgate.net/publication/143874230_albtedru.pdf', True)
+        self.assertTrue(rev is t.reversed_tree())
+        self.assertEqual(rev.match('researchgate.net/publication/143874230_albtedru.pdf'),
+                         (1, 1))
+        self.assertEqual((rev.url_count, rev.success_count), (4, 2))
+
+        # and used to reverse the tree when it becomes a good candidate
+        t.add_url('researchgate.net/publication/320748374_kelbcad.pdf', True)
+        t, pruned = t.prune(confidence_threshold=0.25, reverse=True)
+        self.assertTrue(pruned)
+        self.assertTrue(t.check_sanity())
+        self.assertEqual(t.match('researchgate.net/publication/7489168_lopdetu.pdf'),
+                         (3, 3))
+
+        # the cache is not pickled
+        t = PrefTree()
+        t.add_url('arxiv.org/abs/1410.1454', False)
+        t.reversed_tree()
+        self.assertIsNone(pickle.loads(pickle.dumps(t))._reversed)
+        t.forget_reversed()
+        self.assertIsNone(t._reversed)
+
+    def test_index(self):
+        t = PrefTree()
+        for u in ['abc', 'ab', 'abd', 'b']:
+            t.add_url(u, True)
+            self.assertTrue(t.check_sanity())
+        self.assertEqual(sorted(t.index.keys()), ['a', 'b'])
+        self.assertEqual(t['ab'].index['d'], hashable_list('d'))
+        self.assertEqual(t.match('abd'), (1,1))
+        self.assertEqual(t.match('ab'), (1,1))
+
+        # trees pickled without index get it rebuilt
+        state = t.__dict__.copy()
+        del state['index']
+        restored = PrefTree.__new__(PrefTree)
+        restored.__setstate__(state)
+        self.assertTrue(restored.check_sanity())
+        self.assertEqual(restored.match('b'), (1,1))
+
+    def test_unpickle_old_format(self):
+        # pickled by an older version, after adding 'abc', 'ab' and 'abd':
+        # the URL ending at the internal node 'ab' had a child with an empty key
+        old_pickle = (
+            b'\x80\x02curltheory.preftree\nPrefTree\nq\x00)\x81q\x01}q\x02(X'
+            b'\x08\x00\x00\x00childrenq\x03}q\x04chashable_collections.hashabl'
+            b'e_collections\nhashable_list\nq\x05)\x81q\x06(X\x01\x00\x00\x00a'
+            b'q\x07X\x01\x00\x00\x00bq\x08eh\x00)\x81q\t}q\n(h\x03}q\x0b(h\x05'
+            b')\x81q\x0cX\x01\x00\x00\x00cq\rah\x00)\x81q\x0e}q\x0f(h\x03}q'
+            b'\x10X\t\x00\x00\x00url_countq\x11G?\xf0\x00\x00\x00\x00\x00\x00X'
+            b'\r\x00\x00\x00success_countq\x12G?\xf0\x00\x00\x00\x00\x00\x00X'
+            b'\x0b\x00\x00\x00is_wildcardq\x13\x89ubh\x05)\x81q\x14h\x00)\x81q'
+            b'\x15}q\x16(h\x03}q\x17h\x11G?\xf0\x00\x00\x00\x00\x00\x00h\x12G'
+            b'\x00\x00\x00\x00\x00\x00\x00\x00h\x13\x89ubh\x05)\x81q\x18X\x01'
+            b'\x00\x00\x00dq\x19ah\x00)\x81q\x1a}q\x1b(h\x03}q\x1ch\x11G?\xf0'
+            b'\x00\x00\x00\x00\x00\x00h\x12G?\xf0\x00\x00\x00\x00\x00\x00h\x13'
+            b'\x89ubuh\x11G@\x08\x00\x00\x00\x00\x00\x00h\x12G@\x00\x00\x00'
+            b'\x00\x00\x00\x00h\x13\x89ubsh\x11G@\x08\x00\x00\x00\x00\x00\x00h'
+            b'\x12G@\x00\x00\x00\x00\x00\x00\x00h\x13\x89ub.')
+        t = pickle.loads(old_pickle)
+        self.assertTrue(t.check_sanity())
+        self.assertEqual(sorted(t['ab'].children.keys()), [hashable_list('c'), hashable_list('d')])
+        self.assertEqual(t.match('ab'), (1,0))
+        self.assertEqual(t.match_length('ab'), (1,0,2))
+        self.assertEqual(t.match('abd'), (1,1))
+
+    def test_from_sorted(self):
+        urls = [
+            ('eprint.iacr.org/2016/093', False),
+            ('eprint.iacr.org/2016/093.pdf', True),
+            ('eprint.iacr.org/2015/1248.pdf', True),
+            ('eprint.iacr.org/2015/1248', False),
+            ('eprint.iacr.org/2015/1248', True),
+            ('eprint.iacr.org/', False),
+            ('arxiv.org/abs/1410.1454', False),
+            ]
+        ref = PrefTree()
+        for url, success in urls:
+            ref.add_url(prepare_url('http://'+url), success)
+
+        tokenized = [(prepare_url('http://'+url), 1, success)
+                     for url, success in urls]
+        t = PrefTree.from_sorted(external_sort(tokenized, chunk_size=3,
+                            key=lambda item: token_sort_key(item[0])))
+        self.assertTrue(t.check_sanity())
+        self.assertEqual((t.url_count, t.success_count), (7, 3))
+        for url, success in urls + [('eprint.iacr.org/2014/528.pdf', True)]:
+            tokenized = prepare_url('http://'+url)
+            self.assertEqual(t.match_length(tokenized), ref.match_length(tokenized))
+
+        with self.assertRaises(ValueError):
+            PrefTree.from_sorted([('ab', 1, 0), ('b', 1, 0), ('ac', 1, 0)])
+
+    def test_merge(self):
+        urls = [
+            ('arxiv.org/pdf/1410.1234', True),
+            ('arxiv.org/pdf/1409.1094', True),
+            ('arxiv.org/abs/1409.1094', False),
+            ('arxiv.org/', False),
+            ('gnu.org/about.html', False),
+            ('gnu.org/', False),
+            ]
+        ref = PrefTree()
+        t1 = PrefTree()
+        t2 = PrefTree()
+        for idx, (url, success) in enumerate(urls):
+            ref.add_url(url, success)
+            (t1 if idx % 2 else t2).add_url(url, success)
+        t1.merge(t2)
+        self.assertTrue(t1.check_sanity())
+        for url, success in urls + [('arxiv.org/pdf', False)]:
+            self.assertEqual(t1.match_length(url), ref.match_length(url))
+
+        # wildcards absorb merged urls
+        t3 = PrefTree()
+        t3.add_url('arxiv.org/pdf/', True)
+        t3['arxiv.org/pdf/'].is_wildcard = True
+        ref.merge(t3)
+        self.assertTrue(ref.check_sanity())
+        self.assertEqual(ref.match('arxiv.org/pdf/1784.1920'), (3,3))
+
+    def test_match_confident(self):
+        urls = ([('example.org/pdf/%d' % (i*7919), True) for i in range(30)] +
+                [('example.org/html/a%d' % i, True) for i in range(10)] +
+                [('example.org/html/b1', False)])
+        t = PrefTree()
+        for url, success in urls:
+            t.add_url(url, success)
+        smoothing = ConstantDirichlet()
+        url = 'example.org/html/b1'
+        # the node of the url is not confident, but its prefixes are
+        self.assertFalse(smoothing.is_confident(*t.match_length(url), threshold=0.3))
+        self.assertEqual(t.match_confident(url, smoothing, 0.3),
+                         (11, 10, len('example.org/html/'), True))
+        # stopping early decides with the first confident prefix
+        self.assertEqual(t.match_confident(url, smoothing, 0.3, stop_early=True),
+                         (41, 40, len('example.org/'), True))
+        # without any confident node, this is match_length
+        self.assertEqual(t.match_confident(url, smoothing, 0.99),
+                         t.match_length(url) + (False,))
+
+        compact = CompactPrefTree()
+        for u, success in urls:
+            compact.add_url(u, success)
+        for tree in [t.freeze(), compact]:
+            for stop_early in [False, True]:
+                self.assertEqual(tree.match_confident(url, smoothing, 0.3, stop_early=stop_early),
+                                 t.match_confident(url, smoothing, 0.3, stop_early=stop_early))
+
+    def test_match_many(self):
+        t = PrefTree()
+        for url, success in [('arxiv.org/pdf/1410.1234', True),
+                             ('arxiv.org/abs/1410.1234', False),
+                             ('arxiv.org/abs/1410.1234', True)]:
+            t.add_url(url, success)
+        urls = ['arxiv.org/abs/1410.1234', 'arxiv.org/pdf/1410.1234', 'bac']
+        counts, successes, lengths = t.match_many(urls)
+        self.assertEqual(counts.tolist(), [2, 1, 0])
+        self.assertEqual(successes.tolist(), [1, 1, 0])
+        self.assertEqual(lengths.tolist(), [t.match_length(u)[2] for u in urls])
+        smoothing = ConstantDirichlet()
+        probas = smoothing.evaluate(counts, successes, lengths)
+        self.assertEqual(probas.tolist(), [0.5, 2./3, 0.5])
+        confidences = proba_confidence_many(probas)
+        for p, c in zip(probas, confidences):
+            self.assertAlmostEqual(c, proba_confidence(p))
+        self.assertEqual(len(t.match_many([])[0]), 0)
+
     def test_accessors(self):
         t = PrefTree()
         urls = ['arxiv.org/abs/1410.1454','arxiv.org/pdf/1410.1454v2']
@@ -236,9 +544,385 @@ class RevPrefTreeTest(unittest.TestCase):
                 (3,3))
         self.assertEqual(t.generate_regex(confidence_threshold=0.1), '.*\.pdf')
 
+class CompactPrefTreeTest(unittest.TestCase):
+    urls = [
+        ('arxiv.org/pdf/1410.1234', True),
+        ('arxiv.org/pdf/1409.1094', True),
+        ('arxiv.org/pdf/1201.5480', True),
+        ('arxiv.org/abs/1201.5480', False),
+        ('arxiv.org/abs', False),
+        ('gnu.org/about.html', False),
+        ]
+
+    def test_create(self):
+        t = CompactPrefTree()
+        self.assertTrue(t.check_sanity())
+        ref = PrefTree()
+        for url, success in self.urls:
+            t.add_url(url, success)
+            ref.add_url(url, success)
+            self.assertTrue(t.check_sanity())
+        self.assertFalse(t.has_wildcard())
+        for url in ['arxiv.org/abs', 'arxiv.org/pdf/1410.1234',
+                    'arxiv.org/', 'arxiv.org/pdf/1410.12345', 'bac']:
+            self.assertEqual(t.match_length(url), ref.match_length(url))
+        self.assertEqual(sorted([(flatten(u), c, s) for u, c, s in t.urls()]),
+                         sorted([(flatten(u), c, s) for u, c, s in ref.urls()]))
+
+    def test_prune(self):
+        t = CompactPrefTree(count_typecode='f')
+        for url, success in self.urls:
+            t.add_url(url, success)
+        t, pruned = t.prune(confidence_threshold=proba_confidence(0.7),
+                            smoothing=NoSmoothing())
+        self.assertTrue(pruned)
+        self.assertTrue(t.has_wildcard())
+        self.assertTrue(t.check_sanity())
+        self.assertEqual(t.match('arxiv.org/pdf/1784.1920'), (3,3))
+        t.add_url('arxiv.org/pdf/1784.1920', True)
+        self.assertEqual(t.match('arxiv.org/pdf/1340.0124'), (4,4))
+        with self.assertRaises(ValueError):
+            t.prune(confidence_threshold=0)
+
+    def test_prune_kwargs(self):
+        t = CompactPrefTree()
+        kwargs = {'confidence_threshold':proba_confidence(0.7),
+                  'smoothing':NoSmoothing()}
+        for url, success in self.urls:
+            t.add_url(url, success, prune_kwargs=kwargs)
+        self.assertTrue(t.has_wildcard())
+        self.assertTrue(t.check_sanity())
+
+    def test_encoded(self):
+        t = CompactPrefTree(vocabulary=urltheory.tokenizer.vocabulary)
+        ref = PrefTree()
+        for url, success in self.urls:
+            t.add_url(prepare_url('http://'+url, encode=True), success)
+            ref.add_url(prepare_url('http://'+url), success)
+        for url in [u for u, s in self.urls] + ['arxiv.org/pdf/1784.1920', 'bac.org']:
+            encoded = prepare_url('http://'+url, encode=True)
+            tokenized = prepare_url('http://'+url)
+            self.assertEqual(t.match_length(encoded), ref.match_length(tokenized))
+            self.assertEqual(t.match_length(tokenized), ref.match_length(tokenized))
+
+        # token ids are renumbered when the tree is pickled
+        t2 = pickle.loads(pickle.dumps(t))
+        self.assertTrue(t2.check_sanity())
+        self.assertEqual(sorted(t2.labels), sorted(t.labels))
+        self.assertEqual(t2.match_length(prepare_url('http://gnu.org/about.html')), (1, 0, 13))
+        self.assertIs(t2.vocabulary, urltheory.tokenizer.vocabulary)
+
+    def test_vocabulary(self):
+        # the tokens of a tree are not interned in the global vocabulary
+        global_size = len(urltheory.tokenizer.vocabulary)
+        t = CompactPrefTree()
+        for i in range(50):
+            t.add_url(prepare_url('http://host%d.example.com/abs/%d' % (i, i)), True)
+        t.add_url(prepare_url('http://gnu.org/about.html'), False, 30)
+        self.assertEqual(len(urltheory.tokenizer.vocabulary), global_size)
+        self.assertGreaterEqual(len(t.vocabulary), 50)
+        # pruned tokens are dropped when the tree is pickled
+        t.prune(smoothing=NoSmoothing(), confidence_threshold=0.5)
+        self.assertTrue(t.has_wildcard())
+        t2 = pickle.loads(pickle.dumps(t))
+        self.assertTrue(t2.check_sanity())
+        self.assertLess(len(t2.vocabulary), 20)
+        self.assertEqual(t2.match(prepare_url('http://host3.example.com/abs/3')), (50, 50))
+        self.assertEqual(t2.match(prepare_url('http://gnu.org/about.html')), (30, 0))
+
+    def test_wildcard(self):
+        t = CompactPrefTree()
+        for url, success in self.urls:
+            t.add_url(url, success)
+        vocabulary_size = len(t.vocabulary)
+        t.add_url(list('arxiv.org/pdf/')+[WildcardCharacter()], True, 5)
+        # wildcards are not added to the vocabulary
+        self.assertEqual(len(t.vocabulary), vocabulary_size)
+        self.assertTrue(t.has_wildcard())
+        self.assertTrue(t.check_sanity())
+        self.assertEqual(t.match('arxiv.org/pdf/1784.1920'), (8,4))
+
+    def test_conversion(self):
+        ref = PrefTree()
+        for url, success in self.urls:
+            ref.add_url(prepare_url('http://'+url), success)
+        ref, pruned = ref.prune(confidence_threshold=0.1)
+        t = CompactPrefTree.from_preftree(ref)
+        self.assertTrue(t.check_sanity())
+        for url, success in self.urls:
+            tokenized = prepare_url('http://'+url)
+            self.assertEqual(t.match_length(tokenized), ref.match_length(tokenized))
+        back = t.to_preftree()
+        self.assertTrue(back.check_sanity())
+        self.assertEqual(len(back.urls()), len(ref.urls()))
+
+class JointPrefTreeTest(unittest.TestCase):
+    urls = [
+        ('pdf', 'arxiv.org/pdf/1410.1234', True),
+        ('pdf', 'arxiv.org/pdf/1409.1094', True),
+        ('custom', 'arxiv.org/pdf/1201.5480', False),
+        ('custom', 'arxiv.org/abs/1201.5480', True),
+        ('pdf', 'arxiv.org/abs', False),
+        ('custom', 'gnu.org/about.html', False),
+        ]
+    queries = ['arxiv.org/abs', 'arxiv.org/pdf/1410.1234', 'arxiv.org/',
+               'arxiv.org/pdf/1410.12345', 'arxiv.org/abs/1201.5480',
+               'gnu.org/about.html', 'bac']
+
+    def test_create(self):
+        t = JointPrefTree()
+        refs = {'pdf':PrefTree(), 'custom':PrefTree()}
+        for class_id, url, success in self.urls:
+            t.add_url(class_id, url, success)
+            refs[class_id].add_url(url, success)
+            self.assertTrue(t.check_sanity())
+        self.assertEqual(t.classes, ['pdf', 'custom'])
+        for url in self.queries:
+            counts, successes, lengths = t.match_all(url)
+            for k, class_id in enumerate(t.classes):
+                ref = refs[class_id].match_length(url)
+                self.assertEqual(t.match(class_id, url), ref[:2])
+                self.assertEqual((counts[k], successes[k]), ref[:2])
+                self.assertEqual(lengths[k], ref[2])
+                self.assertEqual(t.match_length(class_id, url), ref)
+        for class_id, ref in refs.items():
+            self.assertEqual(sorted([(flatten(u), c, s) for u, c, s in t.urls(class_id)]),
+                             sorted([(flatten(u), c, s) for u, c, s in ref.urls()]))
+        # shared prefixes are stored once
+        self.assertLess(t.node_count(), sum(CompactPrefTree.from_preftree(ref).node_count()
+                                            for ref in refs.values()))
+        with self.assertRaises(ValueError):
+            t.match('robots', 'arxiv.org/abs')
+        # its methods take the class first: it is not a CompactPrefTree
+        self.assertNotIsInstance(t, CompactPrefTree)
+        self.assertEqual(JointPrefTree().classes, [])
+
+    def test_random_urls(self):
+        # the URLs of each class give the same matches as a PrefTree,
+        # including the lengths of the prefixes of unknown URLs
+        rng = random.Random(42)
+        def random_url():
+            return ''.join(rng.choice('abc/') for _ in range(rng.randint(0, 6)))
+        t = JointPrefTree()
+        refs = {'pdf':PrefTree(), 'custom':PrefTree(), 'robots':PrefTree()}
+        for _ in range(200):
+            class_id = rng.choice(sorted(refs))
+            url = random_url()
+            success = rng.random() < 0.7
+            t.add_url(class_id, url, success)
+            refs[class_id].add_url(url, success)
+        smoothing = ConstantDirichlet()
+        for _ in range(500):
+            url = random_url()
+            counts, successes, lengths = t.match_all(url)
+            for k, class_id in enumerate(t.classes):
+                ref = refs[class_id]
+                self.assertEqual(t.match_length(class_id, url), ref.match_length(url))
+                self.assertEqual((counts[k], successes[k], lengths[k]), ref.match_length(url))
+                for stop_early in [False, True]:
+                    self.assertEqual(t.match_confident(class_id, url, smoothing, 0.3,
+                                                       stop_early=stop_early),
+                                     ref.match_confident(url, smoothing, 0.3,
+                                                         stop_early=stop_early))
+
+    def test_wildcard(self):
+        t = JointPrefTree()
+        t.add_url('custom', 'arxiv.org/pdf/1201.5480', False)
+        t.add_url('pdf', list('arxiv.org/pdf/12')+[WildcardCharacter()], 4, 5)
+        t.add_url('pdf', 'arxiv.org/pdf/1202.1234', True)
+        self.assertTrue(t.has_wildcard())
+        self.assertTrue(t.check_sanity())
+        self.assertEqual(t.match_length('pdf', 'arxiv.org/pdf/1201.0001'), (6, 5, 17))
+        self.assertEqual(t.match_length('custom', 'arxiv.org/pdf/1201.5480'), (1, 0, 23))
+        self.assertEqual(t.match_confident('pdf', 'arxiv.org/pdf/1201.0001',
+                                            NoSmoothing(), proba_confidence(0.8)),
+                         (6, 5, 17, True))
+
+    def test_conversion(self):
+        refs = {'pdf':PrefTree(), 'custom':PrefTree()}
+        for class_id, url, success in self.urls:
+            refs[class_id].add_url(prepare_url('http://'+url), success)
+        refs['pdf'].add_url(prepare_url('http://arxiv.org/pdf/math.pdf'), True)
+        refs['pdf'], pruned = refs['pdf'].prune(confidence_threshold=proba_confidence(0.9),
+                                                smoothing=NoSmoothing())
+        self.assertTrue(pruned)
+        t = JointPrefTree.from_preftrees(refs)
+        t = pickle.loads(pickle.dumps(t))
+        self.assertTrue(t.check_sanity())
+        for url in self.queries:
+            tokenized = prepare_url('http://'+url)
+            for class_id, ref in refs.items():
+                self.assertEqual(t.match(class_id, tokenized), ref.match(tokenized))
+        for class_id, ref in refs.items():
+            back = t.to_preftree(class_id)
+            self.assertTrue(back.check_sanity())
+            self.assertEqual(len(back.urls()), len(ref.urls()))
+        with self.assertRaises(ValueError):
+            JointPrefTree.from_preftrees({'pdf':RevPrefTree()})
+
+class FrozenPrefTreeTest(unittest.TestCase):
+    urls = CompactPrefTreeTest.urls
+
+    def test_match_length(self):
+        ref = PrefTree()
+        for url, success in self.urls:
+            ref.add_url(prepare_url('http://'+url), success)
+        ref.add_url(['arxiv.org', 7, 'ab'], True)
+        ref, pruned = ref.prune(confidence_threshold=0.1, reverse=True)
+        t = ref.freeze()
+        for url in [u for u, s in self.urls] + [
+                'arxiv.org/pdf/1784.1920', 'arxiv.org/', 'gnu.org/a.pdf',
+                'bac', '']:
+            tokenized = prepare_url('http://'+url) if url else []
+            self.assertEqual(t.match_length(tokenized),
+                             ref.match_length(tokenized))
+            self.assertEqual(t.match(tokenized), ref.match(tokenized))
+        with self.assertRaises(ValueError):
+            t.add_url('arxiv.org/', True)
+
+    def test_reversed(self):
+        ref = RevPrefTree()
+        for url, success in [
+            ('researchgate.net/publication/233865122_uriset', False),
+            ('researchgate.net/publication/143874230_albtedru', False),
+            ('researchgate.net/publication/233865122_uriset.pdf', True),
+            ('researchgate.net/publication/143874230_albtedru.pdf', True),
+            ]:
+            ref.add_url(url, success)
+        t = ref.freeze()
+        for url in ['researchgate.net/publication/143874230_albtedru',
+                    'researchgate.net/publication/7489168_lopdetu.pdf',
+                    'uriset.pdf', 'a']:
+            self.assertEqual(t.match_length(url), ref.match_length(url))
+
+    def test_match_many(self):
+        rnd = random.Random(7)
+        urls = [[rnd.choice('abc/') for _ in range(rnd.randint(0, 8))]
+                for _ in range(300)]
+        for cls in [PrefTree, RevPrefTree]:
+            ref = cls()
+            for url in urls[:200]:
+                ref.add_url(url, rnd.random() < 0.3)
+            for reverse in [False, True]:
+                pruned, _ = ref.prune(confidence_threshold=0.2, reverse=reverse)
+                for tree in [ref, pruned]:
+                    t = tree.freeze()
+                    counts, successes, lengths = t.match_many(urls)
+                    self.assertEqual(list(zip(counts.tolist(), successes.tolist(),
+                                              lengths.tolist())),
+                                     [t.match_length(url) for url in urls])
+        self.assertEqual(len(PrefTree().freeze().match_many([])[0]), 0)
+
+    def test_match_proba(self):
+        ref = PrefTree()
+        for url, success in self.urls:
+            ref.add_url(url, success)
+        with self.assertRaises(ValueError):
+            ref.freeze().match_proba('arxiv.org/abs')
+        smoothing = ConstantDirichlet()
+        t = ref.freeze(smoothing)
+        proba, confidence, length = t.match_proba('arxiv.org/abs')
+        self.assertAlmostEqual(proba, smoothing.evaluate(1, 0, len('arxiv.org/abs')))
+        self.assertAlmostEqual(confidence, proba_confidence(proba))
+        self.assertEqual(length, len('arxiv.org/abs'))
+        self.assertIsNone(t.match_proba('arxiv.org/'))
+        self.assertIsNone(t.match_proba('bac'))
+
+class SmoothingTest(unittest.TestCase):
+    def test_is_confident(self):
+        for smoothing in [ConstantDirichlet(), ConstantDirichlet(2., 5.),
+                          urltheory.smoothing.ExponentialDirichlet()]:
+            for count, success, length in [(10, 10, 0), (10, 0, 3), (40, 22, 5),
+                                           (3, 3, 70), (1000, 997, 150)]:
+                for threshold in [0.1, 0.5, 0.8, 0.95]:
+                    confidence = proba_confidence(
+                        smoothing.evaluate(count, success, length))
+                    self.assertEqual(smoothing.is_confident(count, success, length, threshold),
+                                     confidence >= threshold)
+                    self.assertEqual(smoothing.is_confident(count, success, length,
+                                                            threshold, strict=True),
+                                     confidence > threshold)
+            self.assertFalse(smoothing.is_confident(10, 10, 0, 1.5))
+        with self.assertRaises(NotImplementedError):
+            urltheory.smoothing.DirichletSmoothing().evaluate(10, 10, 0)
+
+    def test_evaluate_many(self):
+        smoothing = urltheory.smoothing.ExponentialDirichlet()
+        counts, successes, lengths = [10, 0, 4], [10, 0, 1], [40, 3, 200]
+        probas = smoothing.evaluate_many(counts, successes, lengths)
+        for proba, count, success, length in zip(probas, counts, successes, lengths):
+            self.assertAlmostEqual(proba, smoothing.evaluate(count, success, length))
+        self.assertEqual(smoothing.is_confident_many(counts, successes, lengths, 0.5).tolist(),
+            [smoothing.is_confident(c, s, l, 0.5) for c, s, l in zip(counts, successes, lengths)])
+
+class PrepareURLTest(unittest.TestCase):
+    def test_reference(self):
+        # the fast path of prepare_url returns the same tokens
+        # as the reference implementation
+        urls = ['http://arxiv.org/pdf/1703.01234v2',
+                'https://Example.COM:8080/a/b?x=1&y=2#top',
+                'http://example.com/?b=2&a=1&b=3',
+                'http://example.com/?q=a+b&sessionid=12',
+                'http://example.com/?q=&page=4',
+                'http://example.com/?q=a%20b',
+                'http://example.com/path;jsessionid=abc?x=1',
+                'http://dx.doi.org/10.1007/978-3-319?utm_source=x',
+                'http://hdl.handle.net',
+                'http:////example.com/x',
+                'http://example.com/t\xe9st',
+                'http://example.com/a\n',
+                'arxiv.org/abs/1234',
+                '//[::1]:80/x']
+        for url in urls:
+            self.assertEqual(prepare_url(url),
+                urltheory.tokenizer._prepare_url_reference(url))
+
+    def test_prepare_urls(self):
+        urls = ['http://example.com/%d?page=%d' % (i, i % 7) for i in range(50)]
+        expected = [prepare_url(url) for url in urls]
+        self.assertEqual(list(prepare_urls(urls, workers=3, chunksize=4)), expected)
+        self.assertEqual(list(prepare_urls(iter(urls), workers=1)), expected)
+        unordered = list(prepare_urls(urls, workers=3, chunksize=4, ordered=False))
+        self.assertEqual(sorted(unordered), list(enumerate(expected)))
+        self.assertEqual(list(prepare_urls([], workers=2)), [])
+
+    def test_prepare_urls_worker_killed(self):
+        urls = ['http://example.com/a', ExitOnUnpickle(), 'http://example.com/b']
+        with self.assertRaises(RuntimeError):
+            list(prepare_urls(urls, workers=2, chunksize=1))
+
+    def test_token_classes(self):
+        urls = ['http://repo.org/files/3f2a9c1b77e04d1e/a.pdf',
+                'http://repo.org/files/0b64ac1f29c8e7aa/a.pdf',
+                'http://repo.org/files/deadbeef/0f8fad5b-d9cb-469f-a165-70867728950e']
+        try:
+            urltheory.tokenizer.set_token_classes(['uuid', 'hex', 'digits'])
+            self.assertEqual(prepare_url(urls[2])[-2:], ['/', 1])
+            self.assertEqual(prepare_url(urls[0]), prepare_url(urls[1]))
+            for url in urls:
+                self.assertEqual(prepare_url(url),
+                    urltheory.tokenizer._prepare_url_reference(url))
+            t = PrefTree()
+            for url in urls:
+                t.add_url(prepare_url(url), True)
+            self.assertEqual(t.node_count(), 4)
+            regex = re.compile('^'+flatten_to_re(prepare_url(urls[0]))+'$')
+            self.assertTrue(regex.match('.org.repo/files/1234abcd/a.pdf'))
+            self.assertFalse(regex.match('.org.repo/files/1234/a.pdf'))
+        finally:
+            urltheory.tokenizer.set_token_classes(
+                urltheory.tokenizer.default_token_classes)
+        self.assertNotEqual(prepare_url(urls[0]), prepare_url(urls[1]))
+        with self.assertRaises(ValueError):
+            urltheory.tokenizer.set_token_classes(['nonexistent'])
+        with self.assertRaises(ValueError):
+            urltheory.tokenizer.TokenClass('bad', '(a+)', 4)
+
 def load_tests(loader, tests, ignore):
     tests.addTests(doctest.DocTestSuite(urltheory.tokenizer))
     tests.addTests(doctest.DocTestSuite(urltheory.utils))
     tests.addTests(doctest.DocTestSuite(urltheory.smoothing))
+    tests.addTests(doctest.DocTestSuite(urltheory.sorting))
+    tests.addTests(doctest.DocTestSuite(urltheory.frozentree))
     return tests
 
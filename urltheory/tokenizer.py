@@ -5,17 +5,208 @@ from requests.compat import urlencode
 from urllib.parse import parse_qs
 from urllib.parse import urlunparse
 import re
-
-url_scanner = re.Scanner([
-    (r'\d+', lambda s,t: 0),
-    (r'.', lambda s,t: t),
-    ])
+from array import array
+from functools import lru_cache
+from itertools import islice
+from multiprocessing import Process
+from multiprocessing import Queue
+from multiprocessing import cpu_count
+from urltheory.utils import WildcardCharacter
+from urltheory.utils import get_from_workers
 
 resolver_domains = ['dx.doi.org','doi.org','hdl.handle.net']
 protocol_re = re.compile(r'^([a-z]*:)?//')
 domain_re = re.compile(r'^([a-zA-Z0-9-.]*)((:[0-9]+)?(/.*)?)$')
 session_parameter_re = re.compile(r'(.*sess(ion)?id.*|utm_.*)')
 
+# URLs that prepare_url tokenizes without going through urlparse:
+# printable ASCII, a netloc, no path parameters (;) and no IPv6
+# address. Everything else goes through the reference implementation.
+fast_url_re = re.compile(
+    r'^(?:[a-zA-Z][a-zA-Z0-9+.-]*:)?//([^/?#;\[\]]+)([^?#;]*)(?:\?([^#;]*))?(?:#.*)?$')
+printable_ascii_re = re.compile(r'[!-~]*')
+# query strings which cleanup_parameters would leave unchanged, as
+# long as their keys are distinct and not session parameters
+canonical_query_re = re.compile(
+    r'^[A-Za-z0-9_.~-]+=[A-Za-z0-9_.~-]+(?:&[A-Za-z0-9_.~-]+=[A-Za-z0-9_.~-]+)*$')
+query_key_re = re.compile(r'(?:^|&)([^=&]*)=')
+
+class TokenClass(object):
+    """
+    A class of URL fragments (such as numbers or hexadecimal
+    identifiers) which the tokenizer replaces by a single token,
+    so that URLs which only differ by such fragments share
+    their branches in the trees. Class tokens are integers,
+    so that they cannot be confused with URL characters.
+
+    :param name: the name of the class
+    :param regex: the regular expression matching the fragments
+        (it must not contain capturing groups or match the empty string)
+    :param token: the integer the fragments are replaced by
+    """
+    def __init__(self, name, regex, token):
+        compiled = re.compile(regex)
+        if compiled.groups:
+            raise ValueError('The regular expression of token class %s '
+                             'must not contain capturing groups' % name)
+        if compiled.match(''):
+            raise ValueError('The regular expression of token class %s '
+                             'must not match the empty string' % name)
+        if type(token) != int or token < 0:
+            raise ValueError('Class tokens must be nonnegative integers')
+        self.name = name
+        self.regex = regex
+        self.token = token
+
+    def __repr__(self):
+        return 'TokenClass(%r, %r, %r)' % (self.name, self.regex, self.token)
+
+# the predefined token classes
+token_class_table = {
+    cls.name : cls for cls in [
+    TokenClass('digits', r'\d+', 0),
+    TokenClass('uuid',
+        r'[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}', 1),
+    # hexadecimal identifiers and hashes: at least 8 hex digits,
+    # including a letter and a digit
+    TokenClass('hex',
+        r'(?<![0-9A-Za-z])(?=[0-9a-fA-F]*[a-fA-F])(?=[0-9a-fA-F]*[0-9])'
+        r'[0-9a-fA-F]{8,}(?![0-9A-Za-z])', 2),
+    # URL-safe base64 handles: at least 16 characters, mixing
+    # lowercase and uppercase letters and digits
+    TokenClass('base64',
+        r'(?<![0-9A-Za-z_-])(?=[0-9A-Za-z_-]*[a-z])(?=[0-9A-Za-z_-]*[A-Z])'
+        r'(?=[0-9A-Za-z_-]*[0-9])[0-9A-Za-z_-]{16,}(?![0-9A-Za-z_-])', 3),
+    ]
+}
+default_token_classes = ['digits']
+
+def set_token_classes(classes):
+    """
+    Sets the token classes used by the tokenizer, by decreasing
+    priority: when several classes match at the same position, the
+    first one wins, so `digits` should come last. Trees must be matched
+    with URLs tokenized with the classes they were built with.
+
+    >>> set_token_classes(['uuid', 'hex', 'digits'])
+    >>> prepare_url('//h.org/f/0f8fad5b-d9cb-469f-a165-70867728950e/a3f9c2e1.pdf')
+    ['.org', '.h', '/', 'f', '/', 1, '/', 2, '.', 'p', 'd', 'f']
+    >>> set_token_classes(default_token_classes)
+
+    :param classes: a list of :class:`TokenClass`, or names of
+        predefined classes (see `token_class_table`)
+    """
+    global token_classes, url_scanner, _class_re, _class_tokens
+    resolved = []
+    for cls in classes:
+        if not isinstance(cls, TokenClass):
+            if cls not in token_class_table:
+                raise ValueError('Unknown token class: %s' % cls)
+            cls = token_class_table[cls]
+        resolved.append(cls)
+    if len(set(cls.token for cls in resolved)) != len(resolved):
+        raise ValueError('Token classes must have distinct tokens')
+
+    token_classes = resolved
+    url_scanner = re.Scanner(
+        [(cls.regex, lambda s,t,token=cls.token: token) for cls in resolved] +
+        [(r'.', lambda s,t: t)])
+    _class_re = re.compile('|'.join('(%s)' % cls.regex for cls in resolved)
+                           if resolved else '(?!)')
+    _class_tokens = [None] + [cls.token for cls in resolved]
+
+def class_token_regex(token):
+    """
+    The regular expression matching the fragments replaced by a class
+    token, looked up in the current token classes and then in the
+    predefined ones.
+
+    >>> print(class_token_regex(0))
+    \\d+
+    """
+    for cls in token_classes + list(token_class_table.values()):
+        if cls.token == token:
+            return cls.regex
+    raise ValueError('Unknown class token: %d' % token)
+
+class TokenVocabulary(object):
+    """
+    Maps the tokens produced by :func:`prepare_url` to small
+    integers (token ids), so that tokenized URLs can be stored
+    as compact arrays of unsigned integers, compared and
+    hashed much faster than lists of strings.
+
+    >>> voc = TokenVocabulary()
+    >>> voc.encode(['.org', '/', 0, '/']).tolist()
+    [0, 1, 2, 1]
+    >>> voc.decode(voc.encode(['.org', 'a']))
+    ['.org', 'a']
+    >>> voc.encode(['.com'], add=False).tolist() == [TokenVocabulary.unknown]
+    True
+
+    Wildcards (:class:`urltheory.utils.WildcardCharacter`) are not
+    tokens: they are all encoded as the reserved id `wildcard`.
+
+    >>> voc.encode(['.org', WildcardCharacter()]).tolist() == [0, TokenVocabulary.wildcard]
+    True
+    >>> len(voc)
+    4
+    """
+    # the id returned for tokens which are not in the vocabulary
+    unknown = 0xFFFFFFFF
+    # the id of wildcards
+    wildcard = 0xFFFFFFFE
+
+    def __init__(self):
+        self.tokens = []
+        self.ids = {}
+
+    def __len__(self):
+        return len(self.tokens)
+
+    def intern(self, token):
+        """
+        Returns the id of a token, allocating a new one
+        if it has never been seen.
+        """
+        tid = self.ids.get(token)
+        if tid is None:
+            if isinstance(token, WildcardCharacter):
+                return self.wildcard
+            tid = len(self.tokens)
+            self.tokens.append(token)
+            self.ids[token] = tid
+        return tid
+
+    def encode(self, tokens, add=True):
+        """
+        Encodes a list of tokens as an array of token ids.
+
+        :param add: add the new tokens to the vocabulary. Otherwise,
+            they are encoded as `unknown`.
+        """
+        if add:
+            return array('I', map(self.intern, tokens))
+        get = self.ids.get
+        unknown = self.unknown
+        return array('I', [get(token, unknown) for token in tokens])
+
+    def decode(self, ids):
+        """
+        Decodes an array of token ids to a list of tokens.
+        """
+        tokens = self.tokens
+        try:
+            return [tokens[tid] for tid in ids]
+        except IndexError:
+            wildcard = self.wildcard
+            return [WildcardCharacter() if tid == wildcard else tokens[tid]
+                    for tid in ids]
+
+# the vocabulary of the URLs encoded by prepare_url (compact trees
+# have their own vocabulary unless they are given this one)
+vocabulary = TokenVocabulary()
+
 def cleanup_parameters(querystring):
     """
     Removes session-specific arguments (such as jsessionid,
@@ -51,24 +242,38 @@ def normalize_url(url):
         cleaned_query,
         ''))
 
+def _class_token_group(token):
+    """
+    The regular expression of a class token, as a group if needed.
+    """
+    regex = class_token_regex(token)
+    return regex if token == 0 else '(?:%s)' % regex
+
 def flatten_to_re(lst, reverse=False):
     """
     Flattens a list of strings, produced by the tokenizer,
-    to a regular expression
+    to a regular expression. Class tokens are replaced by the
+    regular expression of their class.
+
+    >>> print(flatten_to_re(['a', '.', 0]))
+    a\\.\\d+
     """
     tokens = [
-        '\d+' if type(x) == int else re.escape(x)
+        _class_token_group(x) if type(x) == int else re.escape(x)
         for x in lst
     ]
     if reverse:
         tokens = reversed(tokens)
     return ''.join(tokens)
 
-def prepare_url(url):
+def prepare_url(url, encode=False):
     """
     Prepares a URL to be fed, removing the protocol and reversing the
     domain name.
 
+    :param encode: return the tokens as an array of ids of the
+        global `vocabulary` rather than as a list
+
     >>> prepare_url('http://dissem.in/faq')
     ['.in', '.dissem', '/', 'f', 'a', 'q']
     >>> prepare_url('//gnu.org')
@@ -88,6 +293,151 @@ def prepare_url(url):
     ['.net', '.handle', '.hdl', '/', '10985', '/', 0]
     >>> prepare_url('//gnu.org/?utm_source=twitter&jsessionid=e452fb1')
     ['.org', '.gnu', '/']
+    >>> vocabulary.decode(prepare_url('//gnu.org/', encode=True))
+    ['.org', '.gnu', '/']
+    """
+    if not url:
+        return url
+    match = fast_url_re.match(url)
+    if match is None or not printable_ascii_re.fullmatch(url):
+        return _prepare_url_reference(url, encode)
+
+    netloc, path, query = match.groups()
+    # do not tokenize DOIs or HANDLES as the numbers they contain can be significant
+    # to guess full text availability
+    if netloc in resolver_domains:
+        parts = path.split('/')
+        url_path = ['/']
+        if len(parts) > 1:
+            url_path += [parts[1], '/'] + _tokenize_ascii('/'.join(parts[2:]))
+    else:
+        if query:
+            if not _is_clean_query(query):
+                query = cleanup_parameters(query)
+            if query:
+                path += '?'+query
+        url_path = _tokenize_ascii(path)
+
+    tokens = list(_reversed_domain(netloc))
+    tokens += url_path
+    if encode:
+        return vocabulary.encode(tokens)
+    return tokens
+
+def prepare_urls(urls, workers=None, chunksize=1000, ordered=True):
+    """
+    Tokenizes a stream of URLs with :func:`prepare_url`, using
+    multiple processes. The URLs are sent to the workers by chunks
+    and the tokenized URLs are yielded as soon as their chunk is done,
+    so that the stream does not need to fit in memory.
+
+    We do not use :class:`multiprocessing.Pool` as its
+    internal queues are not compatible with gevent's
+    monkey-patching.
+
+    >>> list(prepare_urls(['//gnu.org/a', '//gnu.org/b'], workers=2, chunksize=1))
+    [['.org', '.gnu', '/', 'a'], ['.org', '.gnu', '/', 'b']]
+
+    :param urls: an iterable of URLs
+    :param workers: the number of processes to use (defaults to the
+        number of cores). With one worker, the URLs are tokenized in
+        the current process.
+    :param chunksize: the number of URLs sent to a worker at once
+    :param ordered: yield the tokenized URLs in the order of the input.
+        Otherwise, pairs `(index, tokens)` are yielded in the order in
+        which they are computed, where `index` is the position of the
+        URL in the input.
+    :returns: a generator of tokenized URLs
+    """
+    workers = workers or cpu_count()
+    if workers <= 1:
+        for index, url in enumerate(urls):
+            yield prepare_url(url) if ordered else (index, prepare_url(url))
+        return
+
+    tasks = Queue()
+    results = Queue()
+    processes = [Process(target=_prepare_chunks, args=(tasks, results))
+                 for i in range(workers)]
+    for process in processes:
+        process.daemon = True
+        process.start()
+
+    urls = iter(urls)
+    # chunks sent to the workers but not received yet are bounded,
+    # so that we do not read the whole input in advance
+    max_pending = 2*workers
+    sent = 0
+    received = 0
+    next_chunk = 0
+    done = {}
+    exhausted = False
+    try:
+        while True:
+            while not exhausted and sent - received < max_pending:
+                chunk = list(islice(urls, chunksize))
+                if not chunk:
+                    exhausted = True
+                    break
+                tasks.put((sent, chunk))
+                sent += 1
+            if received == sent:
+                break
+
+            chunk_id, tokenized = get_from_workers(results, processes)
+            received += 1
+            if isinstance(tokenized, Exception):
+                raise RuntimeError('A tokenization process failed: %s' % tokenized)
+            if not ordered:
+                start = chunk_id*chunksize
+                for index, tokens in enumerate(tokenized):
+                    yield (start + index, tokens)
+                continue
+            done[chunk_id] = tokenized
+            while next_chunk in done:
+                for tokens in done.pop(next_chunk):
+                    yield tokens
+                next_chunk += 1
+    finally:
+        if received < sent:
+            # we were interrupted: the workers might still be busy
+            # and the chunks left in the queue will never be read
+            tasks.cancel_join_thread()
+            for process in processes:
+                process.terminate()
+        else:
+            for process in processes:
+                tasks.put(None)
+        for process in processes:
+            process.join()
+
+def _prepare_chunks(tasks, results):
+    """
+    Tokenizes the chunks of URLs sent by :func:`prepare_urls`
+    in a worker process, until it receives `None`. If a chunk
+    fails, the exception is sent back instead and the worker
+    stops (with a zero exit code, as it did report its error).
+    """
+    while True:
+        task = tasks.get()
+        if task is None:
+            return
+        chunk_id, urls = task
+        try:
+            results.put((chunk_id, [prepare_url(url) for url in urls]))
+        except Exception as e:
+            results.put((chunk_id, e))
+            return
+
+def _prepare_url_reference(url, encode=False):
+    """
+    The straightforward implementation of :func:`prepare_url`,
+    which normalizes the URL with :func:`normalize_url` first.
+    It is used for the URLs that the fast path of
+    :func:`prepare_url` does not handle.
+
+    >>> _prepare_url_reference('http://dissem.in/faq;jsessionid=3')
+    ['.in', '.dissem', '/', 'f', 'a', 'q']
     """
     if not url:
         return url
@@ -98,11 +448,7 @@ def prepare_url(url):
     cleaned_params = cleanup_parameters(parsed.params)
     cleaned_query = cleanup_parameters(parsed.query)
 
-    split_by_port = parsed.netloc.split(':')
-    reversed_domain = ['.'+dom.lower() for dom in
-                       reversed(split_by_port[0].split('.'))]
-    if len(split_by_port) > 1:
-        reversed_domain.append(':'+split_by_port[1])
+    reversed_domain = list(_reversed_domain(parsed.netloc))
 
     # do not tokenize DOIs or HANDLES as the numbers they contain can be significant
     # to guess full text availability
@@ -120,8 +466,68 @@ def prepare_url(url):
             orig_path += '?'+cleaned_query
         url_path = tokenize_url_path(orig_path)
 
+    if encode:
+        return vocabulary.encode(reversed_domain + url_path)
     return reversed_domain + url_path
 
+@lru_cache(maxsize=65536)
+def _reversed_domain(netloc):
+    """
+    The tokens of a reversed domain name (followed by the port,
+    if any). Memoized, as URLs often share their host.
+
+    >>> _reversed_domain('umas.AC.uk:80')
+    ('.uk', '.ac', '.umas', ':80')
+    """
+    split_by_port = netloc.split(':')
+    reversed_domain = ['.'+dom.lower() for dom in
+                       reversed(split_by_port[0].split('.'))]
+    if len(split_by_port) > 1:
+        reversed_domain.append(':'+split_by_port[1])
+    return tuple(reversed_domain)
+
+def _is_clean_query(query):
+    """
+    Checks that :func:`cleanup_parameters` would leave a
+    query string unchanged: it has no session parameter, and is
+    already in the form produced by :func:`urlencode`.
+
+    >>> _is_clean_query('q=test&page=3')
+    True
+    >>> _is_clean_query('q=test&utm_source=twitter')
+    False
+    >>> _is_clean_query('q=a+b')
+    False
+    """
+    if not canonical_query_re.match(query):
+        return False
+    keys = query_key_re.findall(query)
+    if len(set(keys)) != len(keys):
+        return False
+    match = session_parameter_re.match
+    for key in keys:
+        if match(key) is not None:
+            return False
+    return True
+
+def _tokenize_ascii(path):
+    """
+    Same as :func:`tokenize_url_path`, for ASCII strings without
+    line breaks (which the regular expression scanner would stop at).
+
+    >>> _tokenize_ascii('h3l10s')
+    ['h', 0, 'l', 0, 's']
+    """
+    tokens = []
+    pos = 0
+    for match in _class_re.finditer(path):
+        start = match.start()
+        if start > pos:
+            tokens.extend(path[pos:start])
+        tokens.append(_class_tokens[match.lastindex])
+        pos = match.end()
+    tokens.extend(path[pos:])
+    return tokens
 
 def tokenize_url_path(url):
     """
@@ -138,3 +544,5 @@ def tokenize_url_path(url):
     results, remainder = url_scanner.scan(url)
     return results
 
+set_token_classes(default_token_classes)
+
@@ -1,6 +1,11 @@
 # -*- encoding: utf-8 -*-
 
+from functools import lru_cache
 from math import log
+import queue
+import time
+
+import numpy
 
 def binary_entropy(p):
     if p <= 0. or p >= 1.:
@@ -14,6 +19,65 @@ def proba_confidence(p):
     """
     return 1. - binary_entropy(p)
 
+def proba_confidence_many(p):
+    """
+    Vectorized version of :func:`proba_confidence`,
+    for NumPy arrays of probabilities.
+
+    >>> proba_confidence_many(numpy.array([0.5, 1., 0.8])).round(3).tolist()
+    [0.0, 1.0, 0.278]
+    """
+    p = numpy.asarray(p, dtype=float)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        entropy = -(p*numpy.log2(p) + (1-p)*numpy.log2(1-p))
+    return 1. - numpy.where((p <= 0.) | (p >= 1.), 0., entropy)
+
+def batch_match_length(match_length, urls):
+    """
+    Calls `match_length` on each of the urls and gathers
+    the results in NumPy arrays. This is a plain loop: it does
+    not speed up the matching itself, but lets the results be
+    smoothed in a single vectorized call.
+
+    >>> counts, successes, lengths = batch_match_length(lambda u: (len(u), 1, 2), ['ab', 'c'])
+    >>> counts.tolist(), successes.tolist(), lengths.tolist()
+    ([2.0, 1.0], [1.0, 1.0], [2, 2])
+
+    :returns: a triple of arrays: (url counts, success counts, lengths)
+    """
+    results = numpy.array([match_length(url) for url in urls],
+                          dtype=float).reshape(-1, 3)
+    return (results[:,0], results[:,1], results[:,2].astype(numpy.intp))
+
+def match_confident(nodes, smoothing, min_confidence, stop_early=False, strict=False):
+    """
+    Picks the node deciding for an URL, given the nodes met while
+    matching it to a tree. This is shared by the `match_confident`
+    methods of the trees, which only differ in the way they walk down.
+
+    >>> from urltheory.smoothing import ConstantDirichlet
+    >>> match_confident(iter([(1, 1, 1), (30, 30, 3), (1, 0, 5)]), ConstantDirichlet(), 0.5)
+    (30, 30, 3, True)
+
+    :param nodes: an iterator over the (url count, success count,
+        prefix length) of the nodes met on the way down (the root
+        excepted), followed by the triple returned by `match_length`
+    :param smoothing: the smoothing strategy used to evaluate the nodes
+    :param min_confidence: the confidence a node needs to decide
+    :param stop_early: return the first confident node met, instead
+        of the deepest one
+    :param strict: require confidences strictly higher than `min_confidence`
+    :returns: see :meth:`PrefTree.match_confident`
+    """
+    best = None
+    for url_count, success_count, length in nodes:
+        if url_count and smoothing.is_confident(url_count, success_count,
+                                                length, min_confidence, strict):
+            best = (url_count, success_count, length, True)
+            if stop_early:
+                break
+    return best or (url_count, success_count, length, False)
+
 class WildcardCharacter(object):
     """
     An object representing a wildcard in a string.
@@ -63,20 +127,22 @@ def flatten(lst):
         res += x
     return res
 
-def inverse_proba_confidence(c):
+@lru_cache(maxsize=1024)
+def inverse_proba_confidence(c, epsilon=0.000001):
     """
     Computes the inverse of the proba_confidence,
-    in [0.5,1]
+    in [0.5,1]. The results are cached, as the same
+    thresholds are inverted over and over.
 
     >>> int(round(100*inverse_proba_confidence(proba_confidence(0.8))))
     80
     """
-    return 1. - inverse_binary_entropy(1. - c)
+    return 1. - inverse_binary_entropy(1. - c, epsilon)
 
 def inverse_binary_entropy(e, epsilon=0.000001):
     """
     Computes the inverse of the binary entropy,
-    in [0,0.5]
+    in [0,0.5], by bisection up to `epsilon`
 
     >>> int(round(100*inverse_binary_entropy(0.)))
     0
@@ -123,3 +189,31 @@ def smoothing_for_min_counts(confidence_threshold, min_count_success, min_count_
     beta = (cb - rr*ca)/denom
     return (alpha, beta)
 
+
+def get_from_workers(results, processes, poll_interval=1.):
+    """
+    Waits for the next item put in a queue by worker processes.
+    The workers are checked regularly while waiting, so that we do
+    not wait forever if one of them died without sending anything
+    (for instance when it is killed by the out-of-memory killer).
+
+    :param results: the :class:`multiprocessing.Queue` to read from
+    :param processes: the worker processes filling the queue
+    :param poll_interval: the time (in seconds) between two checks
+    :raises RuntimeError: if one of the workers died
+    """
+    while True:
+        try:
+            return results.get(timeout=poll_interval)
+        except queue.Empty:
+            # when the os module is monkey-patched by gevent, the exit
+            # codes of the workers are only collected when the hub runs
+            time.sleep(0.001)
+            for process in processes:
+                if process.exitcode not in (None, 0):
+                    # what it sent before dying may have arrived meanwhile
+                    try:
+                        return results.get_nowait()
+                    except queue.Empty:
+                        raise RuntimeError('A worker process died (exit code %d).' %
+                                           process.exitcode)